@@ -0,0 +1,302 @@
+"""
+Benchmarks of the persistence layer and the game's hot paths.
+
+    python benchmark.py run [results.json] [backend] [quick]
+    python benchmark.py compare baseline.json results.json [tolerance]
+
+run measures, each in a fresh process against a database in a temporary
+directory:
+
+    generate.<n>            c_map_prototype.generate(n), and .flush the
+                            write that follows
+    reload.cold/.warm       c_reload_objects of a generated map in a new
+                            process, and again once everything is loaded
+    attributes.get/.set     persistent attribute reads and writes
+    list/dict.<cache mode>  db_list and db_dict changes, the flush
+                            included, under each db_cache_control mode
+    dock.catch_up/.prices   c_starbase.catch_up and get_prices over
+                            every starbase of a map
+
+Every case runs repeat times and keeps its best result. Results go to
+results.json (benchmark.json by default), with the unit of each metric:
+seconds, or operations per second for throughputs. backend is sqlite (the
+default), log, sharded or memory. memory forgets everything when its
+process ends, so there are no reload benchmarks for it. quick uses smaller
+maps and a single repeat.
+
+compare lists every metric of the baseline next to the new result, flags
+those worse by more than tolerance (0.25, that is 25%, by default) and
+exits with 1 if there are any.
+
+See memory_benchmark.py for the memory used per object.
+"""
+import json, os, platform, random, shutil, subprocess, sys, tempfile, time
+
+from persistent_object import persistent_object
+from db_interface import db_cache_control
+
+BACKENDS = ("sqlite", "log", "sharded", "memory")
+CACHE_MODES = (db_cache_control.CACHE_MODE_OFF, db_cache_control.CACHE_MODE_MANUAL,
+    db_cache_control.CACHE_MODE_TIMER, db_cache_control.CACHE_MODE_ON_EXIT)
+SECONDS = "s"
+PER_SECOND = "ops/s"
+
+def open_db(backend, directory):
+    if backend == "sqlite":
+        from sqlite3_db import sqlite3_db
+        return sqlite3_db(os.path.join(directory, "bench.db"))
+    if backend == "log":
+        from log_db import log_db
+        return log_db(os.path.join(directory, "bench.log"), compact_interval=None)
+    if backend == "sharded":
+        from sharded_sqlite_db import sharded_sqlite_db
+        return sharded_sqlite_db(os.path.join(directory, "bench.db"))
+    if backend == "memory":
+        from memory_db import memory_db
+        return memory_db()
+    raise Exception("Unknown backend {}".format(backend))
+
+def use_db(backend, directory, mode=db_cache_control.CACHE_MODE_MANUAL):
+    persistent_object.c_set_db_interface(open_db(backend, directory))
+    cache_control = persistent_object.c_db().get_cache_control()
+    cache_control.change_mode(mode)
+    return cache_control
+
+def timed(fn, *args):
+    began = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - began
+
+class bench_object(persistent_object):
+    class persistent_data_spec:
+        x = int
+        name = str
+        items = None
+        table = None
+
+    def __init__(self, i):
+        self.x = i
+        self.name = "object {}".format(i)
+        self.items = []
+        self.table = {}
+
+def case_generate(backend, directory, n):
+    import map_prototype
+    cache_control = use_db(backend, directory)
+    game_map = map_prototype.c_map_prototype()
+    return {
+        "generate.{}".format(n): (timed(game_map.generate, n), SECONDS),
+        "generate.{}.flush".format(n): (timed(cache_control.write_to_database), SECONDS),
+    }
+
+def case_reload(backend, directory, n):
+    # on the map generate left in directory
+    import map_prototype
+    use_db(backend, directory)
+    return {
+        "reload.cold": (timed(persistent_object.c_reload_objects), SECONDS),
+        "reload.warm": (timed(persistent_object.c_reload_objects), SECONDS),
+    }
+
+def case_attributes(backend, directory, n):
+    use_db(backend, directory)
+    objects = [bench_object(i) for i in range(100)]
+    persistent_object.c_db().get_cache_control().write_to_database()
+    began = time.perf_counter()
+    for i in range(n // len(objects)):
+        for o in objects:
+            o.x
+            o.name
+    get_time = time.perf_counter() - began
+    began = time.perf_counter()
+    for i in range(n // len(objects)):
+        for o in objects:
+            o.x = i
+            o.name = "renamed"
+    set_time = time.perf_counter() - began
+    count = 2 * (n // len(objects)) * len(objects)
+    return {
+        "attributes.get": (count / get_time, PER_SECOND),
+        "attributes.set": (count / set_time, PER_SECOND),
+    }
+
+def case_collections(backend, directory, n, mode):
+    cache_control = use_db(backend, directory, mode)
+    o = bench_object(0)
+    cache_control.flush()
+    began = time.perf_counter()
+    for i in range(n):
+        o.items.append(i)
+        if len(o.items) > 64:
+            del o.items[0]
+    cache_control.flush()
+    list_time = time.perf_counter() - began
+    began = time.perf_counter()
+    for i in range(n):
+        o.table[i % 64] = i
+    cache_control.flush()
+    dict_time = time.perf_counter() - began
+    return {
+        "list.{}".format(mode): (n / list_time, PER_SECOND),
+        "dict.{}".format(mode): (n / dict_time, PER_SECOND),
+    }
+
+def case_dock(backend, directory, n):
+    import map_prototype
+    use_db(backend, directory)
+    game_map = map_prototype.c_map_prototype()
+    game_map.generate(n)
+    persistent_object.c_db().get_cache_control().write_to_database()
+    starbases = [sector.starbase for sector in game_map.sectors.values() if sector.starbase]
+    now = time.time()
+    catch_up_time = prices_time = 0
+    rounds = 20
+    for i in range(rounds):
+        # an hour of trading between docks
+        now += 60 * 60
+        catch_up_time += timed(lambda: [starbase.catch_up(now) for starbase in starbases])
+        prices_time += timed(lambda: [starbase.get_prices() for starbase in starbases])
+    docks = rounds * len(starbases)
+    return {
+        "dock.catch_up": (docks / catch_up_time, PER_SECOND),
+        "dock.prices": (docks / prices_time, PER_SECOND),
+    }
+
+CASES = {
+    "generate": case_generate,
+    "reload": case_reload,
+    "attributes": case_attributes,
+    "collections": case_collections,
+    "dock": case_dock,
+}
+
+def run_case(name, backend, directory, *args):
+    """
+    Run a case in a new process, in directory. Returns its metrics.
+    """
+    out = os.path.join(directory, "metrics.json")
+    # same maps, same prices, same set orders every run
+    env = dict(os.environ, PYTHONHASHSEED="0")
+    command = [sys.executable, os.path.abspath(__file__), "case", name, backend, directory, out] + [str(arg) for arg in args]
+    result = subprocess.run(command, cwd=directory, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise Exception("Benchmark {} {} failed:\n{}".format(name, " ".join(str(arg) for arg in args), result.stderr))
+    with open(out) as f:
+        return json.load(f)
+
+def best(results):
+    # the least disturbed run: shortest time, highest throughput
+    merged = {}
+    for metrics in results:
+        for name, (value, unit) in metrics.items():
+            if name not in merged:
+                merged[name] = (value, unit)
+            elif (unit == SECONDS) == (value < merged[name][0]):
+                merged[name] = (value, unit)
+    return merged
+
+def run(backend="sqlite", quick=False):
+    sizes = (100, 1000) if quick else (100, 1000, 5000)
+    repeat = 1 if quick else 3
+    ops = 20000 if quick else 200000
+    cases = [("generate", n) for n in sizes]
+    cases.append(("attributes", ops))
+    for mode in CACHE_MODES:
+        # every change is a commit when writing immediately
+        cases.append(("collections", 200 if mode == db_cache_control.CACHE_MODE_OFF else ops // 10, mode))
+    cases.append(("dock", sizes[-1]))
+
+    metrics = {}
+    for case in cases:
+        results = []
+        for i in range(repeat):
+            directory = tempfile.mkdtemp(prefix="tw_bench_")
+            try:
+                results.append(run_case(case[0], backend, directory, *case[1:]))
+            finally:
+                shutil.rmtree(directory)
+        metrics.update(best(results))
+        print(" ".join(str(part) for part in case), "done")
+
+    if backend != "memory":
+        directory = tempfile.mkdtemp(prefix="tw_bench_")
+        try:
+            run_case("generate", backend, directory, sizes[-1])
+            metrics.update(best([run_case("reload", backend, directory, sizes[-1]) for i in range(repeat)]))
+            print("reload", sizes[-1], "done")
+        finally:
+            shutil.rmtree(directory)
+
+    return {
+        "backend": backend,
+        "quick": quick,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "metrics": {name: {"value": value, "unit": unit} for name, (value, unit) in sorted(metrics.items())},
+    }
+
+def compare(baseline, results, tolerance=0.25):
+    """
+    Lines comparing every metric of baseline to results, and the number
+    of regressions among them.
+    """
+    lines = []
+    regressions = 0
+    if baseline.get("backend") != results.get("backend") or baseline.get("quick") != results.get("quick"):
+        lines.append("Warning: comparing {} {} results to a {} {} baseline".format(
+            results.get("backend"), "quick" if results.get("quick") else "full",
+            baseline.get("backend"), "quick" if baseline.get("quick") else "full"))
+    lines.append("{:36} {:>14} {:>14} {:>8}".format("metric", "baseline", "now", "change"))
+    for name, base in sorted(baseline["metrics"].items()):
+        label = "{} ({})".format(name, base["unit"])
+        now = results["metrics"].get(name, None)
+        if now is None:
+            lines.append("{:36} {:>14.4g} {:>14} {:>8}  MISSING".format(label, base["value"], "-", "-"))
+            regressions += 1
+            continue
+        change = now["value"] / base["value"] - 1 if base["value"] else 0.0
+        # how much worse, whichever way the unit goes
+        worse = change if base["unit"] == SECONDS else base["value"] / now["value"] - 1 if now["value"] else float("inf")
+        flag = ""
+        if worse > tolerance:
+            flag = "  REGRESSION"
+            regressions += 1
+        elif worse < -tolerance:
+            flag = "  improved"
+        lines.append("{:36} {:>14.4g} {:>14.4g} {:>+7.0%}{}".format(label, base["value"], now["value"], change, flag))
+    return lines, regressions
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "case":
+        # python benchmark.py case name backend directory out args...
+        name, backend, directory, out = sys.argv[2:6]
+        args = [int(arg) if arg.isdigit() else arg for arg in sys.argv[6:]]
+        random.seed(1)
+        metrics = CASES[name](backend, directory, *args)
+        with open(out, "w") as f:
+            json.dump(metrics, f)
+    elif len(sys.argv) > 1 and sys.argv[1] == "run":
+        out = sys.argv[2] if len(sys.argv) > 2 else "benchmark.json"
+        backend = sys.argv[3] if len(sys.argv) > 3 else "sqlite"
+        if backend not in BACKENDS:
+            raise Exception("Unknown backend {}, not one of {}".format(backend, ", ".join(BACKENDS)))
+        results = run(backend, quick="quick" in sys.argv[4:])
+        with open(out, "w") as f:
+            json.dump(results, f, indent=2)
+        for name, metric in results["metrics"].items():
+            print("{:36} {:>14.4g} {}".format(name, metric["value"], metric["unit"]))
+        print("Wrote", out)
+    elif len(sys.argv) > 3 and sys.argv[1] == "compare":
+        with open(sys.argv[2]) as f:
+            baseline = json.load(f)
+        with open(sys.argv[3]) as f:
+            results = json.load(f)
+        lines, regressions = compare(baseline, results, float(sys.argv[4]) if len(sys.argv) > 4 else 0.25)
+        for line in lines:
+            print(line)
+        print("{} regression{}".format(regressions, "" if regressions == 1 else "s"))
+        sys.exit(1 if regressions else 0)
+    else:
+        print(__doc__)
+        sys.exit(2)
@@ -0,0 +1,137 @@
+"""
+Compact tagged binary encoding for stored values.
+
+Values are encoded the way they are stored in a database row, as
+(ref, value) pairs: scalars are (None, value) and references are
+(id, ref_type). A sequence of pairs packs into one bytes object.
+
+    tag  payload
+    n    (None)
+    i    zig-zag varint. Any size of int
+    f    8 byte little endian float
+    s    varint length, utf-8
+    b    varint length, raw bytes
+    o/l/d/u   varint id of a persistent object / list / dict / UNSET
+    r    varint length, ref type (utf-8), varint id. Any other reference
+"""
+import struct
+
+FORMAT_VERSION = 1
+
+__DOUBLE = struct.Struct("<d")
+
+__REF_TAGS = {
+    "__persistent_object__": b"o",
+    "__list__": b"l",
+    "__dict__": b"d",
+    "__unset__": b"u",
+}
+__TAG_REFS = {tag[0]: ref_type for ref_type, tag in __REF_TAGS.items()}
+
+def write_varint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def read_varint(buf, pos):
+    n = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+def write_int(out, n):
+    write_varint(out, (n << 1) if n >= 0 else ((-n << 1) - 1))
+
+def read_int(buf, pos):
+    n, pos = read_varint(buf, pos)
+    return ((n >> 1) if not n & 1 else -((n + 1) >> 1)), pos
+
+def write_item(out, ref, value):
+    if ref is not None:
+        tag = __REF_TAGS.get(value, None)
+        if tag is not None:
+            out += tag
+        else:
+            raw = value.encode("utf-8")
+            out += b"r"
+            write_varint(out, len(raw))
+            out += raw
+        write_int(out, ref)
+        return
+    value_type = type(value)
+    if value is None:
+        out += b"n"
+    elif value_type is int:
+        out += b"i"
+        write_int(out, value)
+    elif value_type is float:
+        out += b"f"
+        out += __DOUBLE.pack(value)
+    elif value_type is str:
+        raw = value.encode("utf-8")
+        out += b"s"
+        write_varint(out, len(raw))
+        out += raw
+    elif value_type is bytes:
+        out += b"b"
+        write_varint(out, len(value))
+        out += value
+    else:
+        raise Exception("Cannot encode type {}".format(value_type))
+
+def read_item(buf, pos):
+    tag = buf[pos]
+    pos += 1
+    ref_type = __TAG_REFS.get(tag, None)
+    if ref_type is not None:
+        ref, pos = read_int(buf, pos)
+        return (ref, ref_type), pos
+    if tag == 0x6e: # n
+        return (None, None), pos
+    if tag == 0x69: # i
+        value, pos = read_int(buf, pos)
+        return (None, value), pos
+    if tag == 0x66: # f
+        return (None, __DOUBLE.unpack_from(buf, pos)[0]), pos + 8
+    if tag == 0x73 or tag == 0x62 or tag == 0x72: # s, b, r
+        length, pos = read_varint(buf, pos)
+        raw = bytes(buf[pos:pos+length])
+        pos += length
+        if tag == 0x62:
+            return (None, raw), pos
+        if tag == 0x73:
+            return (None, raw.decode("utf-8")), pos
+        ref, pos = read_int(buf, pos)
+        return (ref, raw.decode("utf-8")), pos
+    raise Exception("Unknown tag {} at {}".format(chr(tag), pos-1))
+
+def pack_items(items):
+    """
+    Pack an iterable of (ref, value) pairs.
+    """
+    out = bytearray()
+    out.append(FORMAT_VERSION)
+    items = list(items)
+    write_varint(out, len(items))
+    for ref, value in items:
+        write_item(out, ref, value)
+    return bytes(out)
+
+def unpack_items(buf):
+    """
+    Unpack bytes (or any buffer) produced by pack_items into a list of (ref, value) pairs.
+    """
+    if buf[0] != FORMAT_VERSION:
+        raise Exception("Unsupported packed format {}".format(buf[0]))
+    count, pos = read_varint(buf, 1)
+    items = []
+    for i in range(count):
+        item, pos = read_item(buf, pos)
+        items.append(item)
+    return items
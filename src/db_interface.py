@@ -1,22 +1,82 @@
-import time, atexit
+import time, atexit, logging, threading, weakref
+
+log = logging.getLogger(__name__)
+
+class db_id_allocator:
+    """
+    Hands out ids from blocks. lease(count) returns the first of count ids
+    that nobody else will be given, so the database is only involved once
+    per block_size ids. Ids left in a block when the process ends are
+    never used.
+    """
+    def __init__(self, lease, block_size=1024):
+        self.lease = lease
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.limit = 0
+        
+    @classmethod
+    def c_in_memory(cls, first_id=0):
+        """
+        Allocator for a single process and a database that doesn't outlive it.
+        """
+        next_block = [first_id]
+        def lease(count):
+            next_block[0] += count
+            return next_block[0] - count
+        return cls(lease)
+        
+    def next(self):
+        with self.lock:
+            if self.next_id >= self.limit:
+                self.next_id = self.lease(self.block_size)
+                self.limit = self.next_id + self.block_size
+            self.next_id += 1
+            return self.next_id - 1
 
 class db_complex_type_ctx:
     """
     This structure is meant to be glue between a complex type (like an object or list)
     and the database. 
     
-    - db_id is a unique id across all possible complex types.
+    - db_id is a unique id across all possible complex types, from the database's id_allocator.
     - db_type_name is a hint for databases (e.g., databses that want a separate table for the type)
     - db_spec is hints that can be used to control types. Can be empty, or types can be None if supported
-    - fields_cache is a dictionary where the complex type holds cached data.
+    - fields_cache is where the complex type holds cached data. A db_field_record for objects.
     - change_notifier is called every time fields are updated. Updates are signaled through fields_changed()
+    - journal, when set, is called before fields are updated. Updates are signaled through fields_changing(). It records them for the calling thread's open transaction, if any
+    - db_format belongs to the database: how the complex type is currently stored (None if never stored)
+    - lock is held while a fields cache changes together with its dirty fields, and while the database serializes them
+    
+    Contexts are slotted and clean ones share CLEAN as their dirty fields;
+    there is one per persistent object, list and dictionary.
     """
-    __next_id = 0
+    __slots__ = ("db_id", "db_type_name", "db_spec", "fields_cache", "db_dirty_fields", "change_notifier", "notify", "db_format")
+    id_allocator = db_id_allocator.c_in_memory()
+    conflict_handler = None
+    journal = None
+    lock = threading.RLock()
+    CLEAN = ()
+    DIRTY_FIELDS_TYPE = set
+    CONFLICT_REFRESH = "refresh"
+    CONFLICT_RETRY = "retry"
     
     @classmethod
     def c_next_id(cls):
-        db_complex_type_ctx.__next_id += 1
-        return (db_complex_type_ctx.__next_id - 1)
+        return db_complex_type_ctx.id_allocator.next()
+        
+    @classmethod
+    def c_set_id_allocator(cls, id_allocator):
+        db_complex_type_ctx.id_allocator = id_allocator
+        
+    @classmethod
+    def c_set_conflict_handler(cls, handler):
+        """
+        handler(ctx) decides what on_conflict returns. None restores the
+        default, CONFLICT_REFRESH.
+        """
+        db_complex_type_ctx.conflict_handler = None if handler is None else staticmethod(handler)
         
     def __init__(self, db_type_name, db_spec, fields_cache, change_notifier, set_id=None):
         if set_id is None:
@@ -26,9 +86,10 @@ class db_complex_type_ctx:
         self.db_type_name = db_type_name
         self.db_spec = db_spec
         self.fields_cache = fields_cache
-        self.db_dirty_fields = set([])
+        self.db_dirty_fields = self.CLEAN
         self.change_notifier = change_notifier
         self.notify = True
+        self.db_format = None
         
     def set_db_loading_mode(self):
         '''
@@ -40,31 +101,239 @@ class db_complex_type_ctx:
         self.notify = False
         
         
+    def fields_changing(self):
+        '''
+        Called before the fields cache is modified, so that an open
+        transaction can keep a copy to roll back to.
+        '''
+        if self.notify and db_complex_type_ctx.journal is not None:
+            db_complex_type_ctx.journal(self)
+            
     def fields_changed(self, fields):
         if not self.notify: return
         
-        self.db_dirty_fields.update(fields)
-        self.change_notifier(self)
+        # the notifier records the dirty fields (under its lock, if it has one)
+        self.change_notifier(self, fields)
         
+    def mark_dirty(self, fields):
+        # the dirty fields container is only allocated once something changes
+        if self.db_dirty_fields is self.CLEAN:
+            self.db_dirty_fields = self.DIRTY_FIELDS_TYPE(fields)
+        else:
+            self.db_dirty_fields.update(fields)
+            
     def fields_synchronized(self):
-        self.db_dirty_fields.clear()
+        self.db_dirty_fields = self.CLEAN
         self.notify = True
         
+    def fields_unwritten(self, fields, db_format):
+        '''
+        Undoes fields_synchronized for a write that failed: fields are
+        dirty again, ahead of whatever changed since, and db_format is
+        what it was before the write.
+        '''
+        # still the same container if the write failed before synchronizing
+        if fields is not self.db_dirty_fields:
+            dirty_fields = self.DIRTY_FIELDS_TYPE(fields)
+            dirty_fields.update(self.db_dirty_fields)
+            self.db_dirty_fields = dirty_fields
+        self.db_format = db_format
+        
+    def on_conflict(self):
+        '''
+        Called when another process changed what this context was about
+        to write. CONFLICT_REFRESH drops the write and re-reads the stored
+        version; CONFLICT_RETRY writes this version over it on the next
+        flush.
+        '''
+        if self.conflict_handler is None:
+            return self.CONFLICT_REFRESH
+        return self.conflict_handler(self)
+        
+    def snapshot(self):
+        return (self.fields_cache._copy(), set(self.db_dirty_fields))
+        
+    def restore(self, snapshot):
+        # restore in place. The owner holds on to fields_cache
+        cache, dirty_fields = snapshot
+        self.fields_cache._update(cache)
+        self.db_dirty_fields = dirty_fields
+        
+        
+class db_field_record:
+    """
+    Field cache of a persistent object: a slot per field instead of a
+    dictionary per object. Each persistent class gets its own record class
+    from c_record_class. Supports the dictionary operations the database
+    uses (record[field], field in record, iteration over field names).
+    
+    Fields start out as db_interface.UNSET.
+    """
+    __slots__ = ()
+    FIELDS = frozenset()
+    
+    @classmethod
+    def c_record_class(cls, name, fields):
+        fields = tuple(fields)
+        return type(name, (cls,), {"__slots__": fields, "FIELDS": frozenset(fields)})
+        
+    def __init__(self):
+        for k in self.FIELDS:
+            object.__setattr__(self, k, db_interface.UNSET)
+            
+    def __getitem__(self, k):
+        if k not in self.FIELDS: raise KeyError(k)
+        return object.__getattribute__(self, k)
+        
+    def __setitem__(self, k, v):
+        if k not in self.FIELDS: raise KeyError(k)
+        object.__setattr__(self, k, v)
+        
+    def __contains__(self, k):
+        return k in self.FIELDS
+        
+    def __iter__(self):
+        return iter(self.FIELDS)
+        
+    def __len__(self):
+        return len(self.FIELDS)
+        
+    def _copy(self):
+        return {k: object.__getattribute__(self, k) for k in self.FIELDS}
+        
+    def _update(self, data):
+        for k, v in data.items():
+            self[k] = v
+            
+    def __repr__(self):
+        return "<{} {}>".format(type(self).__name__, self._copy())
+        
         
+class db_list_oplog(list):
+    """
+    The dirty fields of a db_list: a log of the mutations since the list
+    was last synchronized. Each entry carries what it overwrote, so the
+    stored list can be rebuilt by undoing the log.
+    """
+    update = list.extend
+    
 class db_list(list):
     """
     DB interface wrapper for lists.
+    
+    Changes are recorded as operations rather than dirty indexes. Rows are
+    stored by index, so an insert or delete still rewrites every row after
+    it, but a flush only writes rows whose value differs from the stored
+    list, and a log of sets and appends is flushed without scanning the list:
+    
+    - (OP_SET, index, old_value)
+    - (OP_INSERT, index)
+    - (OP_DELETE, index, old_value)
+    - (OP_APPEND, count)
+    - (OP_TRUNCATE, new_length, old_tail)
+    - (OP_REWRITE, old_items) e.g., sort or slice assignment
     """
+    OP_SET = "set"
+    OP_INSERT = "insert"
+    OP_DELETE = "delete"
+    OP_APPEND = "append"
+    OP_TRUNCATE = "truncate"
+    OP_REWRITE = "rewrite"
+    
+    __slots__ = ("_db_ctx", "__weakref__")
     
     class REGISTRY:
-        __LIST_LOOKUP = {}
+        # weak, like the object directory. Unwritten changes keep an
+        # aggregate alive through its context in the pending map
+        __LIST_LOOKUP = weakref.WeakValueDictionary()
     
         class db_list_ctx(db_complex_type_ctx):
+            __slots__ = ()
+            DIRTY_FIELDS_TYPE = db_list_oplog
+            
             def __init__(self, l, change_notifier, set_id=None):
                 super().__init__("__list__", db_spec={}, fields_cache=l, change_notifier=change_notifier, set_id=set_id)
+                
+            def fields_changed(self, ops):
+                super().fields_changed(ops)
+                log = self.db_dirty_fields
+                # keep the log from outgrowing the list itself
+                if len(log) > 2 * len(self.fields_cache) + 16:
+                    self.db_dirty_fields = db_list_oplog([(db_list.OP_REWRITE, self.stored_items())])
+                # undoing an insert or delete moves every item after it. Once
+                # there are a few, start the log with the stored list instead
+                elif len(log) > 16 and log[0][0] != db_list.OP_REWRITE and ops[-1][0] in (db_list.OP_INSERT, db_list.OP_DELETE):
+                    self.db_dirty_fields = db_list_oplog([(db_list.OP_REWRITE, self.stored_items())] + log)
+                
+            def stored_items(self):
+                """
+                The list as of the last synchronization, made by undoing the log
+                back from the first rewrite in it, which has the list it overwrote.
+                """
+                log = self.db_dirty_fields
+                items, undo = self.fields_cache, len(log)
+                for i, op in enumerate(log):
+                    if op[0] == db_list.OP_REWRITE:
+                        items, undo = op[1], i
+                        break
+                items = list(items)
+                for op in reversed(log[:undo]):
+                    op_type = op[0]
+                    if op_type == db_list.OP_SET:
+                        items[op[1]] = op[2]
+                    elif op_type == db_list.OP_INSERT:
+                        del items[op[1]]
+                    elif op_type == db_list.OP_DELETE:
+                        items.insert(op[1], op[2])
+                    elif op_type == db_list.OP_APPEND:
+                        del items[len(items)-op[1]:]
+                    else:
+                        items[op[1]:] = op[2]
+                return items
+                
+            def changed_indexes(self):
+                """
+                Indexes whose value differs from the stored list, and indexes
+                that no longer exist.
+                """
+                log = self.db_dirty_fields
+                new_items = self.fields_cache
+                if all(op[0] in (db_list.OP_SET, db_list.OP_APPEND, db_list.OP_TRUNCATE) for op in log):
+                    # nothing moved. Rows from the first appended or truncated
+                    # index on are written, and set rows that really changed
+                    old_len = first_resized = len(new_items)
+                    old_values = {}
+                    for op in reversed(log):
+                        if op[0] == db_list.OP_SET:
+                            old_values[op[1]] = op[2]
+                        elif op[0] == db_list.OP_APPEND:
+                            old_len -= op[1]
+                            first_resized = min(first_resized, old_len)
+                        else:
+                            old_len = op[1] + len(op[2])
+                            first_resized = min(first_resized, op[1])
+                    changed = [i for i, value in old_values.items() if i < first_resized and not self.same_value(value, new_items[i])]
+                    changed.extend(range(first_resized, len(new_items)))
+                    return changed, range(len(new_items), old_len)
+                old_items = self.stored_items()
+                changed = [i for i in range(min(len(old_items), len(new_items))) if not self.same_value(old_items[i], new_items[i])]
+                changed.extend(range(len(old_items), len(new_items)))
+                return changed, range(len(new_items), len(old_items))
+                
+            @staticmethod
+            def same_value(a, b):
+                return a is b or (type(a) is type(b) and a == b)
+                
+            def snapshot(self):
+                return (list(self.fields_cache), db_list_oplog(self.db_dirty_fields))
+                
+            def restore(self, snapshot):
+                items, dirty_fields = snapshot
+                list.__setitem__(self.fields_cache, slice(None), items)
+                self.db_dirty_fields = dirty_fields
     
         @classmethod
-        def c_create_db_list(cls, cache_control, raw_list=None, fixed_id=None):
+        def c_create_db_list(cls, cache_control, raw_list=None, fixed_id=None, loading=False):
             if raw_list is not None:
                 l = db_list(raw_list)
             else:
@@ -73,7 +342,9 @@ class db_list(list):
             # TODO: Lots of circular references here. Simpler solution?
             db_ctx = cls.db_list_ctx(l, cache_control, set_id=fixed_id)
             l._db_ctx = db_ctx
-            db_ctx.fields_changed(range(len(l)))
+            # lists coming out of the database are already synchronized
+            if not loading:
+                db_ctx.fields_changed([(db_list.OP_REWRITE, [])])
             cls.__LIST_LOOKUP[db_ctx.db_id] = l
             return l
             
@@ -82,93 +353,144 @@ class db_list(list):
             return cls.__LIST_LOOKUP.get(db_id, None)
         
     def __iadd__(self, other):
-        old_len = len(self)
-        ret = super().__iadd__(other)
-        new_len = len(self)
-        self._db_ctx.fields_changed(range(old_len, new_len))
+        with self._db_ctx.lock:
+            self._db_ctx.fields_changing()
+            old_len = len(self)
+            ret = super().__iadd__(other)
+            self._db_ctx.fields_changed([(self.OP_APPEND, len(self) - old_len)])
         return ret
         
     def __imul__(self, i):
-        old_len = len(self)
-        ret = super().__imul__(i)
-        new_len = len(self)
-        self._db_ctx.fields_changed(range(old_len, new_len))
+        with self._db_ctx.lock:
+            self._db_ctx.fields_changing()
+            old_items = list(self)
+            ret = super().__imul__(i)
+            if len(self) >= len(old_items):
+                self._db_ctx.fields_changed([(self.OP_APPEND, len(self) - len(old_items))])
+            else:
+                self._db_ctx.fields_changed([(self.OP_TRUNCATE, 0, old_items)])
         return ret
         
     def __setitem__(self, k, v):
-        if k < 0: k = len(self) + k
-        ret = super().__setitem__(k, v)
-        self._db_ctx.fields_changed([k])
+        with self._db_ctx.lock:
+            self._db_ctx.fields_changing()
+            if isinstance(k, slice):
+                old_items = list(self)
+                ret = super().__setitem__(k, v)
+                self._db_ctx.fields_changed([(self.OP_REWRITE, old_items)])
+                return ret
+            if k < 0: k = len(self) + k
+            old_value = self[k]
+            ret = super().__setitem__(k, v)
+            self._db_ctx.fields_changed([(self.OP_SET, k, old_value)])
         return ret
         
     def __delitem__(self, k):
-        if k < 0: k = len(self) + k
-        old_len = len(self)
-        ret = super().__delitem__(k, v)
-        self._db_ctx.fields_changed(range(k, old_len))
+        with self._db_ctx.lock:
+            self._db_ctx.fields_changing()
+            if isinstance(k, slice):
+                old_items = list(self)
+                ret = super().__delitem__(k)
+                self._db_ctx.fields_changed([(self.OP_REWRITE, old_items)])
+                return ret
+            if k < 0: k = len(self) + k
+            old_value = self[k]
+            ret = super().__delitem__(k)
+            self._db_ctx.fields_changed([(self.OP_DELETE, k, old_value)])
         return ret
         
     def append(self, v):
-        ret = super().append(v)
-        self._db_ctx.fields_changed([len(self)-1])
+        with self._db_ctx.lock:
+            self._db_ctx.fields_changing()
+            ret = super().append(v)
+            self._db_ctx.fields_changed([(self.OP_APPEND, 1)])
         return ret
         
     def insert(self, pos, item):
-        if pos < 0: pos = len(self) + pos
-        ret = super().insert(pos, item)
-        self._db_ctx.fields_changed(range(pos, len(self)))
+        with self._db_ctx.lock:
+            self._db_ctx.fields_changing()
+            # same clamping as list.insert
+            if pos < 0: pos = max(0, len(self) + pos)
+            pos = min(pos, len(self))
+            ret = super().insert(pos, item)
+            self._db_ctx.fields_changed([(self.OP_INSERT, pos)])
         return ret
         
     def sort(self, *args, **kargs):
-        ret = super().sort(*args, **kargs)
-        self._db_ctx.fields_changed(range(len(self)))
+        with self._db_ctx.lock:
+            self._db_ctx.fields_changing()
+            old_items = list(self)
+            ret = super().sort(*args, **kargs)
+            self._db_ctx.fields_changed([(self.OP_REWRITE, old_items)])
         return ret
         
     def reverse(self, *args, **kargs):
-        ret = super().reverse(*args, **kargs)
-        self._db_ctx.fields_changed(range(len(self)))
+        with self._db_ctx.lock:
+            self._db_ctx.fields_changing()
+            old_items = list(self)
+            ret = super().reverse(*args, **kargs)
+            self._db_ctx.fields_changed([(self.OP_REWRITE, old_items)])
         return ret
         
     def remove(self, item):
-        index = super().index(item)
-        old_len = len(self)
-        ret = super().remove(item)
-        self._db_ctx.fields_changed(range(index, old_len))
+        with self._db_ctx.lock:
+            self._db_ctx.fields_changing()
+            index = super().index(item)
+            old_value = self[index]
+            ret = super().__delitem__(index)
+            self._db_ctx.fields_changed([(self.OP_DELETE, index, old_value)])
         return ret
         
     def pop(self, index=-1):
-        if index < 0: index = len(self) + index
-        old_len = len(self)
-        ret = super().pop(index)
-        self._db_ctx.fields_changed(range(index, old_len))
+        with self._db_ctx.lock:
+            self._db_ctx.fields_changing()
+            if index < 0: index = len(self) + index
+            ret = super().pop(index)
+            self._db_ctx.fields_changed([(self.OP_DELETE, index, ret)])
         return ret
         
     def extend(self, iterable):
-        old_len = len(self)
-        ret = super().extend(iterable)
-        self._db_ctx.fields_changed(range(old_len, len(self)))
+        with self._db_ctx.lock:
+            self._db_ctx.fields_changing()
+            old_len = len(self)
+            ret = super().extend(iterable)
+            self._db_ctx.fields_changed([(self.OP_APPEND, len(self) - old_len)])
         return ret
         
     def clear(self):
-        old_len = len(self)
-        ret = super().clear()
-        self._db_ctx.fields_changed(range(old_len))
+        with self._db_ctx.lock:
+            self._db_ctx.fields_changing()
+            old_items = list(self)
+            ret = super().clear()
+            self._db_ctx.fields_changed([(self.OP_TRUNCATE, 0, old_items)])
         return ret
         
 class db_dict(dict):
     """
     DB interface wrapper for dictionaries.
     """
+    __slots__ = ("_db_ctx", "__weakref__")
     
     class REGISTRY:
-        __DICT_LOOKUP = {}
+        __DICT_LOOKUP = weakref.WeakValueDictionary()
     
         class db_dict_ctx(db_complex_type_ctx):
+            __slots__ = ()
+            
             def __init__(self, d, change_notifier, set_id=None):
                 super().__init__("__dict__", db_spec={}, fields_cache=d, change_notifier=change_notifier, set_id=set_id)
+                
+            def snapshot(self):
+                return (self.fields_cache.copy(), set(self.db_dirty_fields))
+                
+            def restore(self, snapshot):
+                cache, dirty_fields = snapshot
+                dict.clear(self.fields_cache)
+                dict.update(self.fields_cache, cache)
+                self.db_dirty_fields = dirty_fields
     
         @classmethod
-        def c_create_db_dict(cls, cache_control, raw_dict=None, fixed_id=None):
+        def c_create_db_dict(cls, cache_control, raw_dict=None, fixed_id=None, loading=False):
             if raw_dict is not None:
                 d = db_dict(raw_dict)
             else:
@@ -177,7 +499,9 @@ class db_dict(dict):
             # TODO: Lots of circular references here. Simpler solution?
             db_ctx = cls.db_dict_ctx(d, cache_control, set_id=fixed_id)
             d._db_ctx = db_ctx
-            db_ctx.fields_changed(d.keys())
+            # dicts coming out of the database are already synchronized
+            if not loading:
+                db_ctx.fields_changed(d.keys())
             cls.__DICT_LOOKUP[db_ctx.db_id] = d
             return d
             
@@ -186,51 +510,254 @@ class db_dict(dict):
             return cls.__DICT_LOOKUP.get(db_id, None)
         
     def __setitem__(self, k, v):
-        ret = super().__setitem__(k, v)
-        self._db_ctx.fields_changed([k])
+        with self._db_ctx.lock:
+            self._db_ctx.fields_changing()
+            ret = super().__setitem__(k, v)
+            self._db_ctx.fields_changed([k])
         return ret
         
     def __delitem__(self, k):
-        ret = super().__delitem__(k, v)
-        self._db_ctx.fields_changed([k])
+        with self._db_ctx.lock:
+            self._db_ctx.fields_changing()
+            ret = super().__delitem__(k)
+            self._db_ctx.fields_changed([k])
         return ret
         
     def pop(self, k):
-        ret = super().pop(k)
-        self._db_ctx.fields_changed([k])
+        with self._db_ctx.lock:
+            self._db_ctx.fields_changing()
+            ret = super().pop(k)
+            self._db_ctx.fields_changed([k])
         return ret
         
     def popitem(self):
-        pop_key, pop_value = super().popitem()
-        self._db_ctx.fields_changed([pop_key])
+        with self._db_ctx.lock:
+            self._db_ctx.fields_changing()
+            pop_key, pop_value = super().popitem()
+            self._db_ctx.fields_changed([pop_key])
         return pop_key, pop_value
         
     def clear(self):
-        old_keys = list(self.keys())
-        ret = super().clear()
-        self._db_ctx.fields_changed(old_keys)
+        with self._db_ctx.lock:
+            self._db_ctx.fields_changing()
+            old_keys = list(self.keys())
+            ret = super().clear()
+            self._db_ctx.fields_changed(old_keys)
         return ret
         
     def update(self, *args, **kargs):
-        ret = super().update(*args, **kargs)
-        
-        # don't have a simple method for identifying changes yet
-        # just update everything for now.
-        # no keys should be deleted so this should be fine
-        self._db_ctx.fields_changed(self.keys())
+        with self._db_ctx.lock:
+            self._db_ctx.fields_changing()
+            ret = super().update(*args, **kargs)
+            
+            # don't have a simple method for identifying changes yet
+            # just update everything for now.
+            # no keys should be deleted so this should be fine
+            self._db_ctx.fields_changed(self.keys())
         return ret
         
+class db_inventory:
+    """
+    DB interface type for cargo holds: a capacity and a count per item,
+    rather than a slot per unit of cargo. Stored as a single row.
+    
+    Items with a count of zero are dropped.
+    """
+    __slots__ = ("_db_ctx", "__capacity", "__counts", "__used", "__weakref__")
+    
+    class REGISTRY:
+        __INVENTORY_LOOKUP = weakref.WeakValueDictionary()
+        
+        class db_inventory_ctx(db_complex_type_ctx):
+            __slots__ = ()
+            
+            def __init__(self, inv, change_notifier, set_id=None):
+                super().__init__("__inventory__", db_spec={}, fields_cache=inv, change_notifier=change_notifier, set_id=set_id)
+                
+            def snapshot(self):
+                inv = self.fields_cache
+                return ((inv.capacity, dict(inv.items())), set(self.db_dirty_fields))
+                
+            def restore(self, snapshot):
+                (capacity, counts), dirty_fields = snapshot
+                self.fields_cache._db_restore(capacity, counts)
+                self.db_dirty_fields = dirty_fields
+                
+        @classmethod
+        def c_create_db_inventory(cls, cache_control, raw_inventory=None, fixed_id=None, loading=False):
+            if raw_inventory is not None:
+                inv = db_inventory(raw_inventory.capacity, raw_inventory.items())
+            else:
+                inv = db_inventory()
+                
+            db_ctx = cls.db_inventory_ctx(inv, cache_control, set_id=fixed_id)
+            inv._db_ctx = db_ctx
+            # inventories coming out of the database are already synchronized
+            if not loading:
+                db_ctx.fields_changed(["__capacity__"] + list(inv.item_names()))
+            cls.__INVENTORY_LOOKUP[db_ctx.db_id] = inv
+            return inv
+            
+        @classmethod
+        def c_get_db_inventory_by_id(cls, db_id):
+            return cls.__INVENTORY_LOOKUP.get(db_id, None)
+            
+    def __init__(self, capacity=0, counts=()):
+        self._db_ctx = None
+        self.__capacity = capacity
+        self.__counts = {}
+        self.__used = 0
+        for item, n in dict(counts).items():
+            if n > 0:
+                self.__counts[item] = n
+                self.__used += n
+        if self.__used > self.__capacity:
+            raise Exception("Inventory holds {} items but has a capacity of {}".format(self.__used, self.__capacity))
+            
+    @property
+    def capacity(self):
+        return self.__capacity
+        
+    def count(self, item):
+        return self.__counts.get(item, 0)
+        
+    def used(self):
+        return self.__used
+        
+    def free(self):
+        return self.__capacity - self.__used
+        
+    def items(self):
+        return self.__counts.items()
+        
+    def item_names(self):
+        return self.__counts.keys()
+        
+    def add(self, item, n=1):
+        if n < 0: raise Exception("Cannot add {} {}".format(n, item))
+        if n > self.free():
+            raise Exception("Cannot add {} {}. Only {} free".format(n, item, self.free()))
+        self.__change(item, n)
+        
+    def remove(self, item, n=1):
+        if n < 0: raise Exception("Cannot remove {} {}".format(n, item))
+        if n > self.count(item):
+            raise Exception("Cannot remove {} {}. Only {} held".format(n, item, self.count(item)))
+        self.__change(item, -n)
+        
+    def resize(self, capacity):
+        if capacity < self.__used:
+            raise Exception("Cannot resize to {}. {} items held".format(capacity, self.__used))
+        self.__update("__capacity__", self.__resize, capacity)
+        
+    def __resize(self, capacity):
+        self.__capacity = capacity
+        
+    def __change(self, item, n):
+        if n == 0: return
+        self.__update(item, self.__count, item, n)
+        
+    def __count(self, item, n):
+        count = self.__counts.get(item, 0) + n
+        if count:
+            self.__counts[item] = count
+        else:
+            del self.__counts[item]
+        self.__used += n
+        
+    def __update(self, field, change, *args):
+        # change(*args), journaled and marked dirty under the context's lock
+        db_ctx = self._db_ctx
+        if db_ctx is None:
+            change(*args)
+            return
+        with db_ctx.lock:
+            db_ctx.fields_changing()
+            change(*args)
+            db_ctx.fields_changed([field])
+                
+    def _db_restore(self, capacity, counts):
+        # used by the database and rollback. No change notification
+        self.__capacity = capacity
+        self.__counts = dict(counts)
+        self.__used = sum(self.__counts.values())
+        
+    def __contains__(self, item):
+        return item in self.__counts
+        
+    def __eq__(self, other):
+        if not isinstance(other, db_inventory): return NotImplemented
+        return self.__capacity == other.capacity and dict(self.items()) == dict(other.items())
+        
+    def __repr__(self):
+        return "<inventory {}/{} {}>".format(self.__used, self.__capacity, self.__counts)
+        
 class db_unset_obj:
     def __repr__(self):
         return "<UNSET VALUE>"
         
+class db_transaction:
+    """
+    Unit of work. Changes made inside the with block are written out
+    together when the outermost transaction exits. On an exception,
+    every cache touched inside the block is put back the way it was.
+    
+    Transactions nest. An inner rollback only undoes the inner block.
+    """
+    def __init__(self, cache_control):
+        self.cache_control = cache_control
+        
+    def __enter__(self):
+        self.cache_control.begin()
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.cache_control.end()
+        else:
+            self.cache_control.rollback()
+        return False
+        
+class db_writer_thread(threading.Thread):
+    """
+    Background writer for the timer mode. Flushes the cache controller's
+    pending changes every timeout seconds, or sooner when the number of
+    dirty complex types passes the flush threshold.
+    """
+    def __init__(self, cache_control):
+        super().__init__(name="db_writer", daemon=True)
+        self.cache_control = cache_control
+        self.wake = threading.Event()
+        self.running = True
+        
+    def run(self):
+        while self.running:
+            self.wake.wait(self.cache_control.timeout)
+            self.wake.clear()
+            try:
+                self.cache_control.write_to_database()
+            except Exception:
+                # the changes are still pending. Try again next time
+                log.exception("Writing to the database failed")
+            
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        self.join()
+        
 class db_cache_control:
     """
     Interface for a cache on top of the database. Save adds to a pending set.
     On certain conditions (mode-dependant), data is written out
     
-    Note that the timer mode is not guaranteed. It requires some kind of write
-    to occur AFTER the timer has expired.
+    In timer mode a db_writer_thread does the writing. Pending changes are
+    double buffered: the writer swaps the pending map for an empty one,
+    serializes the old one, and commits without holding up the game thread.
+    Serializing takes the lock one context at a time, so a change waits for
+    at most one context to be serialized. flush() blocks until everything
+    pending so far is on disk.
+    
+    A write that fails leaves its changes pending, as if it never happened.
     """
     CACHE_MODE_OFF = "write_immediate"
     CACHE_MODE_MANUAL = "write_on_demand"
@@ -239,37 +766,251 @@ class db_cache_control:
     
     def __init__(self, db_interface, mode=CACHE_MODE_OFF):
         self.db = db_interface
-        self.change_mode(mode)
         self.timeout = 5*60 # 5 minutes
+        self.flush_threshold = 10000
         self.last_save = time.time()
         self.pending = {}
+        self.flushing = {}
+        # open transactions by thread: a stack of journals, and for each
+        # what to call if it rolls back (a dict as an ordered set). Only
+        # changes made by the thread that opened a transaction are part of it
+        self.journals = {}
+        self.rollback_hooks = {}
+        
+        # lock protects pending, and the fields caches and dirty fields of
+        # every context. Everything that changes them holds it.
+        # write_lock keeps a single flush in flight at a time. prepare_lock
+        # is held while one is serialized, so that no transaction starts
+        # halfway through.
+        self.lock = db_complex_type_ctx.lock
+        self.write_lock = threading.RLock()
+        self.prepare_lock = threading.RLock()
+        self.writing = False
+        self.writer = None
+        self.first_pending_time = None
+        self.stats = {"flushes": 0, "objects_flushed": 0, "last_flush_time": 0.0, "last_flush_lag": 0.0, "max_flush_lag": 0.0, "conflicts": 0}
+        # every context keeps save as its change notifier. Binding it once
+        # here means they all share one bound method object
+        self.save = self.save
+        
+        self.mode = None
+        self.change_mode(mode)
         
     def change_mode(self, new_mode):
+        if self.writer is not None and new_mode != self.CACHE_MODE_TIMER:
+            self.writer.stop()
+            self.writer = None
         self.mode = new_mode
         if new_mode == self.CACHE_MODE_ON_EXIT:
             atexit.register(self.write_to_database)
         else:
             atexit.unregister(self.write_to_database)
+        if new_mode == self.CACHE_MODE_TIMER:
+            if self.writer is None:
+                self.writer = db_writer_thread(self)
+                self.writer.start()
+            atexit.register(self.stop)
+        else:
+            atexit.unregister(self.stop)
         
     def change_timeout(self, new_timeout):
-        self.timeout = timeout
+        self.timeout = new_timeout
+        if self.writer is not None:
+            self.writer.wake.set()
+            
+    def change_flush_threshold(self, new_threshold):
+        self.flush_threshold = new_threshold
+        
+    def save(self, ctx, fields=()):
+        with self.lock:
+            ctx.mark_dirty(fields)
+            if ctx.db_id not in self.pending:
+                # ctx, data should be fixed.
+                if not self.pending:
+                    self.first_pending_time = time.time()
+                self.pending[ctx.db_id] = ctx
+            if self.journals: 
+                # written out when the outermost transaction ends
+                return
+        self.write_if_due()
         
-    def save(self, ctx):
-        if ctx.db_id not in self.pending:
-            # ctx, data should be fixed.
-            self.pending[ctx.db_id] = ctx
-        if self.mode == self.CACHE_MODE_OFF or (self.mode == self.CACHE_MODE_TIMER and (time.time() - self.last_save) > self.timeout):
+    def write_if_due(self):
+        if self.mode == self.CACHE_MODE_OFF:
             self.write_to_database()
+            return True
+        if self.mode == self.CACHE_MODE_TIMER and len(self.pending) >= self.flush_threshold:
+            self.writer.wake.set()
+        return False
+        
+    def resolve_conflicts(self, ctxs):
+        """
+        ctxs were not written because another process changed them first.
+        Each one's on_conflict decides whether it is re-read or written
+        again.
+        """
+        with self.lock:
+            self.stats["conflicts"] += len(ctxs)
+            for ctx in ctxs:
+                if ctx.on_conflict() == ctx.CONFLICT_RETRY:
+                    self.db.overwrite(ctx)
+                else:
+                    self.db.refresh(ctx)
+                    
+    def flush(self):
+        """
+        Write everything pending and wait for the commit.
+        """
+        self.write_to_database()
+        
+    def stop(self):
+        if self.writer is not None:
+            self.writer.stop()
+            self.writer = None
+        self.write_to_database()
+        
+    def has_unwritten_changes(self, ctx):
+        """
+        True until every change to ctx is written out. Such contexts
+        must not be dropped and read back from the database.
+        """
+        with self.lock:
+            return bool(ctx.db_dirty_fields) or ctx.db_id in self.pending or ctx.db_id in self.flushing
+        
+    def flush_lag(self):
+        """
+        Age, in seconds, of the oldest change not yet written to the database.
+        """
+        first_pending_time = self.first_pending_time
+        if first_pending_time is None:
+            return 0.0
+        return time.time() - first_pending_time
+        
+    def transaction(self):
+        return db_transaction(self)
+        
+    def begin(self):
+        thread_id = threading.get_ident()
+        with self.prepare_lock, self.lock:
+            self.journals.setdefault(thread_id, []).append({})
+            self.rollback_hooks.setdefault(thread_id, []).append({})
+            db_complex_type_ctx.journal = self.journal_change
+        
+    def journal_change(self, ctx):
+        journals = self.journals.get(threading.get_ident(), None)
+        # another thread's change, not part of any transaction
+        if not journals: return
+        journal = journals[-1]
+        if ctx.db_id not in journal:
+            journal[ctx.db_id] = (ctx, ctx.snapshot())
+            
+    def on_rollback(self, hook):
+        """
+        Call hook() if the calling thread's innermost open transaction
+        rolls back, for state kept outside the fields caches (e.g.,
+        something built from them). Does nothing outside a transaction.
+        """
+        with self.lock:
+            hooks = self.rollback_hooks.get(threading.get_ident(), None)
+            if hooks:
+                hooks[-1][hook] = None
+            
+    def end(self):
+        thread_id = threading.get_ident()
+        with self.lock:
+            journals = self.journals[thread_id]
+            journal = journals.pop()
+            hooks = self.rollback_hooks[thread_id].pop()
+            if journals:
+                # the enclosing transaction can still roll these changes back
+                outer_journal = journals[-1]
+                for db_id, entry in journal.items():
+                    outer_journal.setdefault(db_id, entry)
+                self.rollback_hooks[thread_id][-1].update(hooks)
+                return
+            self.__close_transactions(thread_id)
+        self.write_if_due()
+            
+    def rollback(self):
+        thread_id = threading.get_ident()
+        with self.lock:
+            journals = self.journals[thread_id]
+            journal = journals.pop()
+            for ctx, snapshot in journal.values():
+                ctx.restore(snapshot)
+                # nothing left to write, e.g., objects created in the transaction
+                if not ctx.db_dirty_fields:
+                    self.pending.pop(ctx.db_id, None)
+            if not self.pending:
+                self.first_pending_time = None
+            hooks = self.rollback_hooks[thread_id].pop()
+            if not journals:
+                self.__close_transactions(thread_id)
+            for hook in hooks:
+                hook()
+                
+    def __close_transactions(self, thread_id):
+        # the thread's outermost transaction is over
+        del self.journals[thread_id]
+        del self.rollback_hooks[thread_id]
+        if not self.journals:
+            db_complex_type_ctx.journal = None
             
     def write_to_database(self):
-        print("... writing to disk ...")
-        while self.pending:
-            db_id, ctx = self.pending.popitem()
-            self.db.set(ctx, ctx.fields_cache)
-        self.db.commit()
-        self.last_save = time.time()
-        self.pending = {}
-
+        with self.write_lock:
+            # aggregates created while writing save themselves. Don't recurse
+            if self.writing: return
+            self.writing = True
+            batch = None
+            try:
+                with self.prepare_lock:
+                    with self.lock:
+                        if self.journals: 
+                            # never write half of a transaction
+                            return
+                        if not self.pending:
+                            return
+                        log.debug("... writing to disk ...")
+                        first_pending_time = self.first_pending_time
+                        self.pending, self.flushing = self.flushing, self.pending
+                        self.first_pending_time = None
+                    batch = self.db.prepare_write(self.flushing.values())
+                # the slow part happens without holding up anyone saving changes
+                conflicts = self.db.write_prepared(batch)
+                self.db.commit()
+            except Exception:
+                self.__unwrite(batch, first_pending_time)
+                raise
+            finally:
+                self.writing = False
+            if conflicts:
+                self.resolve_conflicts(conflicts)
+                
+            with self.lock:
+                # anything saved during the write that was also written by it
+                for db_id in [db_id for db_id, ctx in self.pending.items() if not ctx.db_dirty_fields]:
+                    del self.pending[db_id]
+                if not self.pending:
+                    self.first_pending_time = None
+            self.last_save = time.time()
+            lag = self.last_save - first_pending_time
+            self.stats["flushes"] += 1
+            self.stats["objects_flushed"] += len(self.flushing)
+            self.stats["last_flush_time"] = self.last_save
+            self.stats["last_flush_lag"] = lag
+            self.stats["max_flush_lag"] = max(lag, self.stats["max_flush_lag"])
+            self.flushing.clear()
+            
+    def __unwrite(self, batch, first_pending_time):
+        # the database makes what it serialized dirty again (prepare_write
+        # does it itself when it fails), and it all goes back to pending
+        with self.lock:
+            if batch is not None:
+                self.db.abort(batch)
+            for db_id, ctx in self.flushing.items():
+                self.pending.setdefault(db_id, ctx)
+            self.flushing.clear()
+            self.first_pending_time = first_pending_time
+            
 class db_interface:
     UNSET = db_unset_obj()
     
@@ -277,6 +1018,7 @@ class db_interface:
     
     ALLOWED_SCALAR_TYPES = set([int, float, str, bytes, type(None)])
     ALLOWED_AGGREGATE_TYPES = set([list])
+    QUERY_OPS = ("eq", "ne", "lt", "le", "gt", "ge", "in")
     
     @classmethod
     def c_set_ref_mgr(cls, mgr):
@@ -299,6 +1041,8 @@ class db_interface:
             return (v._db_ctx.db_id, "__list__")
         elif isinstance(v, db_dict):
             return (v._db_ctx.db_id, "__dict__")
+        elif isinstance(v, db_inventory):
+            return (v._db_ctx.db_id, "__inventory__")
             
         # make sure any other values are legal scalar types
         elif type(v) not in cls.ALLOWED_SCALAR_TYPES:
@@ -307,6 +1051,17 @@ class db_interface:
         # legal type and unmodified
         return (v, None)
         
+    @classmethod
+    def c_get_aggregate_by_id(cls, db_id):
+        """
+        The list, dictionary or inventory with db_id, if it is in memory.
+        """
+        for lookup in (db_list.REGISTRY.c_get_db_list_by_id, db_dict.REGISTRY.c_get_db_dict_by_id, db_inventory.REGISTRY.c_get_db_inventory_by_id):
+            aggregate = lookup(db_id)
+            if aggregate is not None:
+                return aggregate
+        return None
+        
     @classmethod
     def c_db_deref(cls, v, ref_type):
         if cls.__REF_MGR:
@@ -323,20 +1078,118 @@ class db_interface:
         elif ref_type is not None:
             raise Exception("Could not deference ptr of type {}".format(ref_type))
             
-        return (v, FALSE)
+        return (v, False)
+        
+    def register_class(self, db_type_name, db_spec, indexes=()):
+        """
+        Called for every persistent class, with its field spec and the
+        fields it wants indexed for queries. Databases that lay out storage
+        per class (tables, columns, indexes) do it here.
+        """
+        pass
+        
+    def query(self, db_type_names, conditions):
+        """
+        Ids of the stored objects of any of db_type_names that match every
+        (field, op, value) condition. op is one of QUERY_OPS.
+        """
+        raise Exception("{} does not support queries".format(type(self).__name__))
+        
+    def get_id_allocator(self):
+        """
+        The db_id_allocator new objects, lists and dictionaries take their
+        ids from. Databases that persist should make sure ids are never
+        handed out twice, across processes too.
+        """
+        return db_id_allocator.c_in_memory()
+        
+    def check_field(self, ctx, field, value):
+        """
+        Raise if value can't be stored in field. Called before the field
+        is changed.
+        """
+        pass
         
     def init_object(self, ctx):
         pass
         
+    def forget_object(self, ctx):
+        """
+        Undoes init_object, for an object created in a transaction that
+        rolled back.
+        """
+        pass
+        
     def get(self, ctx):
         pass
         
+    def get_object_class(self, db_id):
+        """
+        Class name of a stored object, or None. Used to fault objects in on demand.
+        """
+        pass
+        
+    def get_many(self, ctxs):
+        """
+        Load several objects at once. Returns a dictionary of db_id to fields.
+        Databases that can stream their contents should override this.
+        """
+        return {ctx.db_id: self.get(ctx) for ctx in ctxs}
+        
     def set(self, ctx, data):
         pass
         
+    def prepare_write(self, ctxs):
+        """
+        Collect the changes of ctxs in memory. The result is handed to
+        write_prepared, possibly from another thread. Databases that do
+        not split the two steps simply write here.
+        """
+        for ctx in ctxs:
+            self.set(ctx, ctx.fields_cache)
+        return None
+        
+    def write_prepared(self, batch):
+        """
+        Returns the contexts that could not be written because of
+        conflicting changes by another process, if the database detects
+        them.
+        """
+        pass
+        
+    def refresh(self, ctx):
+        """
+        Re-read what is stored for ctx into its fields cache, in place.
+        """
+        pass
+        
+    def overwrite(self, ctx):
+        """
+        Make the next flush write all of ctx over whatever is stored.
+        """
+        pass
+        
+    def changed_ids(self):
+        """
+        Ids that other processes changed since the last call, among those
+        loaded here. Empty for databases with a single writer.
+        """
+        return []
+        
     def load_objects(self):
         pass
         
     def get_cache_control(self):
         pass
         
+    def commit(self):
+        pass
+        
+    def abort(self, batch):
+        """
+        Called instead of commit when writing batch failed. Drop whatever
+        write_prepared stored of it, and make the contexts prepare_write
+        synchronized dirty again, so the next flush writes them.
+        """
+        pass
+        
@@ -0,0 +1,444 @@
+"""
+Row model shared by the databases that store objects as rows.
+
+Every field of an object is a row (obj_id, field, ref, value), where ref
+and value are what c_db_ref makes of the field: (None, value) for scalars,
+(id, ref type) for references. Lists and dictionaries are stored like
+objects, with a row per index or key. Those of up to pack_threshold items
+are packed into a single row (see db_codec) instead, so that a change only
+rewrites the items it touched in the large ones. Set pack_threshold to 0
+for a row per item always. Inventories are always packed.
+
+db_row_store turns dirty contexts into a db_row_batch of row changes, and
+rows back into objects and aggregates. Subclasses store the rows.
+"""
+from db_interface import db_interface, db_cache_control, db_list, db_dict, db_inventory
+import db_codec
+
+def field_order(row):
+    """
+    Sort key for the rows of an aggregate. Numbers before strings before
+    bytes, as SQLite orders them.
+    """
+    field = row[0]
+    if isinstance(field, (int, float)):
+        return 0, field
+    return (1 if isinstance(field, str) else 2), field
+
+class db_row_batch:
+    """
+    Pending row changes for one flush, keyed by (obj_id, field) so that
+    the last change to a row wins.
+    """
+    def __init__(self):
+        self.objects = []
+        self.deleted_objects = []
+        self.cleared = []
+        self.upserts = {}
+        self.deletes = set()
+        # every context written, by id
+        self.ctxs = {}
+        # (ctx, dirty fields, db_format) before each was written, in order
+        self.unwritten = []
+
+    def written(self, ctx):
+        # called before ctx is synchronized
+        self.ctxs[ctx.db_id] = ctx
+        self.unwritten.append((ctx, ctx.db_dirty_fields, ctx.db_format))
+
+    def drop(self, db_ids):
+        """
+        Forget every change to db_ids.
+        """
+        self.objects = [(db_id, db_type_name) for db_id, db_type_name in self.objects if db_id not in db_ids]
+        self.cleared = [db_id for db_id in self.cleared if db_id not in db_ids]
+        self.upserts = {key: row for key, row in self.upserts.items() if key[0] not in db_ids}
+        self.deletes = set(key for key in self.deletes if key[0] not in db_ids)
+        for db_id in db_ids:
+            self.ctxs.pop(db_id, None)
+
+    def insert_object(self, db_id, db_type_name):
+        self.objects.append((db_id, db_type_name))
+
+    def delete_object(self, db_id):
+        self.deleted_objects.append(db_id)
+
+    def clear(self, db_id):
+        # drop every row of db_id before the upserts are applied
+        self.cleared.append(db_id)
+
+    def update(self, db_id, field, ref, value):
+        self.deletes.discard((db_id, field))
+        self.upserts[(db_id, field)] = (ref, value)
+
+    def delete(self, db_id, field):
+        self.upserts.pop((db_id, field), None)
+        self.deletes.add((db_id, field))
+
+class db_row_store(db_interface):
+    """
+    Base of the row databases. Subclasses implement write_prepared for a
+    db_row_batch and _stored_rows, and usually get and get_many, which
+    rebuild what they read with _load and _build. The source argument the
+    read helpers pass along is whatever the subclass reads from (a cursor,
+    say); it is only handed back to the hooks.
+    """
+    PACKED = "__packed__"
+    ROWS = "__rows__"
+    # stored by someone else, in whatever format. Cleared and rewritten
+    STALE = "__stale__"
+    AGGREGATE_TYPES = ("__list__", "__dict__", "__inventory__")
+
+    def __init__(self, pack_threshold=256):
+        self.pack_threshold = pack_threshold
+        self.cache_control = db_cache_control(self)
+        self.__new_objects = {}
+
+    def _new_batch(self):
+        return db_row_batch()
+
+    def _stored_rows(self, source, db_id):
+        """
+        The (field, ref, value) rows stored for db_id, ordered by field. A
+        packed aggregate is one row holding the packed bytes.
+        """
+        raise Exception("{} does not read rows".format(type(self).__name__))
+
+    def _delete(self, batch, db_id, field=None):
+        if field == None:
+            batch.delete_object(db_id)
+        else:
+            # We don't delete references yet. Garbage collection at some point
+            batch.delete(db_id, field)
+
+    def _encode(self, batch, value):
+        """
+        Returns the value to keep in the cache (plain lists and dicts are
+        converted), plus the ref and value columns to store for it.
+        """
+        # TODO: This is ugly. Get machinery for creating our complex types.
+        if isinstance(value, list) and not isinstance(value, db_list):
+            value = db_list.REGISTRY.c_create_db_list(self.get_cache_control().save, value)
+        elif isinstance(value, dict) and not isinstance(value, db_dict):
+            value = db_dict.REGISTRY.c_create_db_dict(self.get_cache_control().save, value)
+        elif isinstance(value, db_inventory) and value._db_ctx is None:
+            value = db_inventory.REGISTRY.c_create_db_inventory(self.get_cache_control().save, value)
+
+        (value_ref, ref_type) = self.c_db_ref(value)
+
+        if ref_type is None and type(value) in self.ALLOWED_SCALAR_TYPES:
+            return value, None, value
+        elif ref_type is not None:
+            if isinstance(value, (db_list, db_dict, db_inventory)):
+                self._update_aggregate(batch, value._db_ctx, value)
+            return value, value_ref, ref_type
+        else:
+            raise Exception("Unhandled type {}".format(type(value)))
+
+    def _update(self, batch, db_id, field, value):
+        value, ref, stored_value = self._encode(batch, value)
+        batch.update(db_id, field, ref, stored_value)
+        return value
+
+    def _update_field(self, batch, ctx, field, value):
+        # a field of an object, as opposed to an item of an aggregate
+        return self._update(batch, ctx.db_id, field, value)
+
+    def _pack(self, batch, data):
+        items = []
+        if isinstance(data, db_inventory):
+            # capacity, then item and count pairs. Counts are always ints
+            items.append((None, data.capacity))
+            for item, count in data.items():
+                items.append((None, item))
+                items.append((None, count))
+        elif isinstance(data, list):
+            for i, item in enumerate(data):
+                value, ref, stored_value = self._encode(batch, item)
+                if value is not item: list.__setitem__(data, i, value)
+                items.append((ref, stored_value))
+        else:
+            for key, item in data.items():
+                value, ref, stored_value = self._encode(batch, item)
+                if value is not item: dict.__setitem__(data, key, value)
+                items.append((None, key))
+                items.append((ref, stored_value))
+        return db_codec.pack_items(items)
+
+    def _unpack_inventory(self, inv, items):
+        inv._db_restore(items[0][1], ((items[i][1], items[i+1][1]) for i in range(1, len(items), 2)))
+
+    def _update_aggregate(self, batch, ctx, data):
+        if not ctx.db_dirty_fields: return
+        batch.written(ctx)
+
+        if isinstance(data, db_inventory) or len(data) <= self.pack_threshold:
+            # small aggregates are rewritten whole, as one row
+            if ctx.db_format in (self.ROWS, self.STALE):
+                batch.clear(ctx.db_id)
+            ctx.db_format = self.PACKED
+            batch.update(ctx.db_id, self.PACKED, self.PACKED, self._pack(batch, data))
+            ctx.fields_synchronized()
+            return
+
+        dirty_fields = ctx.db_dirty_fields
+        if ctx.db_format == self.PACKED:
+            # everything needs a row now
+            batch.delete(ctx.db_id, self.PACKED)
+            dirty_fields = None if ctx.db_type_name == "__list__" else list(data.keys())
+        elif ctx.db_format == self.STALE:
+            batch.clear(ctx.db_id)
+            dirty_fields = None if ctx.db_type_name == "__list__" else list(data.keys())
+        ctx.db_format = self.ROWS
+        if ctx.db_type_name == "__list__":
+            # only rows whose value actually changed are written,
+            # however far the change shifted the list
+            if dirty_fields is None:
+                changed, removed = range(len(data)), []
+            else:
+                changed, removed = ctx.changed_indexes()
+            for k in changed:
+                value = self._update(batch, ctx.db_id, k, data[k])
+                if value is not data[k]: list.__setitem__(data, k, value)
+            for k in removed:
+                self._delete(batch, ctx.db_id, k)
+        else:
+            for k in dirty_fields:
+                if k in data:
+                    value = self._update(batch, ctx.db_id, k, data[k])
+                    if value is not data[k]: dict.__setitem__(data, k, value)
+                else:
+                    self._delete(batch, ctx.db_id, k)
+        ctx.fields_synchronized()
+
+    def _is_packed(self, rows):
+        return len(rows) == 1 and rows[0][1] == self.PACKED
+
+    def _unpack(self, source, rows):
+        return db_codec.unpack_items(rows[0][2])
+
+    def _load(self, source, ref, value):
+        if ref is None:
+            return value
+
+        # inline dereferencing of aggregate types like list and dictionary.
+        # Each aggregate is read with a single query.
+        if value == "__list__":
+            l = db_list.REGISTRY.c_get_db_list_by_id(ref)
+            if l is None:
+                l = db_list.REGISTRY.c_create_db_list(self.get_cache_control().save, fixed_id=ref, loading=True)
+                self._read_aggregate(source, l)
+            return l
+
+        if value == "__dict__":
+            d = db_dict.REGISTRY.c_get_db_dict_by_id(ref)
+            if d is None:
+                d = db_dict.REGISTRY.c_create_db_dict(self.get_cache_control().save, fixed_id=ref, loading=True)
+                self._read_aggregate(source, d)
+            return d
+
+        if value == "__inventory__":
+            inv = db_inventory.REGISTRY.c_get_db_inventory_by_id(ref)
+            if inv is None:
+                inv = db_inventory.REGISTRY.c_create_db_inventory(self.get_cache_control().save, fixed_id=ref, loading=True)
+                self._read_aggregate(source, inv)
+            return inv
+
+        # the de-referencer is used for dereferencing external object
+        # it's also used for the UNSET value for... reasons...
+        value, derefed = self.c_db_deref(ref, value)
+        if not derefed:
+            raise Exception("Could not dereference {}, {}".format(ref, value))
+        return value
+
+    def _read_aggregate(self, source, agg):
+        # fills agg in place, replacing whatever it held
+        ctx = agg._db_ctx
+        rows = self._stored_rows(source, ctx.db_id)
+        if isinstance(agg, db_inventory):
+            ctx.db_format = self.PACKED
+            self._unpack_inventory(agg, self._unpack(source, rows))
+        elif isinstance(agg, db_list):
+            if self._is_packed(rows):
+                ctx.db_format = self.PACKED
+                items = [self._load(source, item_ref, item_value) for item_ref, item_value in self._unpack(source, rows)]
+            else:
+                ctx.db_format = self.ROWS
+                items = [None] * (rows[-1][0] + 1 if rows else 0)
+                for index, item_ref, item_value in rows:
+                    items[index] = self._load(source, item_ref, item_value)
+            list.__setitem__(agg, slice(None), items)
+        else:
+            dict.clear(agg)
+            if self._is_packed(rows):
+                ctx.db_format = self.PACKED
+                items = self._unpack(source, rows)
+                for i in range(0, len(items), 2):
+                    dict.__setitem__(agg, items[i][1], self._load(source, *items[i+1]))
+            else:
+                ctx.db_format = self.ROWS
+                for key, item_ref, item_value in rows:
+                    dict.__setitem__(agg, key, self._load(source, item_ref, item_value))
+        ctx.fields_synchronized()
+
+    def _resolve(self, ref, value, aggregates):
+        # same rules as _load, but aggregates were already built by _build
+        if ref is None:
+            return value
+        if value in self.AGGREGATE_TYPES:
+            return aggregates[ref]
+        value, derefed = self.c_db_deref(ref, value)
+        if not derefed:
+            raise Exception("Could not dereference {}, {}".format(ref, value))
+        return value
+
+    def _build(self, rows, ctxs):
+        """
+        Rebuild ctxs and every aggregate they reach from rows, a dictionary
+        of obj_id to (field, ref, value) rows ordered by field, with packed
+        aggregates already unpacked. Returns a dictionary of db_id to fields
+        for ctxs, and the aggregates that were created.
+
+        References are resolved in a second pass, once all aggregates exist,
+        so the cost is linear in the number of rows.
+        """
+        packed = {}
+        aggregate_refs = []
+        for obj_id, obj_rows in rows.items():
+            for field, ref, value in obj_rows:
+                if ref == self.PACKED:
+                    items = packed[obj_id] = value
+                    aggregate_refs.extend((item_ref, item_value) for item_ref, item_value in items if item_value in self.AGGREGATE_TYPES)
+                elif ref is not None and value in self.AGGREGATE_TYPES:
+                    aggregate_refs.append((ref, value))
+
+        # pass one: make sure every aggregate exists. Previously loaded ones are kept as is.
+        aggregates = {}
+        new_aggregates = []
+        cache_control = self.get_cache_control()
+        for ref, agg_type in aggregate_refs:
+            if ref in aggregates: continue
+            if agg_type == "__list__":
+                agg = db_list.REGISTRY.c_get_db_list_by_id(ref)
+                if agg is None:
+                    agg = db_list.REGISTRY.c_create_db_list(cache_control.save, fixed_id=ref, loading=True)
+                    new_aggregates.append(agg)
+            elif agg_type == "__dict__":
+                agg = db_dict.REGISTRY.c_get_db_dict_by_id(ref)
+                if agg is None:
+                    agg = db_dict.REGISTRY.c_create_db_dict(cache_control.save, fixed_id=ref, loading=True)
+                    new_aggregates.append(agg)
+            else:
+                agg = db_inventory.REGISTRY.c_get_db_inventory_by_id(ref)
+                if agg is None:
+                    agg = db_inventory.REGISTRY.c_create_db_inventory(cache_control.save, fixed_id=ref, loading=True)
+                    new_aggregates.append(agg)
+            aggregates[ref] = agg
+
+        # pass two: fill in aggregates and objects, resolving references
+        for agg in new_aggregates:
+            agg_id = agg._db_ctx.db_id
+            if agg_id in packed:
+                agg._db_ctx.db_format = self.PACKED
+                items = packed[agg_id]
+                if isinstance(agg, db_inventory):
+                    self._unpack_inventory(agg, items)
+                elif isinstance(agg, db_list):
+                    list.extend(agg, [self._resolve(ref, value, aggregates) for ref, value in items])
+                else:
+                    dict.update(agg, ((items[i][1], self._resolve(*items[i+1], aggregates)) for i in range(0, len(items), 2)))
+                agg._db_ctx.fields_synchronized()
+                continue
+
+            agg._db_ctx.db_format = self.ROWS
+            agg_rows = rows.get(agg_id, [])
+            if isinstance(agg, db_list):
+                items = [None] * (agg_rows[-1][0] + 1 if agg_rows else 0)
+                for index, ref, value in agg_rows:
+                    items[index] = self._resolve(ref, value, aggregates)
+                list.extend(agg, items)
+            else:
+                dict.update(agg, ((key, self._resolve(ref, value, aggregates)) for key, ref, value in agg_rows))
+            agg._db_ctx.fields_synchronized()
+
+        loaded = {}
+        for ctx in ctxs:
+            obj_rows = {field: (ref, value) for field, ref, value in rows.get(ctx.db_id, [])}
+            data = {}
+            for field in ctx.db_spec:
+                if field not in obj_rows:
+                    # fields added to a class after the object was stored
+                    data[field] = self.UNSET
+                    continue
+                ref, value = obj_rows[field]
+                data[field] = self._resolve(ref, value, aggregates)
+            ctx.fields_synchronized()
+            loaded[ctx.db_id] = data
+        return loaded, new_aggregates
+
+    def get_cache_control(self):
+        return self.cache_control
+
+    def init_object(self, ctx):
+        # written out with the object's first save, through the cache control
+        self.__new_objects[ctx.db_id] = ctx.db_type_name
+        ctx.fields_changed(list(ctx.db_spec))
+
+    def forget_object(self, ctx):
+        self.__new_objects.pop(ctx.db_id, None)
+
+    def set(self, ctx, data):
+        self.write_prepared(self.prepare_write([ctx]))
+
+    def prepare_write(self, ctxs):
+        """
+        Turn the dirty fields of ctxs into row changes, without touching
+        the database. Rows touched more than once are only written once.
+        """
+        batch = self._new_batch()
+        try:
+            for ctx in ctxs:
+                # one context at a time, so that the game thread never
+                # waits for more than one
+                with ctx.lock:
+                    self.__prepare(batch, ctx)
+        except Exception:
+            self.abort(batch)
+            raise
+        return batch
+
+    def __prepare(self, batch, ctx):
+        if ctx.db_id in self.__new_objects:
+            batch.insert_object(ctx.db_id, self.__new_objects.pop(ctx.db_id))
+
+        # update aggregates directly
+        if ctx.db_type_name in self.AGGREGATE_TYPES:
+            self._update_aggregate(batch, ctx, ctx.fields_cache)
+            return
+
+        data = ctx.fields_cache
+        if ctx.db_dirty_fields:
+            batch.written(ctx)
+        for k in ctx.db_dirty_fields:
+            if k not in ctx.db_spec: raise Exception("Data filed {} is not persistent".format(k))
+            data[k] = self._update_field(batch, ctx, k, data[k])
+        ctx.fields_synchronized()
+
+    def abort(self, batch):
+        with self.cache_control.lock:
+            # latest first, so the oldest dirty fields end up in front
+            for ctx, dirty_fields, db_format in reversed(batch.unwritten):
+                ctx.fields_unwritten(dirty_fields, db_format)
+            for db_id, db_type_name in batch.objects:
+                self.__new_objects[db_id] = db_type_name
+
+    def overwrite(self, ctx):
+        # whatever is stored now is what gets replaced
+        if ctx.db_type_name == "__list__":
+            ctx.db_format = self.STALE
+            ctx.fields_changed([(db_list.OP_REWRITE, [])])
+        elif ctx.db_type_name in self.AGGREGATE_TYPES:
+            ctx.db_format = self.STALE
+            ctx.fields_changed([self.STALE])
+        else:
+            ctx.fields_changed(list(ctx.db_spec))
@@ -0,0 +1,119 @@
+"""
+Binary snapshot of everything stored in a database, for fast starts.
+
+A snapshot holds every object's class, the version of everything that has
+one, and the stored rows of every object and aggregate, with packed
+aggregates already unpacked. References stay (id, ref type) pairs, as
+they are stored. It is taken at a commit sequence number (see sqlite3_db),
+so a start reads the newest snapshot and then only what was written after
+that seq.
+
+    magic "TWSS", format version, marshal version, seq (little endian
+    uint32, uint32, uint64), then the marshalled (objects, versions, rows)
+    dicts.
+
+The payload is marshalled rather than db_codec encoded: marshal decodes in
+C, the db_codec reader is Python and no faster than the table scan a
+snapshot replaces. A snapshot written by a Python with another marshal
+version is refused, and the database is read the long way.
+
+Files are named snapshot-<seq>.bin. They are written to a temporary file
+and renamed, so a crash never leaves half a snapshot behind.
+"""
+import gc, marshal, mmap, os, re, struct, sys
+
+MAGIC = b"TWSS"
+FORMAT_VERSION = 1
+# older snapshots are deleted once there are more than this
+KEEP = 2
+
+__HEADER = struct.Struct("<4sIIQ")
+__NAME = re.compile(r"^snapshot-(\d+)\.bin$")
+
+def snapshots(snapshot_dir):
+    """
+    (seq, path) of every snapshot in snapshot_dir, oldest first.
+    """
+    if not os.path.isdir(snapshot_dir):
+        return []
+    found = []
+    for name in os.listdir(snapshot_dir):
+        match = __NAME.match(name)
+        if match:
+            found.append((int(match.group(1)), os.path.join(snapshot_dir, name)))
+    return sorted(found)
+
+def newest(snapshot_dir):
+    found = snapshots(snapshot_dir)
+    return found[-1][1] if found else None
+
+def __interned(ref, value):
+    if ref is not None and type(value) is str:
+        return sys.intern(value)
+    return value
+
+def __interned_row(row):
+    field, ref, value = row
+    if type(field) is str:
+        field = sys.intern(field)
+    if type(value) is list:
+        # an unpacked aggregate
+        return field, ref, [(item_ref, __interned(item_ref, item_value)) for item_ref, item_value in value]
+    return field, ref, __interned(ref, value)
+
+def write(snapshot_dir, seq, objects, versions, rows):
+    """
+    Write a snapshot taken at seq and drop the old ones. Returns its path.
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    # marshal writes an object it has seen before as a back reference, so
+    # interned class names, field names and ref types are written once
+    objects = {db_id: sys.intern(obj_class) for db_id, obj_class in objects.items()}
+    rows = {db_id: [__interned_row(row) for row in obj_rows] for db_id, obj_rows in rows.items()}
+    path = os.path.join(snapshot_dir, "snapshot-{:012d}.bin".format(seq))
+    with open(path + ".tmp", "wb") as f:
+        f.write(__HEADER.pack(MAGIC, FORMAT_VERSION, marshal.version, seq))
+        marshal.dump((objects, versions, rows), f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+    for old_seq, old_path in snapshots(snapshot_dir)[:-KEEP]:
+        os.unlink(old_path)
+    return path
+
+def read(path):
+    """
+    (seq, objects, versions, rows) of the snapshot at path.
+    """
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            magic, format_version, marshal_version, seq = __HEADER.unpack_from(buf)
+            if magic != MAGIC:
+                raise Exception("Not a snapshot: {}".format(path))
+            if format_version != FORMAT_VERSION or marshal_version != marshal.version:
+                raise Exception("Unsupported snapshot format {}/{}: {}".format(format_version, marshal_version, path))
+            view = memoryview(buf)[__HEADER.size:]
+            # a container per row, none of them in a cycle. Collections
+            # in the middle of the load would only walk them over and over
+            gc_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                objects, versions, rows = marshal.loads(view)
+            finally:
+                view.release()
+                if gc_enabled:
+                    gc.enable()
+    return seq, objects, versions, rows
+
+if __name__ == "__main__":
+    # python db_snapshot.py checkpoint|verify db_file snapshot_dir
+    from sqlite3_db import sqlite3_db
+    db = sqlite3_db(sys.argv[2], snapshot_dir=sys.argv[3])
+    if sys.argv[1] == "checkpoint":
+        print("Wrote", db.checkpoint())
+    elif sys.argv[1] == "verify":
+        problems = db.verify_snapshot()
+        for problem in problems:
+            print(problem)
+        print("Snapshot {}".format("differs from the database" if problems else "agrees with the database"))
+        sys.exit(1 if problems else 0)
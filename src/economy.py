@@ -0,0 +1,351 @@
+"""
+Starbase economy catch-up.
+
+A starbase only updates its stock when someone docks. Rather than replay
+every elapsed period, catch_up() draws the total production and consumption
+for all of them at once, so the cost doesn't depend on how long the port
+was left alone.
+"""
+import math, random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CATCH_UP_SAMPLE = "sample"
+CATCH_UP_EXPECTED = "expected"
+
+def binomial(n, p, rng=random):
+    """
+    Number of successes in n trials of probability p.
+    """
+    if n <= 0 or p <= 0: return 0
+    if p >= 1: return n
+    if hasattr(rng, "binomialvariate"):
+        return rng.binomialvariate(n, p)
+    if n <= 32:
+        return sum(1 for i in range(n) if rng.random() < p)
+    # count the rarer outcome, so the work is bounded by n*min(p, 1-p)
+    if p > 0.5:
+        return n - binomial(n, 1 - p, rng)
+    if n * p < 16:
+        # skip straight from one success to the next (geometric waiting times)
+        log_q = math.log(1 - p)
+        successes = 0
+        trial = 0
+        while True:
+            trial += int(math.log(1 - rng.random()) / log_q) + 1
+            if trial > n: return successes
+            successes += 1
+    # normal approximation is good enough once np and n(1-p) are large
+    k = int(rng.gauss(n * p, math.sqrt(n * p * (1 - p))) + 0.5)
+    return min(max(k, 0), n)
+
+def expected(n, p):
+    return int(n * min(max(p, 0), 1) + 0.5)
+
+def hypergeometric(good, bad, n, rng=random):
+    """
+    Number of good ones among n picked without replacement out of good + bad.
+    """
+    n = min(max(n, 0), good + bad)
+    if n == 0 or good == 0: return 0
+    if bad == 0: return n
+    if n <= 32:
+        k = 0
+        for i in range(n):
+            if rng.random() * (good + bad) < good:
+                good -= 1
+                k += 1
+            else:
+                bad -= 1
+        return k
+    # normal approximation, with the finite population correction
+    total = good + bad
+    p = good / total
+    sd = math.sqrt(n * p * (1 - p) * (total - n) / (total - 1))
+    k = int(rng.gauss(n * p, sd) + 0.5)
+    return min(max(k, n - bad, 0), good)
+
+def share(space, wanted, mode=CATCH_UP_SAMPLE, rng=random):
+    """
+    Split space between the counts in wanted, in proportion to them, when
+    they don't all fit. Sampled, it is a multivariate hypergeometric draw:
+    space units picked at random out of all those wanted, as if they had
+    been produced one period at a time until the holds were full. Expected,
+    the units left over by rounding down go to the largest remainders.
+    """
+    total = sum(wanted)
+    if total <= space: return list(wanted)
+    if space <= 0: return [0] * len(wanted)
+    if mode == CATCH_UP_EXPECTED:
+        shares = [space * n // total for n in wanted]
+        order = sorted(range(len(wanted)), key=lambda j: -(space * wanted[j] % total))
+        for j in order[:space - sum(shares)]:
+            shares[j] += 1
+        return shares
+    shares = []
+    for n in wanted:
+        k = hypergeometric(n, total - n, space, rng)
+        shares.append(k)
+        space -= k
+        total -= n
+    return shares
+
+def catch_up(holds, gen_rate, con_rate, periods, mode=CATCH_UP_SAMPLE, rng=random):
+    """
+    Advance holds (a db_inventory) by periods. Each period, every held
+    con_rate item is consumed with its probability, then every gen_rate
+    item is produced with its probability while there is free space. When
+    the holds fill up, the free space is shared between the items in
+    proportion to what each produced (see share).
+
+    Returns (consumed, produced), dicts of item counts.
+    """
+    if mode == CATCH_UP_SAMPLE:
+        draw = lambda p: binomial(periods, p, rng)
+    elif mode == CATCH_UP_EXPECTED:
+        draw = lambda p: expected(periods, p)
+    else:
+        raise Exception("Unknown catch-up mode {}".format(mode))
+
+    consumed = {}
+    produced = {}
+    if periods <= 0: return consumed, produced
+
+    for item, rate in con_rate.items():
+        n = min(holds.count(item), draw(rate))
+        if n:
+            holds.remove(item, n)
+            consumed[item] = n
+    items = list(gen_rate)
+    shares = share(holds.free(), [draw(gen_rate[item]) for item in items], mode, rng)
+    for item, n in zip(items, shares):
+        if n:
+            holds.add(item, n)
+            produced[item] = n
+    return consumed, produced
+
+class economy_engine:
+    """
+    Column mirror of every starbase of an economy, so that the whole
+    universe can be advanced in one batched step per tick.
+    
+    Rows are ports and columns are the economy's commodities. Uses numpy
+    when it is available, plain lists otherwise. The mirror is built once;
+    ports changed outside the engine (docking, trading) are marked with
+    c_port_changed and re-read on the next tick.
+    
+    Ports are brought up to the economy's last_tick. A port that caught up
+    on its own since then counts from its own last_update instead.
+    
+    Engines, the economy and the ports are known by persistent id. The
+    engine holds none of them, so the object cache can still evict them,
+    and they are looked up (faulted in, if need be) when they are written.
+    
+    The vector step itself takes milliseconds for tens of thousands of
+    ports. Writing the changed ports back goes through their persistent
+    fields one port at a time, at several microseconds each, and is what
+    bounds a tick.
+    """
+    __ENGINES = {}
+    
+    @classmethod
+    def c_get_engine(cls, economy, **kargs):
+        economy_id = economy.__get_persistent_id__()
+        engine = cls.__ENGINES.get(economy_id, None)
+        if engine is None:
+            engine = cls.__ENGINES[economy_id] = cls(economy, **kargs)
+        return engine
+        
+    @classmethod
+    def c_port_changed(cls, port):
+        engine = cls.__ENGINES.get(port.economy.__get_persistent_id__(), None)
+        if engine is not None:
+            engine.port_changed(port)
+            
+    def __init__(self, economy, mode=CATCH_UP_SAMPLE, seed=None, use_numpy=True):
+        if mode not in (CATCH_UP_SAMPLE, CATCH_UP_EXPECTED):
+            raise Exception("Unknown catch-up mode {}".format(mode))
+        self.economy_id = economy.__get_persistent_id__()
+        self.mode = mode
+        self.np = numpy if use_numpy else None
+        if self.np is not None:
+            self.rng = self.np.random.default_rng(seed)
+        else:
+            self.rng = random.Random(seed)
+        self.stale = set()
+        self.rebuild()
+        
+    @staticmethod
+    def __lookup(obj_id):
+        # local import, the persistence layer isn't needed to simulate
+        from persistent_object import persistent_object
+        return persistent_object.c_get_object_by_id(obj_id)
+        
+    @property
+    def economy(self):
+        return self.__lookup(self.economy_id)
+        
+    def rebuild(self):
+        economy = self.economy
+        self.items = list(economy.standard_rates.keys())
+        ports = list(economy.get_ports())
+        self.port_ids = [port.__get_persistent_id__() for port in ports]
+        self.rows = {port_id: row for row, port_id in enumerate(self.port_ids)}
+        self.stale.clear()
+        
+        n_items = len(self.items)
+        self.capacity = [0] * len(ports)
+        self.last_update = [0.0] * len(ports)
+        self.stock = [[0] * n_items for port in ports]
+        self.gen = [[0.0] * n_items for port in ports]
+        self.con = [[0.0] * n_items for port in ports]
+        for row, port in enumerate(ports):
+            self.__read_port(row, port)
+        if self.np is not None:
+            np = self.np
+            self.capacity = np.array(self.capacity, dtype=np.int64)
+            self.last_update = np.array(self.last_update, dtype=np.float64)
+            self.stock = np.array(self.stock, dtype=np.int64).reshape(len(ports), n_items)
+            self.gen = np.array(self.gen, dtype=np.float64).reshape(len(ports), n_items)
+            self.con = np.array(self.con, dtype=np.float64).reshape(len(ports), n_items)
+            
+    def __read_port(self, row, port):
+        holds = port.holds
+        gen_rate = port.gen_rate
+        con_rate = port.con_rate
+        self.capacity[row] = holds.capacity
+        self.last_update[row] = port.last_update
+        for j, item in enumerate(self.items):
+            self.stock[row][j] = holds.count(item)
+            self.gen[row][j] = gen_rate.get(item, 0.0)
+            self.con[row][j] = con_rate.get(item, 0.0)
+            
+    def port_changed(self, port):
+        self.stale.add(port.__get_persistent_id__())
+        
+    def __refresh(self):
+        if len(self.economy.get_ports()) != len(self.port_ids):
+            self.rebuild()
+            return
+        for port_id in self.stale:
+            row = self.rows.get(port_id, None)
+            if row is not None:
+                self.__read_port(row, self.__lookup(port_id))
+        self.stale.clear()
+        
+    def tick(self, now):
+        """
+        Advance every port by the whole periods elapsed since the last
+        tick. Only ports whose stock changed are written back, in one
+        transaction. Returns the number of ports written.
+        """
+        self.__refresh()
+        economy = self.economy
+        period = economy.period
+        last_tick = economy.last_tick
+        if not isinstance(last_tick, (int, float)):
+            # nothing ticked yet. Every port counts from its own last_update
+            last_tick = None
+            new_tick = now
+        else:
+            new_tick = last_tick + int((now - last_tick) / period) * period
+            if new_tick <= last_tick: return 0
+            
+        if self.np is not None:
+            changes = self.__step_numpy(last_tick, new_tick, period)
+        else:
+            changes = self.__step_python(last_tick, new_tick, period)
+            
+        from persistent_object import persistent_object
+        lookup = persistent_object.c_get_object_by_id
+        items = self.items
+        try:
+            with persistent_object.transaction():
+                for row, consumed, produced, last_update in changes:
+                    port = lookup(self.port_ids[row])
+                    holds = port.holds
+                    for j, n in enumerate(consumed):
+                        if n: holds.remove(items[j], n)
+                    for j, n in enumerate(produced):
+                        if n: holds.add(items[j], n)
+                    port.last_update = self.last_update[row] = last_update
+                economy.last_tick = new_tick
+        except:
+            # the ports were rolled back, the mirror has to follow
+            self.rebuild()
+            raise
+        return len(changes)
+        
+    def __draw(self, n, p):
+        if self.mode == CATCH_UP_EXPECTED:
+            return self.np.floor(n * p + 0.5).astype(self.np.int64)
+        return self.rng.binomial(n, p)
+        
+    def __share(self, space, wanted):
+        # share() for every row at once
+        np = self.np
+        total = wanted.sum(axis=1)
+        full = total > space
+        if not full.any(): return wanted
+        shares = wanted.copy()
+        space, wanted, total = space[full], wanted[full], total[full]
+        if self.mode == CATCH_UP_EXPECTED:
+            part = space[:, None] * wanted // total[:, None]
+            # the units left over go to the largest remainders, the first
+            # item first on ties
+            order = np.argsort(-(space[:, None] * wanted % total[:, None]), axis=1, kind="stable")
+            rank = np.argsort(order, axis=1, kind="stable")
+            part += rank < (space - part.sum(axis=1))[:, None]
+        else:
+            part = np.zeros_like(wanted)
+            for j in range(wanted.shape[1]):
+                part[:, j] = self.rng.hypergeometric(wanted[:, j], total - wanted[:, j], space)
+                space = space - part[:, j]
+                total = total - wanted[:, j]
+        shares[full] = part
+        return shares
+        
+    # the step functions return (row, consumed, produced, last_update)
+    # for every port whose stock changed. Counts are plain ints
+    
+    def __step_numpy(self, last_tick, new_tick, period):
+        np = self.np
+        start = self.last_update if last_tick is None else np.maximum(self.last_update, last_tick)
+        periods = np.maximum(np.floor((new_tick - start) / period), 0).astype(np.int64)
+        
+        consumed = np.minimum(self.stock, self.__draw(periods[:, None], self.con))
+        self.stock -= consumed
+        produced = self.__share(self.capacity - self.stock.sum(axis=1), self.__draw(periods[:, None], self.gen))
+        self.stock += produced
+            
+        changed = np.flatnonzero((consumed | produced).any(axis=1))
+        last_update = start + periods * period
+        return list(zip(changed.tolist(), consumed[changed].tolist(), produced[changed].tolist(), last_update[changed].tolist()))
+        
+    def __step_python(self, last_tick, new_tick, period):
+        if self.mode == CATCH_UP_EXPECTED:
+            draw = lambda n, p: expected(n, p)
+        else:
+            draw = lambda n, p: binomial(n, p, self.rng)
+        n_items = len(self.items)
+        changes = []
+        for row in range(len(self.port_ids)):
+            row_start = self.last_update[row] if last_tick is None else max(self.last_update[row], last_tick)
+            n = max(int((new_tick - row_start) / period), 0)
+            if n == 0: continue
+            
+            stock = self.stock[row]
+            row_consumed = [0] * n_items
+            for j in range(n_items):
+                row_consumed[j] = min(stock[j], draw(n, self.con[row][j]))
+                stock[j] -= row_consumed[j]
+            free = self.capacity[row] - sum(stock)
+            row_produced = share(free, [draw(n, self.gen[row][j]) for j in range(n_items)], self.mode, self.rng)
+            for j in range(n_items):
+                stock[j] += row_produced[j]
+            if any(row_consumed) or any(row_produced):
+                changes.append((row, row_consumed, row_produced, row_start + n * period))
+        return changes
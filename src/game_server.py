@@ -0,0 +1,204 @@
+"""
+Multi-player front end. A line oriented (telnet style) TCP server that runs
+the play commands of map_prototype for many sessions at once.
+
+    python game_server.py [port] [db_file]
+
+Sessions are served on the asyncio event loop. Database I/O stays off it:
+
+- everything that can fault in an object or change one runs on a single
+  reader thread, one command at a time, so commands from different
+  sessions never interleave. A jump checks its lane and loads the sector
+  it arrives in (its lanes and starbase), plotting a course reads every
+  sector's lanes, and docking, buying and selling change the starbase
+  there. A trade is a transaction, which can wait for the writer to finish
+  serializing a flush; it waits on the reader, not on the loop. The loop
+  itself only describes the session's current sector, loaded when the
+  session got there.
+- writes are left to the cache control's db_writer_thread (timer mode).
+  Serializing and committing happen on the writer. The database is opened
+  in WAL mode and the reader reads on a connection of its own, so a slow
+  commit holds up neither the loop nor the reader.
+
+See load_client.py for a load generator.
+"""
+import asyncio, sys, time
+from concurrent.futures import ThreadPoolExecutor
+
+from persistent_object import persistent_object
+from sqlite3_db import sqlite3_db
+from db_interface import db_cache_control
+# defines the map classes the database refers to
+import map_prototype
+
+class c_game_session:
+    """
+    One connected player. Keeps its own current sector, so sessions move
+    around the map independently.
+    """
+    def __init__(self, server, sector_number):
+        self.server = server
+        self.map = server.map
+        self.sector_number = sector_number
+
+    def describe(self):
+        sector = self.map.sectors[self.sector_number]
+        text  = "Sector [{}] (Unexplored)\n".format(self.sector_number)
+        if sector.starbase:
+            text += "Starbase\n"
+        text += "Jump Lanes: {}\n".format([str(s) for s in self.map.get_exits(self.sector_number)])
+        return text
+
+    async def execute(self, line):
+        """
+        Run one command line. Returns (reply, done), done once the player
+        quits.
+        """
+        cmd = line.strip().lower().split()
+        if not cmd:
+            return "", False
+        if cmd[0] in ["quit", "exit"]:
+            return "EXIT\n", True
+        elif cmd[0] in ["hyper", "jump", "sector"]:
+            if len(cmd) < 2:
+                return "", False
+            try:
+                goto_sector = int(cmd[1])
+            except ValueError:
+                return "Sector must be a number.\n", False
+            if not await self.server.read(self.server.load_sector, goto_sector, self.sector_number):
+                return "Cannot go to sector {}\n".format(goto_sector), False
+            self.sector_number = goto_sector
+            return "Jumping to sector {}\n".format(goto_sector), False
+        elif cmd[0] in ["plot", "course"]:
+            try:
+                target = int(cmd[1])
+            except (IndexError, ValueError):
+                return "Sector must be a number.\n", False
+            # the first course plotted reads every sector's lanes
+            course = await self.server.read(self.map.plot_course, target, self.sector_number)
+            if course is None:
+                return "No course to sector {}\n".format(target), False
+            return "Course to sector {} ({} jumps): {}\n".format(target, len(course)-1, " > ".join(str(s) for s in course)), False
+        elif cmd[0] in ["exits", "jumps", "lanes"]:
+            lanes = [str(s) for s in sorted(self.map.get_exits(self.sector_number))]
+            return "Jump-lane exits from this sector are: {}\n".format(", ".join(lanes)), False
+        elif cmd[0] in ["dock", "buy", "sell"]:
+            return await self.server.read(self.trade, cmd), False
+        return "Unknown command {}\n".format(cmd[0]), False
+
+    def trade(self, cmd):
+        # on the reader thread
+        starbase = self.map.sectors[self.sector_number].starbase
+        if not starbase:
+            return "There is no starbase here!\n"
+        if cmd[0] == "dock":
+            return self.dock(starbase)
+        try:
+            item, count = cmd[1], int(cmd[2])
+        except (IndexError, ValueError):
+            return "Usage: {} <item> <count>\n".format(cmd[0])
+        try:
+            if cmd[0] == "buy":
+                return "You purchased {} {} for {} credits\n".format(count, item, starbase.buy(item, count))
+            return "You sold {} {} for {} credits\n".format(count, item, starbase.sell(item, count))
+        except Exception as e:
+            return "{}\n".format(e)
+
+    def dock(self, starbase):
+        starbase.catch_up(time.time())
+        sell_prices, buy_prices = starbase.get_prices()
+        text = "===> docking <===\n{}\n".format(starbase.holds)
+        if sell_prices:
+            text += "\tItems for sale:\n"
+            for sell_item in sell_prices:
+                text += "\t\t{}\t\t{}\n".format(sell_item, sell_prices[sell_item])
+        if buy_prices:
+            text += "\tItems to buy (max {}):\n".format(starbase.holds.free())
+            for buy_item in buy_prices:
+                text += "\t\t{}\t\t{}\n".format(buy_item, buy_prices[buy_item])
+        text += "buy <item> <count>, sell <item> <count>\n"
+        return text
+
+class c_game_server:
+    PROMPT = ">> "
+
+    def __init__(self, map):
+        self.map = map
+        self.reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db_reader")
+        self.sessions = 0
+
+    async def read(self, fn, *args):
+        """
+        Run fn(*args) on the reader thread. Everything that touches the
+        database goes through here.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.reader, fn, *args)
+
+    def load_sector(self, sector_number, from_sector=None):
+        """
+        On the reader thread. Touches everything describe and the commands
+        use, so they find it loaded. With from_sector, only if there is a
+        lane from it to sector_number. Returns whether the sector was loaded.
+        """
+        # has_lane faults in the sector on a map that keeps lanes on them
+        if from_sector is not None and not self.map.has_lane(from_sector, sector_number):
+            return False
+        sector = self.map.sectors[sector_number]
+        self.map.get_exits(sector_number)
+        starbase = sector.starbase
+        if starbase:
+            starbase.holds.free()
+            starbase.economy.period
+        return True
+
+    async def handle(self, reader, writer):
+        session = c_game_session(self, self.map.current_sector)
+        self.sessions += 1
+        try:
+            await self.read(self.load_sector, session.sector_number)
+            writer.write((session.describe() + self.PROMPT).encode())
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                reply, done = await session.execute(line.decode(errors="replace"))
+                if done:
+                    writer.write(reply.encode())
+                    break
+                writer.write((reply + session.describe() + self.PROMPT).encode())
+                await writer.drain()
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.sessions -= 1
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=2002):
+        server = await asyncio.start_server(self.handle, host, port, backlog=1024)
+        print("Listening on {}:{}".format(host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.reader.shutdown()
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 2002
+    db_file = sys.argv[2] if len(sys.argv) > 2 else "test_map.db"
+    persistent_object.c_set_db_interface(sqlite3_db(db_file, wal=True))
+    cache_control = persistent_object.c_db().get_cache_control()
+    cache_control.change_timeout(5)
+    cache_control.change_mode(db_cache_control.CACHE_MODE_TIMER)
+    persistent_object.c_set_load_mode(persistent_object.LOAD_MODE_LAZY)
+    persistent_object.c_reload_objects()
+    server = c_game_server(persistent_object.c_get_object_by_id(0))
+    # every session starts here
+    server.load_sector(server.map.current_sector)
+    try:
+        asyncio.run(server.serve(port=port))
+    except KeyboardInterrupt:
+        pass
+    # the writer flushes what is left on exit
+    print("EXIT")
@@ -0,0 +1,113 @@
+"""
+Compressed sparse row (CSR) store for the jump lane graph.
+
+The exits of sector i are neighbors[offsets[i]:offsets[i+1]]. Both arrays
+hold unsigned 32 bit sector numbers in native byte order, so a million
+sector map with a few million lanes is a few tens of megabytes.
+
+The arrays are persisted as a single bytes value. A graph loaded from bytes
+is a memoryview over the loaded value and is not copied. Lane changes go to a
+small overlay (added lanes, removed lanes) until compact() folds them back
+into the arrays.
+"""
+import array, struct
+
+class lane_graph:
+    MAGIC = b"CSR1"
+    __HEADER = struct.Struct("<4sII")
+
+    def __init__(self, offsets, neighbors):
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.added = {}
+        self.removed = set()
+
+    @classmethod
+    def c_from_lanes(cls, lanes):
+        """
+        lanes is a list indexed by sector number, of lists of sector numbers.
+        """
+        offsets = array.array("I", [0])
+        neighbors = array.array("I")
+        for exits in lanes:
+            neighbors.extend(exits)
+            offsets.append(len(neighbors))
+        return cls(offsets, neighbors)
+
+    @classmethod
+    def c_from_bytes(cls, blob):
+        magic, sectors, lanes = cls.__HEADER.unpack_from(blob)
+        if magic != cls.MAGIC:
+            raise Exception("Not a lane graph: {}".format(magic))
+        view = memoryview(blob)
+        start = cls.__HEADER.size
+        offsets_end = start + 4 * (sectors + 1)
+        offsets = view[start:offsets_end].cast("I")
+        neighbors = view[offsets_end:offsets_end + 4 * lanes].cast("I")
+        return cls(offsets, neighbors)
+
+    def to_bytes(self):
+        self.compact()
+        offsets = array.array("I", self.offsets)
+        neighbors = array.array("I", self.neighbors)
+        return self.__HEADER.pack(self.MAGIC, len(offsets) - 1, len(neighbors)) + offsets.tobytes() + neighbors.tobytes()
+
+    def sector_count(self):
+        return len(self.offsets) - 1
+
+    def lane_count(self):
+        return len(self.neighbors) - len(self.removed) + sum(len(exits) for exits in self.added.values())
+
+    def edit_count(self):
+        return len(self.removed) + sum(len(exits) for exits in self.added.values())
+
+    def __stored_exits(self, a):
+        if a < 0 or a >= len(self.offsets) - 1:
+            return []
+        return self.neighbors[self.offsets[a]:self.offsets[a+1]].tolist()
+
+    def exits(self, a):
+        exits = self.__stored_exits(a)
+        if self.removed:
+            exits = [b for b in exits if (a, b) not in self.removed]
+        exits.extend(self.added.get(a, ()))
+        return exits
+
+    def degree(self, a):
+        return len(self.exits(a))
+
+    def has_lane(self, a, b):
+        if (a, b) in self.removed: return False
+        return b in self.added.get(a, ()) or b in self.__stored_exits(a)
+
+    def add_lane(self, a, b):
+        """
+        Returns False if the lane already exists.
+        """
+        if self.has_lane(a, b): return False
+        if (a, b) in self.removed:
+            self.removed.discard((a, b))
+        else:
+            self.added.setdefault(a, []).append(b)
+        return True
+
+    def remove_lane(self, a, b):
+        """
+        Returns False if there is no such lane.
+        """
+        if not self.has_lane(a, b): return False
+        added = self.added.get(a, [])
+        if b in added:
+            added.remove(b)
+        else:
+            self.removed.add((a, b))
+        return True
+
+    def compact(self):
+        if not self.added and not self.removed: return
+        sectors = max([len(self.offsets) - 2] + list(self.added.keys()))
+        rebuilt = self.c_from_lanes([self.exits(a) for a in range(sectors + 1)])
+        self.offsets = rebuilt.offsets
+        self.neighbors = rebuilt.neighbors
+        self.added = {}
+        self.removed = set()
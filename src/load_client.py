@@ -0,0 +1,74 @@
+"""
+Load generator for game_server.
+
+    python load_client.py [sessions] [commands] [port] [host]
+
+Opens sessions connections at once. Each one sends commands commands,
+waiting for the reply (up to the next prompt) before sending the next: it
+wanders the map, plots courses back to sectors it has seen, and docks and
+trades at the starbases it finds. Reports commands per second over all
+sessions and the latency percentiles of single commands.
+"""
+import asyncio, random, re, sys, time
+
+PROMPT = b">> "
+EXITS = re.compile(r"Jump Lanes: \[(.*)\]")
+ITEMS = ["ore", "fuel", "organics"]
+
+async def command(reader, writer, line):
+    writer.write(line.encode() + b"\n")
+    reply = await reader.readuntil(PROMPT)
+    return reply.decode()
+
+def next_command(reply, seen):
+    exits = [int(s.strip(" '")) for s in EXITS.search(reply).group(1).split(",") if s.strip()]
+    seen.extend(exits)
+    roll = random.random()
+    if "Starbase\n" in reply and roll < 0.3:
+        if roll < 0.1:
+            return "dock"
+        return "{} {} {}".format(random.choice(["buy", "sell"]), random.choice(ITEMS), random.randint(1, 5))
+    if roll < 0.4:
+        return "plot {}".format(random.choice(seen))
+    if roll < 0.5:
+        return "exits"
+    return "jump {}".format(random.choice(exits))
+
+async def connect(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    reply = (await reader.readuntil(PROMPT)).decode()
+    return reader, writer, reply
+
+async def session(reader, writer, reply, commands, latencies):
+    seen = []
+    for i in range(commands):
+        line = next_command(reply, seen)
+        sent = time.perf_counter()
+        reply = await command(reader, writer, line)
+        latencies.append(time.perf_counter() - sent)
+    writer.write(b"quit\n")
+    await writer.drain()
+    writer.close()
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+async def run(sessions, commands, host, port):
+    # every session connects before the clock starts
+    connections = await asyncio.gather(*(connect(host, port) for i in range(sessions)))
+    latencies = []
+    began = time.perf_counter()
+    await asyncio.gather(*(session(reader, writer, reply, commands, latencies) for reader, writer, reply in connections))
+    elapsed = time.perf_counter() - began
+    latencies.sort()
+    print("{} sessions, {} commands in {:.2f}s".format(sessions, len(latencies), elapsed))
+    print("{:.0f} commands/s".format(len(latencies) / elapsed))
+    print("latency ms: p50 {:.2f}  p90 {:.2f}  p99 {:.2f}  max {:.2f}".format(
+        *(1000 * percentile(latencies, p) for p in (0.5, 0.9, 0.99, 1.0))))
+
+if __name__ == "__main__":
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    commands = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else 2002
+    host = sys.argv[4] if len(sys.argv) > 4 else "127.0.0.1"
+    asyncio.run(run(sessions, commands, host, port))
@@ -0,0 +1,465 @@
+"""
+Append-only, log structured database.
+
+The rows of the row model (see db_rows) are never updated in place. Every
+flush appends one frame of records to the log, a directory of segment files
+segment-<n>.log, and commit fsyncs it: writes are sequential and a commit
+costs one fsync however many flushes it covers. Once a segment passes
+segment_size a new one is started.
+
+    frame   varint length, crc32 of the payload (little endian uint32),
+            payload: records back to back
+    record  tag, zig-zag varint obj_id, then per tag (db_codec items)
+        O   class name                  object created
+        X   -                           object and all its rows deleted
+        C   -                           all rows of obj_id deleted
+        U   field, (ref, value)         row written
+        P   packed bytes                the packed row of an aggregate
+        D   field                       row deleted
+        I   -                           ids below obj_id are leased
+
+An in-memory index maps every live row to the record holding it, so a
+read is a pread of that record, and a bulk load reads each segment front
+to back once. The index is rebuilt from the log on open. A torn frame at
+the end of the log (a crash in the middle of an append) is cut off.
+
+Rewritten and deleted rows leave garbage behind. A log_compactor_thread
+copies what is still live out of the oldest segments into the active one
+and deletes them, whenever the garbage in sealed segments passes
+garbage_ratio of the log. The oldest segment goes first, so nothing older
+is left that its tombstones (X, C, D) could still be hiding: they are
+simply dropped.
+
+A log belongs to a single process. Opening it twice is refused.
+"""
+import fcntl, os, re, struct, threading, zlib
+
+from db_interface import db_id_allocator
+from db_rows import db_row_store, field_order
+import db_codec
+
+class log_compactor_thread(threading.Thread):
+    """
+    Compacts the log every interval seconds, or sooner when a commit finds
+    it needs it.
+    """
+    def __init__(self, db, interval):
+        super().__init__(name="log_compactor", daemon=True)
+        self.db = db
+        self.interval = interval
+        self.wake = threading.Event()
+        self.running = True
+
+    def run(self):
+        while self.running:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            if self.running:
+                self.db.compact()
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        self.join()
+
+class log_db(db_row_store):
+    OBJECT = ord("O")
+    DELETE_OBJECT = ord("X")
+    CLEAR = ord("C")
+    UPSERT = ord("U")
+    PACKED_UPSERT = ord("P")
+    DELETE = ord("D")
+    LEASE = ord("I")
+    # records less than this far apart are read together
+    READ_GAP = 4096
+
+    __CRC = struct.Struct("<I")
+    __NAME = re.compile(r"^segment-(\d+)\.log$")
+
+    def __init__(self, log_dir, pack_threshold=256, segment_size=64*1024*1024, id_block_size=1024, garbage_ratio=0.5, compact_interval=60):
+        super().__init__(pack_threshold)
+        self.log_dir = log_dir
+        self.segment_size = segment_size
+        self.id_block_size = id_block_size
+        self.garbage_ratio = garbage_ratio
+        os.makedirs(log_dir, exist_ok=True)
+        self.__lock_file = open(os.path.join(log_dir, "LOCK"), "w")
+        try:
+            fcntl.flock(self.__lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            raise Exception("{} is open in another process".format(log_dir))
+        # index and segments are shared by the game, writer, reader and
+        # compactor threads
+        self.__lock = threading.RLock()
+        # obj_id: (obj_class, segment, start, end) of its O record
+        self.__objects = {}
+        # obj_id: {field: (segment, start, end)} of the record of each live row
+        self.__rows = {}
+        # segment: [size, garbage bytes]
+        self.__segments = {}
+        self.__fds = {}
+        self.__next_id = 0
+        self.__lease_at = None
+        self.__recover()
+        self.__compactor = None
+        if compact_interval is not None:
+            self.__compactor = log_compactor_thread(self, compact_interval)
+            self.__compactor.start()
+
+    def __path(self, segment):
+        return os.path.join(self.log_dir, "segment-{:06d}.log".format(segment))
+
+    def __recover(self):
+        segments = sorted(int(match.group(1)) for match in map(self.__NAME.match, os.listdir(self.log_dir)) if match)
+        for segment in segments:
+            with open(self.__path(segment), "rb") as f:
+                buf = f.read()
+            self.__segments[segment] = [0, 0]
+            end = 0
+            for start, payload_end in self.__frames(buf):
+                self.__index(segment, buf, start, payload_end)
+                end = payload_end
+            self.__segments[segment][0] = end
+            if end < len(buf):
+                if segment != segments[-1]:
+                    raise Exception("Corrupt frame at {} of {}".format(end, self.__path(segment)))
+                print("Cutting off a torn frame at {} of {}".format(end, self.__path(segment)))
+                os.truncate(self.__path(segment), end)
+        if not segments:
+            segments = [0]
+            self.__segments[0] = [0, 0]
+        self.__active = segments[-1]
+        self.__fds[self.__active] = os.open(self.__path(self.__active), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def __frames(self, buf):
+        """
+        Yields where the payload of each intact frame of buf starts and ends.
+        """
+        pos = 0
+        while pos < len(buf):
+            try:
+                length, start = db_codec.read_varint(buf, pos)
+            except IndexError:
+                return
+            end = start + self.__CRC.size + length
+            if end > len(buf) or zlib.crc32(buf[start+self.__CRC.size:end]) != self.__CRC.unpack_from(buf, start)[0]:
+                return
+            yield start + self.__CRC.size, end
+            pos = end
+
+    def __decode(self, buf, pos):
+        """
+        (tag, obj_id, field, ref, value, end) of the record at pos. field,
+        ref and value are whatever the tag has.
+        """
+        tag = buf[pos]
+        obj_id, pos = db_codec.read_int(buf, pos + 1)
+        field = ref = value = None
+        if tag == self.UPSERT:
+            (_, field), pos = db_codec.read_item(buf, pos)
+            (ref, value), pos = db_codec.read_item(buf, pos)
+        elif tag == self.PACKED_UPSERT:
+            field = ref = self.PACKED
+            (_, value), pos = db_codec.read_item(buf, pos)
+        elif tag == self.DELETE:
+            (_, field), pos = db_codec.read_item(buf, pos)
+        elif tag == self.OBJECT:
+            (_, value), pos = db_codec.read_item(buf, pos)
+        elif tag not in (self.DELETE_OBJECT, self.CLEAR, self.LEASE):
+            raise Exception("Unknown record {} at {}".format(chr(tag), pos - 1))
+        return tag, obj_id, field, ref, value, pos
+
+    def __encode_record(self, out, tag, obj_id, field=None, ref=None, value=None):
+        out.append(tag)
+        db_codec.write_int(out, obj_id)
+        if tag == self.UPSERT:
+            db_codec.write_item(out, None, field)
+            db_codec.write_item(out, ref, value)
+        elif tag == self.PACKED_UPSERT or tag == self.OBJECT:
+            db_codec.write_item(out, None, value)
+        elif tag == self.DELETE:
+            db_codec.write_item(out, None, field)
+
+    def __garbage(self, entry):
+        # entry: (segment, start, end), the last fields of an index entry
+        segment, start, end = entry[-3:]
+        if segment in self.__segments:
+            self.__segments[segment][1] += end - start
+
+    def __drop_rows(self, obj_id):
+        for entry in self.__rows.pop(obj_id, {}).values():
+            self.__garbage(entry)
+
+    def __index(self, segment, buf, pos, end, offset=0):
+        """
+        Apply the records of buf[pos:end] to the index. They are at offset
+        further into segment than into buf.
+        """
+        while pos < end:
+            tag, obj_id, field, ref, value, record_end = self.__decode(buf, pos)
+            entry = (segment, offset + pos, offset + record_end)
+            if tag == self.UPSERT or tag == self.PACKED_UPSERT:
+                rows = self.__rows.setdefault(obj_id, {})
+                if field in rows:
+                    self.__garbage(rows[field])
+                rows[field] = entry
+            elif tag == self.OBJECT:
+                if obj_id in self.__objects:
+                    self.__garbage(self.__objects[obj_id])
+                self.__objects[obj_id] = (value,) + entry
+            elif tag == self.LEASE:
+                if self.__lease_at is not None:
+                    self.__garbage(self.__lease_at)
+                self.__lease_at = entry
+                self.__next_id = max(self.__next_id, obj_id)
+            else:
+                # tombstones are only needed until the segments before them are gone
+                self.__garbage(entry)
+                if tag == self.DELETE:
+                    rows = self.__rows.get(obj_id, {})
+                    if field in rows:
+                        self.__garbage(rows.pop(field))
+                else:
+                    self.__drop_rows(obj_id)
+                    if tag == self.DELETE_OBJECT and obj_id in self.__objects:
+                        self.__garbage(self.__objects.pop(obj_id))
+            pos = record_end
+
+    def __append(self, payload):
+        """
+        Append payload as one frame to the active segment and index it.
+        Holds the lock.
+        """
+        frame = bytearray()
+        db_codec.write_varint(frame, len(payload))
+        frame += self.__CRC.pack(zlib.crc32(payload))
+        start = self.__segments[self.__active][0] + len(frame)
+        frame += payload
+        written = 0
+        while written < len(frame):
+            written += os.write(self.__fds[self.__active], frame[written:])
+        self.__segments[self.__active][0] += len(frame)
+        self.__index(self.__active, payload, 0, len(payload), start)
+        if self.__segments[self.__active][0] >= self.segment_size:
+            self.__roll()
+
+    def __roll(self):
+        # the sealed segment is complete on disk before anything goes to the next
+        os.fsync(self.__fds[self.__active])
+        self.__active += 1
+        self.__segments[self.__active] = [0, 0]
+        self.__fds[self.__active] = os.open(self.__path(self.__active), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.__sync_dir()
+
+    def __sync_dir(self):
+        fd = os.open(self.log_dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def __fd(self, segment):
+        fd = self.__fds.get(segment, None)
+        if fd is None:
+            fd = self.__fds[segment] = os.open(self.__path(segment), os.O_RDONLY)
+        return fd
+
+    def __read(self, obj_id):
+        """
+        The (field, ref, value) rows of obj_id. Holds the lock.
+        """
+        by_segment = {}
+        for entry in self.__rows.get(obj_id, {}).values():
+            by_segment.setdefault(entry[0], []).append(entry)
+        rows = []
+        for segment, entries in by_segment.items():
+            # the rows of an object are usually written together. Records
+            # close to each other are read with one pread
+            entries.sort()
+            first = 0
+            while first < len(entries):
+                last = first
+                while last + 1 < len(entries) and entries[last+1][1] - entries[last][2] < self.READ_GAP:
+                    last += 1
+                offset = entries[first][1]
+                buf = os.pread(self.__fd(segment), entries[last][2] - offset, offset)
+                for s, start, end in entries[first:last+1]:
+                    tag, obj_id, field, ref, value, end = self.__decode(buf, start - offset)
+                    rows.append((field, ref, value))
+                first = last + 1
+        return rows
+
+    def get_id_allocator(self):
+        return db_id_allocator(self.__lease_ids, self.id_block_size)
+
+    def __lease_ids(self, count):
+        # written out with the next commit, which is before any of the ids is
+        # stored
+        with self.__lock:
+            first_id = self.__next_id
+            out = bytearray()
+            self.__encode_record(out, self.LEASE, first_id + count)
+            self.__append(bytes(out))
+            return first_id
+
+    def get_object_class(self, db_id):
+        with self.__lock:
+            entry = self.__objects.get(db_id, None)
+            return entry and entry[0]
+
+    def all_objects(self):
+        with self.__lock:
+            return [(obj_id, entry[0]) for obj_id, entry in self.__objects.items()]
+
+    def _stored_rows(self, source, db_id):
+        with self.__lock:
+            return sorted(self.__read(db_id), key=field_order)
+
+    def get(self, ctx):
+        with self.__lock:
+            obj_rows = {field: (ref, value) for field, ref, value in self.__read(ctx.db_id)}
+        data = {}
+        for field in ctx.db_spec:
+            if field not in obj_rows:
+                data[field] = self.UNSET
+                continue
+            data[field] = self._load(None, *obj_rows[field])
+        ctx.fields_synchronized()
+        return data
+
+    def get_many(self, ctxs):
+        """
+        Bulk load. Every segment is read front to back once, and only the
+        records the index still points at are decoded.
+        """
+        with self.__lock:
+            by_segment = {}
+            for obj_id, obj_rows in self.__rows.items():
+                for entry in obj_rows.values():
+                    by_segment.setdefault(entry[0], []).append((entry[1], obj_id))
+            rows = {}
+            for segment in sorted(by_segment):
+                with open(self.__path(segment), "rb") as f:
+                    buf = f.read()
+                for start, obj_id in sorted(by_segment[segment]):
+                    tag, obj_id, field, ref, value, end = self.__decode(buf, start)
+                    if tag == self.PACKED_UPSERT:
+                        value = db_codec.unpack_items(value)
+                    rows.setdefault(obj_id, []).append((field, ref, value))
+        for obj_rows in rows.values():
+            obj_rows.sort(key=field_order)
+        loaded, new_aggregates = self._build(rows, ctxs)
+        return loaded
+
+    def write_prepared(self, batch):
+        out = bytearray()
+        for db_id, db_type_name in batch.objects:
+            self.__encode_record(out, self.OBJECT, db_id, value=db_type_name)
+        for db_id in batch.deleted_objects:
+            self.__encode_record(out, self.DELETE_OBJECT, db_id)
+        for db_id in batch.cleared:
+            self.__encode_record(out, self.CLEAR, db_id)
+        for db_id, field in batch.deletes:
+            self.__encode_record(out, self.DELETE, db_id, field)
+        for (db_id, field), (ref, value) in batch.upserts.items():
+            if ref == self.PACKED:
+                self.__encode_record(out, self.PACKED_UPSERT, db_id, value=value)
+            else:
+                self.__encode_record(out, self.UPSERT, db_id, field, ref, value)
+        if out:
+            with self.__lock:
+                self.__append(bytes(out))
+        return []
+
+    def commit(self):
+        # everything appended since the last commit goes to disk at once
+        with self.__lock:
+            os.fsync(self.__fds[self.__active])
+            needs_compaction = self.__needs_compaction()
+        if needs_compaction and self.__compactor is not None:
+            self.__compactor.wake.set()
+
+    def refresh(self, ctx):
+        if ctx.db_type_name in self.AGGREGATE_TYPES:
+            self._read_aggregate(None, ctx.fields_cache)
+        else:
+            ctx.fields_cache._update(self.get(ctx))
+
+    def __needs_compaction(self):
+        total = sum(size for size, garbage in self.__segments.values())
+        sealed_garbage = sum(garbage for segment, (size, garbage) in self.__segments.items() if segment != self.__active)
+        return sealed_garbage > self.garbage_ratio * total
+
+    def compact(self):
+        """
+        Copy what is still live out of the oldest segments into the active
+        one and delete them, until the garbage in sealed segments is below
+        garbage_ratio of the log. Returns how many segments were deleted.
+        """
+        with self.__lock:
+            sealed = sorted(segment for segment in self.__segments if segment != self.__active)
+        compacted = 0
+        for segment in sealed:
+            with self.__lock:
+                if not self.__needs_compaction():
+                    break
+            self.__compact_segment(segment)
+            compacted += 1
+        return compacted
+
+    def __compact_segment(self, segment):
+        # sealed segments never change, so reading one needs no lock
+        with open(self.__path(segment), "rb") as f:
+            buf = f.read()
+        records = []
+        for start, end in self.__frames(buf):
+            pos = start
+            while pos < end:
+                tag, obj_id, field, ref, value, record_end = self.__decode(buf, pos)
+                if tag in (self.UPSERT, self.PACKED_UPSERT, self.OBJECT):
+                    records.append((tag, obj_id, field, pos, record_end))
+                pos = record_end
+        with self.__lock:
+            out = bytearray()
+            for tag, obj_id, field, start, end in records:
+                if tag == self.OBJECT:
+                    live = self.__objects.get(obj_id, ())[1:] == (segment, start, end)
+                else:
+                    live = self.__rows.get(obj_id, {}).get(field) == (segment, start, end)
+                if live:
+                    out += buf[start:end]
+            # the segment may hold the last lease
+            self.__encode_record(out, self.LEASE, self.__next_id)
+            self.__append(bytes(out))
+            # copies first, on disk, then the originals go
+            os.fsync(self.__fds[self.__active])
+            del self.__segments[segment]
+            fd = self.__fds.pop(segment, None)
+            if fd is not None:
+                os.close(fd)
+            os.unlink(self.__path(segment))
+            self.__sync_dir()
+
+    def close(self):
+        """
+        Stop compacting and close the log. Pending changes should be
+        written out first.
+        """
+        if self.__compactor is not None:
+            self.__compactor.stop()
+            self.__compactor = None
+        with self.__lock:
+            os.fsync(self.__fds[self.__active])
+            for fd in self.__fds.values():
+                os.close(fd)
+            self.__fds = {}
+        self.__lock_file.close()
+
+    def stats(self):
+        """
+        Segment count, log size and garbage bytes.
+        """
+        with self.__lock:
+            return {"segments": len(self.__segments),
+                    "size": sum(size for size, garbage in self.__segments.values()),
+                    "garbage": sum(garbage for size, garbage in self.__segments.values())}
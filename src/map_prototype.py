@@ -1,5 +1,8 @@
 from persistent_object import persistent_object
 from sqlite3_db import sqlite3_db
+from db_interface import db_interface, db_inventory
+import economy, routing
+from lane_graph import lane_graph
 
 import random, time
 
@@ -7,6 +10,8 @@ class c_economy(persistent_object):
     class persistent_data_spec:
         standard_rates = None
         period = None
+        ports = None
+        last_tick = None
         
     def __init__(self):
         self.standard_rates = {
@@ -15,6 +20,29 @@ class c_economy(persistent_object):
             'organics': 10
         }
         self.period = 1*60
+        self.ports = []
+        self.last_tick = time.time()
+        
+    def add_port(self, port):
+        # economies stored before ports were tracked
+        if self.ports is db_interface.UNSET:
+            self.ports = []
+        self.ports.append(port)
+        
+    def get_ports(self):
+        if self.ports is db_interface.UNSET: return []
+        return self.ports
+        
+    def tick(self, now=None):
+        """
+        Advance every port of the economy. See economy.economy_engine
+        """
+        return economy.economy_engine.c_get_engine(self).tick(time.time() if now is None else now)
+        
+    def caught_up_to(self):
+        # ports are kept current up to the last tick
+        if self.last_tick is db_interface.UNSET: return None
+        return self.last_tick
         
 
 class c_starbase(persistent_object):
@@ -28,7 +56,7 @@ class c_starbase(persistent_object):
         
     def __init__(self, economy):
         self.economy = economy
-        self.holds = [None]*random.randint(10,100)
+        self.holds = db_inventory(random.randint(10,100))
         sell_items = []
         buy_items = []
         rate_type = random.randint(1,3)
@@ -45,13 +73,14 @@ class c_starbase(persistent_object):
         self.gen_rate = {item_i: (random.random()/2)+0.25 for item_i in sell_items}
         self.con_rate = {item_i: (random.random()/2)+0.25 for item_i in buy_items}
         self.last_update = time.time()
+        self.economy.add_port(self)
         
     def get_sale_price(self, item):
         #print("Calculate sale price", item)
         if item not in self.gen_rate: 
             return None
         item_count = self.holds.count(item)
-        free_space = self.holds.count(None)
+        free_space = self.holds.free()
         if item_count == 0: return None
         sale_price = self.economy.standard_rates[item]
         #print("Standard rate", sale_price)
@@ -59,49 +88,94 @@ class c_starbase(persistent_object):
         sale_price = int(sale_price * (self.gen_rate[item]+0.5))
         #print("General demand", sale_price)
         # multiply final price by overall sell drive.
-        sale_price = int(sale_price * (.75 + (len(self.holds)-free_space)/(len(self.holds)*2)))
-        #print("Inventory price", sale_price, (.75 + (len(self.holds)-free_space)/(len(self.holds)*2)))
+        sale_price = int(sale_price * (.75 + (self.holds.capacity-free_space)/(self.holds.capacity*2)))
+        #print("Inventory price", sale_price, (.75 + (self.holds.capacity-free_space)/(self.holds.capacity*2)))
         return sale_price
         
     def get_buy_price(self, item):
         if item not in self.con_rate: return None
         item_count = self.holds.count(item)
-        free_space = self.holds.count(None)
+        free_space = self.holds.free()
         if free_space == 0: return None
         buy_price = self.economy.standard_rates[item]
         # multiply by gen_rate+.5 (con-rate is between .25.75 so price between 75% and 125%)
         buy_price = int(buy_price * (self.con_rate[item]+0.5))
         # multiply final price by overall buy drive.
-        buy_price = int(buy_price * (.75 + free_space/(len(self.holds)*2)))
-        print("inventory. Holds {}/{} full".format((len(self.holds)-free_space), len(self.holds)))
-        print("Adjustment:", (.75 + free_space/(len(self.holds)*2)))
+        buy_price = int(buy_price * (.75 + free_space/(self.holds.capacity*2)))
         return buy_price
         
+    def get_prices(self):
+        """
+        (sell_prices, buy_prices): unit price of each item the port sells,
+        and of each item it buys. None for items it can't trade right now.
+        """
+        sell_prices = {sell_item: self.get_sale_price(sell_item) for sell_item in self.gen_rate}
+        buy_prices  = {buy_item:  self.get_buy_price(buy_item)   for buy_item  in self.con_rate}
+        return sell_prices, buy_prices
+        
+    def catch_up(self, now, mode=economy.CATCH_UP_SAMPLE):
+        """
+        Bring the stock up to date with the periods elapsed since last_update,
+        or since the economy's last tick if that is later. Any partial
+        period is carried over to the next update.
+        """
+        start = self.last_update
+        last_tick = self.economy.caught_up_to()
+        if last_tick is not None and last_tick > start:
+            start = last_tick
+        periods = int((now - start) / self.economy.period)
+        if periods <= 0: return 0
+        with persistent_object.transaction():
+            economy.catch_up(self.holds, self.gen_rate, self.con_rate, periods, mode)
+            self.last_update = start + periods * self.economy.period
+        economy.economy_engine.c_port_changed(self)
+        return periods
+        
+    def buy(self, item, count):
+        """
+        A trader buys count of item from the port (one of the port's
+        sell-items). Returns the price paid. Raises if the trade can't be made.
+        """
+        self.catch_up(time.time())
+        if item not in self.gen_rate:
+            raise Exception("No such item {}".format(item))
+        if count <= 0:
+            raise Exception("Count must be positive")
+        if count > self.holds.count(item):
+            raise Exception("Cannot buy {} {}. Insufficient quantity".format(count, item))
+        price = count * self.get_sale_price(item)
+        self.holds.remove(item, count)
+        economy.economy_engine.c_port_changed(self)
+        return price
+        
+    def sell(self, item, count):
+        """
+        A trader sells count of item to the port (one of the port's
+        buy-items). Returns the price received. Raises if the trade can't be
+        made.
+        """
+        self.catch_up(time.time())
+        if item not in self.con_rate:
+            raise Exception("No such item {}".format(item))
+        if count <= 0:
+            raise Exception("Count must be positive")
+        if count > self.holds.free():
+            raise Exception("Cannot sell {} {}. Insufficient free holds".format(count, item))
+        price = count * self.get_buy_price(item)
+        self.holds.add(item, count)
+        economy.economy_engine.c_port_changed(self)
+        return price
+        
     def dock(self):
+        """
+        Interactive trading on the console. See buy and sell for the
+        non-interactive version.
+        """
         cur_time = time.time()
         elapsed = cur_time - self.last_update
-        periods = int(elapsed / self.economy.period)
-        free_holds = self.holds.count(None)
-        print("Dock updating {} periods".format(periods))
-        for period in range(periods):
-            # removed consumed items
-            for buy_item in self.con_rate.keys():
-                if buy_item not in self.holds: continue
-                if random.random() < self.con_rate[buy_item]:
-                    print("Consume")
-                    self.holds.remove(buy_item)
-                    self.holds.append(None)
-                    
-            # update generated items
-            for sell_item in self.gen_rate.keys():
-                if self.holds.count(None) == 0: break
-                if random.random() < self.gen_rate[sell_item]:
-                    next_empty = self.holds.index(None)
-                    self.holds[next_empty] = sell_item
-        if periods > 0: 
-            self.last_update = time.time()
-        sell_prices = {sell_item: self.get_sale_price(sell_item) for sell_item in self.gen_rate}
-        buy_prices  = {buy_item:  self.get_buy_price(buy_item)   for buy_item  in self.con_rate}
+        periods = self.catch_up(cur_time)
+        print("Dock updated {} periods".format(periods))
+        sell_prices, buy_prices = self.get_prices()
         print("Welcome to dock.")
         print("time: {}".format(time.ctime(time.time())))
         print("last update: {})".format(time.ctime(self.last_update)))
@@ -112,7 +186,7 @@ class c_starbase(persistent_object):
             for sell_item in sell_prices:
                 print("\t\t{}\t\t{}".format(sell_item, sell_prices[sell_item]))
         if buy_prices:
-            print("\tItems to buy (max {}):".format(self.holds.count(None)))
+            print("\tItems to buy (max {}):".format(self.holds.free()))
             for buy_item in buy_prices:
                 print("\t\t{}\t\t{}".format(buy_item, buy_prices[buy_item]))
         choice = None
@@ -120,36 +194,15 @@ class c_starbase(persistent_object):
             choice = input("[b, s, x] >> ").strip().lower().split(" ")
             try:
                 if choice[0][0] == "b":
-                    item = choice[1]
-                    count = int(choice[2])
                     # buying sell-items. Sell-items from dock perspective, buy from trader
-                    if item not in sell_prices:
-                        print("No such item {}".format(item))
-                        choice = None
-                        continue
-                    if count > self.holds.count(item):
-                        print("Cannot buy {} {}. Insufficient quantity".format(count, item))
-                        choice = None
-                        continue
-                    for i in range(count):
-                        self.holds.remove(item)
-                    print("You purchased {} {} for {} credits".format(count, item, count*sell_prices[item]))
+                    item, count = choice[1], int(choice[2])
+                    price = self.buy(item, count)
+                    print("You purchased {} {} for {} credits".format(count, item, price))
                 elif choice[0][0] == 's':
-                    item = choice[1]
-                    count = int(choice[2])
                     # selling buy-items. buy-items from dock perspective, sell from trader
-                    if item not in buy_prices:
-                        print("No such item {}".format(item))
-                        choice = None
-                        continue
-                    if count > self.holds.count(None):
-                        print("Cannot sell {} {}. Insufficient free holds".format(count, item))
-                        choice = None
-                        continue
-                    for i in range(count):
-                        next_empty = self.holds.index(None)
-                        self.holds[next_empty] = item
-                    print("You sold {} {} for {} credits".format(count, item, count*buy_prices[item]))
+                    item, count = choice[1], int(choice[2])
+                    price = self.sell(item, count)
+                    print("You sold {} {} for {} credits".format(count, item, price))
                 else:
                     break
             except Exception as e:
@@ -162,64 +215,218 @@ class c_sector(persistent_object):
         name = None
         starbase = None
         
-    def __init__(self, name):
+    def __init__(self, name, compact_lanes=False):
         self.name = name
-        self.jump_lanes = []
+        # None when the map keeps the lanes in its lane graph
+        self.jump_lanes = None if compact_lanes else []
         self.starbase = None
         
     def add_star_base(self, b):
         self.starbase = b
         
+    # both return the lanes they changed, as (from, to) sector numbers.
+    # Go through the map's add_jump_lane and remove_jump_lane, which keep
+    # its course plotting up to date
+    
     def add_jump_lane(self, s, one_way=False):
+        added = []
         if s not in self.jump_lanes:
             self.jump_lanes.append(s)
+            added.append((self.name, s.name))
         if not one_way and self not in s.jump_lanes:
             s.jump_lanes.append(self)
+            added.append((s.name, self.name))
+        return added
+            
+    def remove_jump_lane(self, s, one_way=False):
+        removed = []
+        if s in self.jump_lanes:
+            self.jump_lanes.remove(s)
+            removed.append((self.name, s.name))
+        if not one_way and self in s.jump_lanes:
+            s.jump_lanes.remove(self)
+            removed.append((s.name, self.name))
+        return removed
 
 class c_map_prototype(persistent_object):
+    """
+    Lanes are kept either on the sectors (c_sector.jump_lanes) or, for large
+    maps, in a compact lane graph: lanes holds the CSR arrays as one bytes
+    value and lane_edits the lanes changed since, as (sector, sector, +1/-1)
+    triples. Use get_exits, has_lane and add_jump_lane rather than
+    jump_lanes, so that both work.
+    """
     class persistent_data_spec:
         sectors = None
         current_sector = None
         economy = None
+        lanes = None
+        lane_edits = None
+        
+    LANE_ADDED = 1
+    LANE_REMOVED = -1
         
     def __init__(self):
         self.sectors = {}
         self.current_sector = None
         self.economy = c_economy()
+        self.lanes = None
+        self.lane_edits = []
         
-    def generate(self, n):
+    def generate(self, n, compact_lanes=False):
+        # one database transaction for the whole map
+        with persistent_object.transaction():
+            self.__generate(n, compact_lanes)
+        
+    def __generate(self, n, compact_lanes):
+        """
+        Near linear in n. Lanes are worked out on plain lists first and each
+        sector's lane list is assigned once, at the end (or all of them
+        packed into the lane graph, with compact_lanes).
+        
+        A random spanning tree makes the map connected. Each sector then
+        opens about half of its target number of lanes to sectors that still
+        have room, drawn from a list of open sectors with O(1) removal.
+        """
+        links = [0] + [random.randint(1,10) for i in range(n)]
+        lanes = [[] for i in range(n+1)]
+        
+        # sectors with room for more lanes, and where each one is in the list
+        open_sectors = list(range(1, n+1))
+        open_pos = list(range(-1, n))
+        def close(i):
+            pos = open_pos[i]
+            if pos < 0: return
+            last = open_sectors.pop()
+            if last != i:
+                open_sectors[pos] = last
+                open_pos[last] = pos
+            open_pos[i] = -1
+        def connect(i, j):
+            lanes[i].append(j)
+            lanes[j].append(i)
+            if len(lanes[i]) >= links[i]: close(i)
+            if len(lanes[j]) >= links[j]: close(j)
+            
+        # spanning tree: join each sector to a random one already in the tree
+        order = list(range(1, n+1))
+        random.shuffle(order)
+        for k in range(1, n):
+            connect(order[k], order[random.randrange(k)])
+        print("Spanning tree complete")
         
-        disconnected_sectors = set(range(1,n+1))
-        links = {}
-        for i in range(1, n+1):
-            print("Generating sector", i)
-            self.sectors[i] = c_sector(i)
-            links[i] = random.randint(1,10)
         for i in range(1, n+1):
-            print("Connecting sector", i, "to map")
-            connection_options = [conn_i for conn_i in range(1,n+1) if conn_i != i and len(self.sectors[conn_i].jump_lanes) < links[conn_i]]
-            # try and connect about half of expected connections. Others filled in by reverse connections
-            if len(connection_options) == 0:
-                break
-            connections = random.sample(connection_options, k=(int(min(links[i], len(connection_options))/2)+1)) 
-            for conn_i in connections:
-                self.sectors[i].add_jump_lane(self.sectors[conn_i])
-                disconnected_sectors.discard(i)
-                disconnected_sectors.discard(conn_i)
-        print("After initial connections, {} disconnected sectors remaining".format(len(disconnected_sectors)))
-        for sec_i in disconnected_sectors:
-            connection_options = [conn_i for conn_i in range(1, n+1) if conn_i != sec_i and links[conn_i] > 5]
-            self.sectors[sec_i].add_jump_lane(self.sectors[random.choice(connection_options)])
+            wanted = int(links[i]/2)+1 - len(lanes[i])
+            # a few tries per lane. Duplicates and self lanes are skipped
+            tries = wanted * 4
+            while wanted > 0 and tries > 0 and open_pos[i] >= 0 and len(open_sectors) > 1:
+                tries -= 1
+                j = open_sectors[random.randrange(len(open_sectors))]
+                if j == i or j in lanes[i]: continue
+                connect(i, j)
+                wanted -= 1
+        print("Lanes complete")
+        
+        sectors = {i: c_sector(i, compact_lanes) for i in range(1, n+1)}
+        if compact_lanes:
+            self.lanes = lane_graph.c_from_lanes(lanes).to_bytes()
+        else:
+            for i in range(1, n+1):
+                sectors[i].jump_lanes = [sectors[j] for j in lanes[i]]
+        self.sectors.update(sectors)
         self.current_sector = 1
         #persistent_object.c_db().get_cache_control().write_to_database()
         #persistent_object.c_db().get_cache_control().change_mode("write_immediate")
         self.sectors[1].add_star_base(c_starbase(self.economy))
-        for sector in self.sectors[1].jump_lanes:
-            sector.add_star_base(c_starbase(self.economy))
+        for sector_number in lanes[1]:
+            self.sectors[sector_number].add_star_base(c_starbase(self.economy))
         print("generation complete")
         
+    def lane_graph(self):
+        """
+        The compact lane graph, or None if lanes are kept on the sectors.
+        Decoded once, with the stored edits applied, and decoded again when
+        lanes or lane_edits no longer match it: after a reload (eviction,
+        another process's changes) or a rollback.
+        """
+        lanes = self.lanes
+        if not isinstance(lanes, bytes):
+            return None
+        try:
+            cached_lanes, cached_edits, graph = self.__lane_graph
+            if cached_lanes is lanes and cached_edits == len(self.lane_edits):
+                return graph
+            # stale: courses were plotted over the lanes as they were
+            routing.route_index.c_drop_index(self)
+        except AttributeError:
+            pass
+        graph = lane_graph.c_from_bytes(lanes)
+        edits = self.lane_edits
+        for i in range(0, len(edits), 3):
+            if edits[i+2] == self.LANE_ADDED: graph.add_lane(edits[i], edits[i+1])
+            else: graph.remove_lane(edits[i], edits[i+1])
+        self.__lane_graph = (lanes, len(edits), graph)
+        return graph
+        
+    def get_exits(self, sector_number):
+        graph = self.lane_graph()
+        if graph is not None:
+            return graph.exits(sector_number)
+        return [s.name for s in self.sectors[sector_number].jump_lanes]
+        
+    def has_lane(self, from_sector, to_sector):
+        graph = self.lane_graph()
+        if graph is not None:
+            return graph.has_lane(from_sector, to_sector)
+        if to_sector not in self.sectors: return False
+        return self.sectors[to_sector] in self.sectors[from_sector].jump_lanes
+        
+    def add_jump_lane(self, from_sector, to_sector, one_way=False):
+        graph = self.lane_graph()
+        self.__lanes_changing()
+        if graph is None:
+            for a, b in self.sectors[from_sector].add_jump_lane(self.sectors[to_sector], one_way):
+                routing.route_index.c_lane_added(self, a, b)
+            return
+        self.__edit_lane(graph, from_sector, to_sector, self.LANE_ADDED)
+        if not one_way:
+            self.__edit_lane(graph, to_sector, from_sector, self.LANE_ADDED)
+            
+    def remove_jump_lane(self, from_sector, to_sector, one_way=False):
+        graph = self.lane_graph()
+        self.__lanes_changing()
+        if graph is None:
+            for a, b in self.sectors[from_sector].remove_jump_lane(self.sectors[to_sector], one_way):
+                routing.route_index.c_lane_removed(self, a, b)
+            return
+        self.__edit_lane(graph, from_sector, to_sector, self.LANE_REMOVED)
+        if not one_way:
+            self.__edit_lane(graph, to_sector, from_sector, self.LANE_REMOVED)
+            
+    def __edit_lane(self, graph, a, b, edit):
+        if edit == self.LANE_ADDED:
+            if not graph.add_lane(a, b): return
+            routing.route_index.c_lane_added(self, a, b)
+        else:
+            if not graph.remove_lane(a, b): return
+            routing.route_index.c_lane_removed(self, a, b)
+        self.lane_edits.extend([a, b, edit])
+        # fold the edits back into the arrays once they add up
+        if graph.edit_count() > max(1024, graph.lane_count() // 32):
+            self.lanes = graph.to_bytes()
+            self.lane_edits.clear()
+        # the graph has the edit already
+        self.__lane_graph = (self.lanes, len(self.lane_edits), graph)
+        
+    def __lanes_changing(self):
+        # a rollback restores the lanes, but not the route index built from them
+        persistent_object.c_db().get_cache_control().on_rollback(self.__drop_route_index)
+        
+    def __drop_route_index(self):
+        routing.route_index.c_drop_index(self)
+        
     def goto_sector(self, sector_number):
-        if self.sectors[sector_number] in self.sectors[self.current_sector].jump_lanes:
+        if self.has_lane(self.current_sector, sector_number):
             self.current_sector = sector_number
             return True
         else:
@@ -227,6 +434,15 @@ class c_map_prototype(persistent_object):
             
     def get_current_sector(self):
         return (self.current_sector, self.sectors[self.current_sector])
+        
+    def plot_course(self, sector_number, from_sector=None):
+        """
+        Shortest course as a list of sector numbers, starting at from_sector
+        (the current sector by default). None if there is no course.
+        """
+        if from_sector is None: from_sector = self.current_sector
+        build_exits = lambda: {num: self.get_exits(num) for num in self.sectors}
+        return routing.route_index.c_get_index(self, build_exits).plot(from_sector, sector_number)
 
 if __name__=="__main__":
     import sys, os
@@ -235,11 +451,13 @@ if __name__=="__main__":
         persistent_object.c_set_db_interface(sqlite3_db("test_map.db"))
         persistent_object.c_db().get_cache_control().change_mode("write_on_exit")
         map = c_map_prototype()
-        map.generate(100)
+        map.generate(int(sys.argv[2]) if len(sys.argv) > 2 else 100, compact_lanes="compact" in sys.argv[3:])
         print("Map generated")
     elif sys.argv[1] == "play":
         persistent_object.c_set_db_interface(sqlite3_db("test_map.db"))
         persistent_object.c_db().get_cache_control().change_mode("write_on_exit")
+        # only load the sectors we actually visit
+        persistent_object.c_set_load_mode(persistent_object.LOAD_MODE_LAZY)
         persistent_object.c_reload_objects()
         map = persistent_object.c_get_object_by_id(0)
         
@@ -248,7 +466,7 @@ if __name__=="__main__":
             cur_sector  = "Sector [{}] (Unexplored)\n".format(sec_num)
             if sector.starbase:
                 cur_sector += "Starbase\n"
-            cur_sector += "Jump Lanes: {}\n".format([str(s.name) for s in sector.jump_lanes])
+            cur_sector += "Jump Lanes: {}\n".format([str(s) for s in map.get_exits(sec_num)])
             cur_sector += ">> "
             cmd = input(cur_sector).strip().lower().split(" ")
             if cmd[0] in ["quit", "exit"]:
@@ -270,8 +488,18 @@ if __name__=="__main__":
                     sector.starbase.dock()
                 else:
                     print("There is no starbase here!")
+            elif cmd[0] in ["plot", "course"]:
+                try:
+                    target = int(cmd[1])
+                except:
+                    print("Sector must be a number.")
+                    continue
+                course = map.plot_course(target)
+                if course is None:
+                    print("No course to sector {}".format(target))
+                else:
+                    print("Course to sector {} ({} jumps): {}".format(target, len(course)-1, " > ".join(str(s) for s in course)))
             elif cmd[0] in ["exits", "jumps", "lanes"]:
-                lanes = [str(s.name) for s in sector.jump_lanes]
-                lanes.sort()
+                lanes = [str(s) for s in sorted(map.get_exits(sec_num))]
                 print("Jump-lane exits from this sector are:", ", ".join(lanes))
         print("EXIT")
\ No newline at end of file
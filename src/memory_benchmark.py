@@ -0,0 +1,56 @@
+"""
+Memory used per persistent object, list and dict, measured with tracemalloc.
+
+    python memory_benchmark.py [count]
+
+Objects are measured twice: just created (dirty, waiting to be written)
+and after a flush to an in-memory database (clean), which is what a loaded
+universe looks like.
+"""
+import gc, sys, tracemalloc
+
+from persistent_object import persistent_object
+from sqlite3_db import sqlite3_db
+from db_interface import db_list, db_dict
+
+class bench_sector(persistent_object):
+    class persistent_data_spec:
+        name = None
+        jump_lanes = None
+        starbase = None
+
+    def __init__(self, name):
+        self.name = name
+        self.jump_lanes = None
+        self.starbase = None
+
+def measure(create, count, cache_control):
+    gc.collect()
+    start = tracemalloc.get_traced_memory()[0]
+    keep = [create(i) for i in range(count)]
+    gc.collect()
+    # the list holding the results isn't part of the cost
+    dirty = (tracemalloc.get_traced_memory()[0] - start - sys.getsizeof(keep)) / count
+    cache_control.write_to_database()
+    gc.collect()
+    clean = (tracemalloc.get_traced_memory()[0] - start - sys.getsizeof(keep)) / count
+    return keep, dirty, clean
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    persistent_object.c_set_db_interface(sqlite3_db(":memory:"))
+    cache_control = persistent_object.c_db().get_cache_control()
+    cache_control.change_mode(cache_control.CACHE_MODE_MANUAL)
+
+    tracemalloc.start()
+    results = [
+        ("persistent object (3 fields)", measure(bench_sector, count, cache_control)),
+        ("db_list (3 items)", measure(lambda i: db_list.REGISTRY.c_create_db_list(cache_control.save, [i, i+1, i+2]), count, cache_control)),
+        ("db_dict (1 item)", measure(lambda i: db_dict.REGISTRY.c_create_db_dict(cache_control.save, {"a": i}), count, cache_control)),
+    ]
+    tracemalloc.stop()
+
+    print("{} of each, bytes per item".format(count))
+    print("{:30} {:>8} {:>8}".format("", "dirty", "clean"))
+    for name, (keep, dirty, clean) in results:
+        print("{:30} {:8.0f} {:8.0f}".format(name, dirty, clean))
@@ -0,0 +1,112 @@
+"""
+Database that keeps everything in memory and does no I/O at all, for
+tests, simulation runs and measuring the object layer on its own.
+
+Rows are kept exactly as a stored database would have them (see db_rows):
+aggregates are packed with db_codec and references stored as ids, so
+what works here works on disk. Nothing outlives the process.
+"""
+import operator, threading
+
+from db_interface import db_id_allocator
+from db_rows import db_row_store, field_order
+import db_codec
+
+class memory_db(db_row_store):
+    QUERY_COMPARE = {"lt": operator.lt, "le": operator.le, "gt": operator.gt, "ge": operator.ge}
+
+    def __init__(self, pack_threshold=256):
+        super().__init__(pack_threshold)
+        # the timer mode writer thread writes while the game reads
+        self.__lock = threading.Lock()
+        self.__objects = {}
+        # obj_id: {field: (ref, value)}
+        self.__rows = {}
+
+    def get_id_allocator(self):
+        return db_id_allocator.c_in_memory()
+
+    def get_object_class(self, db_id):
+        return self.__objects.get(db_id, None)
+
+    def all_objects(self):
+        with self.__lock:
+            return list(self.__objects.items())
+
+    def _stored_rows(self, source, db_id):
+        with self.__lock:
+            rows = [(field, ref, value) for field, (ref, value) in self.__rows.get(db_id, {}).items()]
+        return sorted(rows, key=field_order)
+
+    def get(self, ctx):
+        with self.__lock:
+            obj_rows = dict(self.__rows.get(ctx.db_id, {}))
+        data = {}
+        for field in ctx.db_spec:
+            if field not in obj_rows:
+                data[field] = self.UNSET
+                continue
+            data[field] = self._load(None, *obj_rows[field])
+        ctx.fields_synchronized()
+        return data
+
+    def get_many(self, ctxs):
+        rows = {}
+        with self.__lock:
+            for obj_id, obj_rows in self.__rows.items():
+                rows[obj_id] = sorted(((field, ref, db_codec.unpack_items(value) if ref == self.PACKED else value)
+                    for field, (ref, value) in obj_rows.items()), key=field_order)
+        loaded, new_aggregates = self._build(rows, ctxs)
+        return loaded
+
+    def write_prepared(self, batch):
+        with self.__lock:
+            self.__objects.update(batch.objects)
+            for db_id in batch.deleted_objects:
+                self.__objects.pop(db_id, None)
+                self.__rows.pop(db_id, None)
+            for db_id in batch.cleared:
+                self.__rows.pop(db_id, None)
+            for db_id, field in batch.deletes:
+                self.__rows.get(db_id, {}).pop(field, None)
+            for (db_id, field), row in batch.upserts.items():
+                self.__rows.setdefault(db_id, {})[field] = row
+        return []
+
+    def refresh(self, ctx):
+        if ctx.db_type_name in self.AGGREGATE_TYPES:
+            self._read_aggregate(None, ctx.fields_cache)
+        else:
+            ctx.fields_cache._update(self.get(ctx))
+
+    def query(self, db_type_names, conditions):
+        db_type_names = set(db_type_names)
+        obj_ids = []
+        with self.__lock:
+            for obj_id, obj_class in self.__objects.items():
+                if obj_class not in db_type_names: continue
+                rows = self.__rows.get(obj_id, {})
+                if all(field in rows and self.__matches(rows[field], op, value) for field, op, value in conditions):
+                    obj_ids.append(obj_id)
+        return obj_ids
+
+    def __matches(self, row, op, value):
+        # the same rules as sqlite3_db's SQL, on the stored (ref, value) pair
+        if op == "in":
+            return any(self.__matches(row, "eq", v) for v in value)
+        value, ref_type = self.c_db_ref(value)
+        wanted = (value, ref_type) if ref_type is not None else (None, value)
+        if op == "eq":
+            return row == wanted
+        if op == "ne":
+            return row != wanted
+        if ref_type is not None:
+            raise Exception("References can only be compared with eq, ne and in")
+        ref, stored = row
+        if ref is not None or stored is None:
+            return False
+        try:
+            return self.QUERY_COMPARE[op](stored, value)
+        except TypeError:
+            # SQLite orders values of different types, Python won't
+            return False
@@ -1,10 +1,20 @@
-import time
-from db_interface import db_interface, db_complex_type_ctx
+import weakref
+from collections import OrderedDict
+from operator import attrgetter
+from db_interface import db_interface, db_complex_type_ctx, db_field_record
 
 class PersistentType(type):  
+    LOAD_MODE_EAGER = "load_eager"
+    LOAD_MODE_LAZY = "load_on_demand"
+    
     __db_access = None
     __class_directory = {}
-    __obj_directory = {}
+    # objects are only held weakly by id. The strong references are in
+    # __loaded_objects, oldest first, which bounds how many stay loaded
+    __obj_directory = weakref.WeakValueDictionary()
+    __loaded_objects = OrderedDict()
+    __object_cache_size = None
+    __load_mode = LOAD_MODE_EAGER
     
     class reference_manager:
         def db_ref(self, v):
@@ -19,7 +29,10 @@ class PersistentType(type):
     @classmethod
     def c_set_db_interface(cls, db_interface):
         db_interface.c_set_ref_mgr(cls.reference_manager())
+        db_complex_type_ctx.c_set_id_allocator(db_interface.get_id_allocator())
         cls.__db_access = db_interface
+        for db_cls_name, (db_cls, db_spec) in cls.__class_directory.items():
+            db_interface.register_class(db_cls_name, db_spec, db_cls._persistent_indexes)
         
     @classmethod
     def c_db(cls):
@@ -32,20 +45,158 @@ class PersistentType(type):
     @classmethod
     def c_set_class_spec(cls, db_cls_name, db_cls, db_spec):
         cls.__class_directory[db_cls_name] = (db_cls, db_spec)
+        if cls.__db_access is not None:
+            cls.__db_access.register_class(db_cls_name, db_spec, db_cls._persistent_indexes)
         
     @classmethod
     def c_register_object(cls, obj, obj_id):
         cls.__obj_directory[obj_id] = obj
         
+    @classmethod
+    def c_forget_object(cls, obj_id):
+        # created in a transaction that rolled back, so never stored
+        cls.__obj_directory.pop(obj_id, None)
+        cls.__loaded_objects.pop(obj_id, None)
+        
+    @classmethod
+    def c_set_object_cache_size(cls, size):
+        """
+        Keep at most size objects loaded (None, the default, is unbounded).
+        Past that, the least recently used objects are made hollow again,
+        which releases their fields, and are dropped entirely once nothing
+        else refers to them. Objects with changes that are not written yet
+        are never evicted.
+        """
+        cls.__object_cache_size = size
+        cls.__evict()
+        
+    @classmethod
+    def c_object_cache_size(cls):
+        return cls.__object_cache_size
+        
+    @classmethod
+    def c_loaded_object_count(cls):
+        return len(cls.__loaded_objects)
+        
+    @classmethod
+    def c_object_loaded(cls, obj):
+        cls.__loaded_objects[obj.__get_persistent_id__()] = obj
+        if cls.__object_cache_size is not None and len(cls.__loaded_objects) > cls.__object_cache_size:
+            cls.__evict()
+            
+    @classmethod
+    def __evict(cls):
+        size = cls.__object_cache_size
+        loaded = cls.__loaded_objects
+        if size is None or len(loaded) <= size: return
+        cache_control = cls.__db_access.get_cache_control()
+        with cache_control.lock:
+            # clock sweep: objects used since the last sweep get a second
+            # chance, objects with unwritten changes stay pinned
+            for i in range(len(loaded)):
+                if len(loaded) <= size: break
+                obj_id, obj = loaded.popitem(last=False)
+                proxy = obj._persistent_object__persistent_proxy
+                if proxy.referenced or cache_control.has_unwritten_changes(proxy.db_ctx):
+                    proxy.referenced = False
+                    loaded[obj_id] = obj
+                else:
+                    proxy.unload()
+                    
+    @classmethod
+    def c_set_load_mode(cls, mode):
+        cls.__load_mode = mode
+        
+    @classmethod
+    def c_load_mode(cls):
+        return cls.__load_mode
+        
     @classmethod
     def c_lookup_object(cls, obj_id):
-        return cls.__obj_directory.get(obj_id, None)
+        obj = cls.__obj_directory.get(obj_id, None)
+        # not loaded yet (lazy mode) or evicted and collected since
+        if obj is None:
+            obj_class_name = cls.__db_access.get_object_class(obj_id)
+            if obj_class_name is not None:
+                obj = cls.c_create_hollow_object(obj_id, obj_class_name)
+        return obj
+        
+    @classmethod
+    def c_create_hollow_object(cls, obj_id, obj_class_name):
+        """
+        Create and register an object whose fields are not loaded yet.
+        The fields are filled in the first time one of them is accessed
+        (or by an explicit reload).
+        """
+        obj_class, db_spec = cls.c_get_class_spec(obj_class_name)
+        
+        obj = object.__new__(obj_class)
+        obj_ctx = db_complex_type_ctx(obj_class_name, db_spec, obj_class._persistent_record(), cls.c_db().get_cache_control().save, set_id=obj_id)
+        persistence_proxy = obj_class.persistence_proxy(obj_ctx, loaded=False)
+        obj.__initialize_persistence__(persistence_proxy)
+        cls.c_register_object(obj, obj_id)
+        return obj
+        
+    @classmethod
+    def c_refresh_changes(cls):
+        """
+        Catch up with the changes other processes committed. Changed
+        objects go back to hollow and are re-read on next access; changed
+        lists and dictionaries are re-read in place. Anything with changes
+        of its own still to be written is left to conflict detection.
+        Returns how many were refreshed.
+        """
+        db = cls.__db_access
+        cache_control = db.get_cache_control()
+        refreshed = 0
+        with cache_control.lock:
+            for db_id in db.changed_ids():
+                obj = cls.__obj_directory.get(db_id, None)
+                if obj is not None:
+                    proxy = obj._persistent_object__persistent_proxy
+                    if proxy.loaded and not cache_control.has_unwritten_changes(proxy.db_ctx):
+                        proxy.unload()
+                        refreshed += 1
+                    continue
+                aggregate = db.c_get_aggregate_by_id(db_id)
+                if aggregate is not None and not cache_control.has_unwritten_changes(aggregate._db_ctx):
+                    db.refresh(aggregate._db_ctx)
+                    refreshed += 1
+        return refreshed
         
     @classmethod
     def c_obj_iter(cls):
-        for k,v in cls.__obj_directory.items():
+        for k,v in list(cls.__obj_directory.items()):
             yield (k,v)
         
+    class persistent_field:
+        """
+        Data descriptor generated for each persistent field. Reads come
+        straight from the fields cache; writes go through the proxy so the
+        field is marked dirty.
+        """
+        __slots__ = ("name", "read")
+        
+        def __init__(self, name):
+            self.name = name
+            self.read = attrgetter(name)
+            
+        def __get__(self, obj, obj_class=None):
+            if obj is None: return self
+            proxy = obj._persistent_object__persistent_proxy
+            if not proxy.loaded:
+                proxy.reload()
+                PersistentType.c_object_loaded(obj)
+            proxy.referenced = True
+            return self.read(proxy.cache)
+            
+        def __set__(self, obj, v):
+            proxy = obj._persistent_object__persistent_proxy
+            if not proxy.loaded:
+                proxy.reload()
+                PersistentType.c_object_loaded(obj)
+            proxy.set(self.name, v)
+            
     class init_decorator:
         def __init__(self, orig_init):
             self.orig_init = orig_init
@@ -62,12 +213,16 @@ class PersistentType(type):
                 print(obj_self, obj_self.__class__, db_cls)
                 raise Exception("Class definition mismatch")
             
-            db_obj_ctx = db_complex_type_ctx(db_type_name, db_spec, {}, PersistentType.c_db().get_cache_control().save)
+            db_obj_ctx = db_complex_type_ctx(db_type_name, db_spec, db_cls._persistent_record(), PersistentType.c_db().get_cache_control().save)
             persistence_proxy = obj_self.__class__.persistence_proxy(db_obj_ctx)
             obj_self.__initialize_persistence__(persistence_proxy)
             
+            # lets an open transaction drop the object again on rollback
+            db_obj_ctx.fields_changing()
             PersistentType.c_db().init_object(persistence_proxy.db_ctx)
             PersistentType.c_register_object(obj_self, obj_self.__get_persistent_id__())
+            PersistentType.c_object_loaded(obj_self)
+            PersistentType.c_db().get_cache_control().on_rollback(persistence_proxy.forget)
             
             self.orig_init(obj_self, *args, **kargs)
             
@@ -79,6 +234,8 @@ class PersistentType(type):
             raise Exception("Class {} does not define 'persistent_data_spec'.".format(name))
         
         db_spec = {k:getattr(persistent_data_spec,k) for k in dir(persistent_data_spec) if not k.startswith("_")}
+        # fields to index for queries, e.g. _indexes = ("m_sector",)
+        indexes = list(getattr(persistent_data_spec, "_indexes", ()))
         base_specs = [base for base in bases if type(base) is PersistentType]
         while base_specs:
             next_base = base_specs.pop(0)
@@ -86,9 +243,19 @@ class PersistentType(type):
                 if k.startswith("_"): continue
                 if k in db_spec:
                     raise Exception("Persistent Subclasses Cannot Overwrite Previous Attributes. Attempt to redefine {}".format(k))
-                db_spec[k] = next_base.persistent_data_spec[k]
+                db_spec[k] = getattr(next_base.persistent_data_spec, k)
+            indexes += [k for k in next_base._persistent_indexes if k not in indexes]
             base_specs = base_specs + [base for base in next_base.__bases__ if type(base) is PersistentType]
+        for k in indexes:
+            if k not in db_spec:
+                raise Exception("Class {} indexes {}, which is not a persistent field".format(name, k))
         
+        # persistent fields take precedence over anything else of the same name
+        for k in db_spec:
+            attrs[k] = PersistentType.persistent_field(k)
+        attrs["_persistent_record"] = db_field_record.c_record_class(name + "_record", db_spec)
+        attrs["_persistent_indexes"] = tuple(indexes)
+            
         orig_constructor = attrs.get("__init__", lambda self: None)
         new_constructor =  PersistentType.init_decorator(orig_constructor)
         attrs["__init__"] = lambda self, *args, **kargs: new_constructor(self, *args, **kargs)
@@ -104,6 +271,9 @@ class persistent_object(metaclass=PersistentType):
     def c_set_db_interface(cls, db_interface):
         PersistentType.c_set_db_interface(db_interface)
         
+    LOAD_MODE_EAGER = PersistentType.LOAD_MODE_EAGER
+    LOAD_MODE_LAZY = PersistentType.LOAD_MODE_LAZY
+    
     @classmethod
     def c_get_object_by_id(cls, persistent_id):
         return PersistentType.c_lookup_object(persistent_id)
@@ -112,8 +282,66 @@ class persistent_object(metaclass=PersistentType):
     def c_set_cache_mode(cls, mode):
         cls.persistence_proxy.CACHE_MODE = mode
         
+    @classmethod
+    def c_set_load_mode(cls, mode):
+        PersistentType.c_set_load_mode(mode)
+        
+    @classmethod
+    def c_set_object_cache_size(cls, size):
+        PersistentType.c_set_object_cache_size(size)
+        
+    @classmethod
+    def c_refresh_changes(cls):
+        return PersistentType.c_refresh_changes()
+        
+    @classmethod
+    def transaction(cls):
+        """
+        with persistent_object.transaction():
+            ...
+        
+        Batches every change in the block into one database transaction.
+        """
+        return PersistentType.c_db().get_cache_control().transaction()
+        
+    @classmethod
+    def query(cls, **conditions):
+        """
+        c_starbase.query(economy=e, last_update__lt=t)
+        
+        Objects of this class, or a subclass, whose stored fields match
+        every condition. A condition is field=value or field__op=value,
+        with op one of eq, ne, lt, le, gt, ge or in (a list of values).
+        Values can be scalars or persistent objects. Declare the fields
+        you query on in persistent_data_spec._indexes.
+        
+        Pending changes are written first, so they are matched. Changes
+        made inside an open transaction are not. Objects come back hollow
+        unless they were loaded already.
+        """
+        db_cls, db_spec = PersistentType.c_get_class_spec(cls.__name__)
+        parsed = []
+        for k, v in conditions.items():
+            field, sep, op = k.rpartition("__")
+            if op not in db_interface.QUERY_OPS:
+                field, op = k, "eq"
+            if field not in db_spec:
+                raise Exception("Class {} has no persistent field {}".format(cls.__name__, field))
+            parsed.append((field, op, list(v) if op == "in" else v))
+            
+        db_type_names = []
+        classes = [cls]
+        while classes:
+            next_cls = classes.pop()
+            db_type_names.append(next_cls.__name__)
+            classes.extend(sub for sub in next_cls.__subclasses__() if type(sub) is PersistentType)
+            
+        PersistentType.c_db().get_cache_control().write_to_database()
+        return [PersistentType.c_lookup_object(obj_id) for obj_id in PersistentType.c_db().query(db_type_names, parsed)]
+        
     class persistence_proxy:
         UNSET = db_interface.UNSET
+        __slots__ = ("db_ctx", "cache", "loaded", "referenced")
         
         '''
         @staticmethod
@@ -127,24 +355,38 @@ class persistent_object(metaclass=PersistentType):
             l.__append__ = lambda self, v: [old_append(v), proxy.set_list_changed(l_key, len(l)-1, len(l))]
             l.__persistent__ = True'''
         
-        def __init__(self, db_ctx):
+        def __init__(self, db_ctx, loaded=True):
             self.db_ctx = db_ctx
-            
-            self.last_save = time.time()
             self.cache = db_ctx.fields_cache
-            for k in db_ctx.db_spec:
-                if k not in self.cache:
-                    self.cache[k] = self.UNSET
+            # hollow proxies fault their fields in on first access
+            self.loaded = loaded
+            # set on every access, cleared by the eviction sweep
+            self.referenced = loaded
                 
         def has_persistent_attr(self, k):
             return k in self.db_ctx.db_spec
             
         def get(self, k):
+            if not self.loaded: self.reload()
             return self.cache[k]
             
-        def reload(self):
-            self.db_ctx.fields_cache = PersistentType.c_db().get(self.db_ctx)
-            self.cache = self.db_ctx.fields_cache
+        def reload(self, data=None):
+            if data is None:
+                data = PersistentType.c_db().get(self.db_ctx)
+            self.cache._update(data)
+            self.loaded = True
+            self.referenced = True
+            
+        def unload(self):
+            # back to hollow. The next access reads the fields again
+            self.cache.__init__()
+            self.loaded = False
+            self.referenced = False
+            
+        def forget(self):
+            # the object was created in a transaction that rolled back
+            PersistentType.c_db().forget_object(self.db_ctx)
+            PersistentType.c_forget_object(self.db_ctx.db_id)
             
         def save_aggregate(self, k):
             PersistentType.c_db().set_aggregate(self.db_ctx, k, self.cache[k], changespec)
@@ -152,8 +394,13 @@ class persistent_object(metaclass=PersistentType):
         def set(self, k, v):
             #if isinstance(v, list) and not hasattr(v, "__persistent__"):
             #    self.decorate_list(self, k, v)
-            self.cache[k] = v
-            self.db_ctx.fields_changed([k])
+            if not self.loaded: self.reload()
+            self.referenced = True
+            PersistentType.c_db().check_field(self.db_ctx, k, v)
+            with self.db_ctx.lock:
+                self.db_ctx.fields_changing()
+                self.cache[k] = v
+                self.db_ctx.fields_changed([k])
                 
         def set_list_changed(self, l_key, start_change, end_change):
             self.change_specs[l].append((start_change, end_change))
@@ -163,37 +410,23 @@ class persistent_object(metaclass=PersistentType):
     def c_reload_objects(cls):
         cls.__CREATION_MODE = "reload"
         
+        # in lazy mode, objects are faulted in by c_get_object_by_id as they are reached
+        if PersistentType.c_load_mode() == PersistentType.LOAD_MODE_LAZY:
+            return
+        
         # objects must be registered first (so they exist) and then reloaded
         # this solves objects pointing at teach other
         reloaders = []
         for persistence_id, obj_class_name in PersistentType.c_db().all_objects():
-            obj_class, db_spec = PersistentType.c_get_class_spec(obj_class_name)
-            
-            obj = object.__new__(obj_class)
-            obj_ctx = db_complex_type_ctx(obj_class_name, db_spec, {}, PersistentType.c_db().get_cache_control().save, set_id=persistence_id)
-            persistence_proxy = obj.__class__.persistence_proxy(obj_ctx)
-            obj.__initialize_persistence__(persistence_proxy)
-            PersistentType.c_register_object(obj, persistence_id)
-            reloaders.append(persistence_proxy)
+            reloaders.append(PersistentType.c_create_hollow_object(persistence_id, obj_class_name))
             
-        for persistence_proxy in reloaders:
-            persistence_proxy.reload()
+        # a single bulk load instead of a round trip per field
+        loaded = PersistentType.c_db().get_many([obj.__persistent_proxy.db_ctx for obj in reloaders])
+        for obj in reloaders:
+            obj.__persistent_proxy.reload(loaded[obj.__get_persistent_id__()])
+            PersistentType.c_object_loaded(obj)
             
     
-    def __getattribute__(self, k):
-        if k.startswith("_"): return super().__getattribute__(k)
-        proxy = self.__persistent_proxy
-        if proxy.has_persistent_attr(k):
-            return proxy.get(k)
-        else: return super().__getattribute__(k)
-        
-    def __setattr__(self, k, v):
-        if k.startswith("_"): return super().__setattr__(k, v)
-        proxy = self.__persistent_proxy
-        if proxy.has_persistent_attr(k):
-            return proxy.set(k, v)
-        else: return super().__setattr__(k, v)
-        
     def __initialize_persistence__(self, proxy):
         self.__persistent_proxy = proxy
         
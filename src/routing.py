@@ -0,0 +1,192 @@
+"""
+Course plotting over jump lanes.
+
+route_index keeps the lanes as plain sector numbers, so routing never goes
+through the persistent objects. Lanes are unweighted, so breadth first
+search gives the shortest course.
+
+Sources that are routed from repeatedly get a full BFS tree, kept in an LRU.
+Every other query runs a bidirectional BFS, which only explores around the
+two ends. When a lane changes, each cached tree is checked in O(1) and only
+the trees the change can affect are dropped.
+
+There is an index per map. It goes away with the map.
+"""
+import weakref
+from collections import OrderedDict
+
+class route_index:
+    # owner: index. Weak, so that an index lives as long as its map
+    __INDEXES = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def c_get_index(cls, owner, build_exits, **kargs):
+        """
+        The index for owner (a map), built from build_exits() on first use.
+        """
+        index = cls.__INDEXES.get(owner, None)
+        if index is None:
+            index = cls.__INDEXES[owner] = cls(build_exits(), **kargs)
+        return index
+
+    @classmethod
+    def c_drop_index(cls, owner):
+        """
+        Forget owner's index. The next query builds it again.
+        """
+        cls.__INDEXES.pop(owner, None)
+
+    @classmethod
+    def c_lane_added(cls, owner, a, b):
+        index = cls.__INDEXES.get(owner, None)
+        if index is not None:
+            index.add_lane(a, b)
+
+    @classmethod
+    def c_lane_removed(cls, owner, a, b):
+        index = cls.__INDEXES.get(owner, None)
+        if index is not None:
+            index.remove_lane(a, b)
+
+    def __init__(self, exits, cache_size=256):
+        """
+        exits maps each sector number to a list of the sector numbers its
+        lanes lead to.
+        """
+        self.exits = {}
+        self.entries = {}
+        for num, sector_exits in exits.items():
+            self.exits[num] = list(sector_exits)
+            self.entries.setdefault(num, [])
+        for num, exits in self.exits.items():
+            for other in exits:
+                self.entries.setdefault(other, []).append(num)
+        self.cache_size = cache_size
+        # source -> (dist, parent) for hot sources
+        self.__trees = OrderedDict()
+        # sources routed from once, waiting for a second query
+        self.__seen = OrderedDict()
+
+    def has_lane(self, a, b):
+        return b in self.exits.get(a, ())
+
+    def add_lane(self, a, b):
+        if self.has_lane(a, b): return
+        self.exits.setdefault(a, []).append(b)
+        self.entries.setdefault(b, []).append(a)
+        self.exits.setdefault(b, [])
+        self.entries.setdefault(a, [])
+        # a new lane only matters to trees where it makes b closer
+        for source, (dist, parent) in list(self.__trees.items()):
+            if a in dist and (b not in dist or dist[a] + 1 < dist[b]):
+                del self.__trees[source]
+
+    def remove_lane(self, a, b):
+        if not self.has_lane(a, b): return
+        self.exits[a].remove(b)
+        self.entries[b].remove(a)
+        # a lost lane only matters to trees that route through it
+        for source, (dist, parent) in list(self.__trees.items()):
+            if parent.get(b, None) == a:
+                del self.__trees[source]
+
+    def plot(self, source, target):
+        """
+        Shortest course from source to target as a list of sector numbers,
+        both ends included. None if there is no course.
+        """
+        if source not in self.exits or target not in self.exits:
+            return None
+        if source == target:
+            return [source]
+
+        tree = self.__trees.get(source, None)
+        if tree is None and source in self.__seen:
+            # second query from here. Worth a full tree
+            del self.__seen[source]
+            tree = self.__build_tree(source)
+        if tree is not None:
+            self.__trees.move_to_end(source)
+            return self.__tree_path(tree, source, target)
+
+        self.__seen[source] = True
+        self.__seen.move_to_end(source)
+        if len(self.__seen) > self.cache_size:
+            self.__seen.popitem(last=False)
+        return self.__bidirectional(source, target)
+
+    def distance(self, source, target):
+        course = self.plot(source, target)
+        return None if course is None else len(course) - 1
+
+    def __build_tree(self, source):
+        dist = {source: 0}
+        parent = {source: None}
+        frontier = [source]
+        exits = self.exits
+        while frontier:
+            next_frontier = []
+            for num in frontier:
+                d = dist[num] + 1
+                for other in exits[num]:
+                    if other not in dist:
+                        dist[other] = d
+                        parent[other] = num
+                        next_frontier.append(other)
+            frontier = next_frontier
+        tree = (dist, parent)
+        self.__trees[source] = tree
+        if len(self.__trees) > self.cache_size:
+            self.__trees.popitem(last=False)
+        return tree
+
+    def __tree_path(self, tree, source, target):
+        dist, parent = tree
+        if target not in parent:
+            return None
+        course = [target]
+        while course[-1] != source:
+            course.append(parent[course[-1]])
+        course.reverse()
+        return course
+
+    def __bidirectional(self, source, target):
+        # forward over exits from source, backward over entries into target.
+        # Always grow the smaller frontier
+        forward = {source: (None, 0)}
+        backward = {target: (None, 0)}
+        forward_frontier = [source]
+        backward_frontier = [target]
+        while forward_frontier and backward_frontier:
+            if len(forward_frontier) <= len(backward_frontier):
+                forward_frontier, meet = self.__expand(forward_frontier, forward, backward, self.exits)
+            else:
+                backward_frontier, meet = self.__expand(backward_frontier, backward, forward, self.entries)
+            if meet is not None:
+                course = []
+                num = meet
+                while num is not None:
+                    course.append(num)
+                    num = forward[num][0]
+                course.reverse()
+                num = backward[meet][0]
+                while num is not None:
+                    course.append(num)
+                    num = backward[num][0]
+                return course
+        return None
+
+    def __expand(self, frontier, parents, other_parents, lanes):
+        # one full BFS level. Of the sectors where the searches meet, the one
+        # closest to the other end is on a shortest course
+        next_frontier = []
+        meet = None
+        for num in frontier:
+            depth = parents[num][1] + 1
+            for other in lanes[num]:
+                if other in parents: continue
+                parents[other] = (num, depth)
+                if other in other_parents and (meet is None or other_parents[other][1] < other_parents[meet][1]):
+                    meet = other
+                next_frontier.append(other)
+        return next_frontier, meet
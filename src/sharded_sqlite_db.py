@@ -0,0 +1,154 @@
+"""
+Database partitioned over several SQLite files by object id, so that a
+flush is written to all of them at once.
+"""
+import os, queue, threading
+from concurrent.futures import Future, wait
+
+from db_rows import db_row_store
+from sqlite3_db import sqlite3_db, sqlite3_write_batch
+
+class shard_writer_thread(threading.Thread):
+    """
+    Runs the writes of one shard, in the order they were submitted. A
+    daemon rather than an executor, so the flush of the write on exit
+    cache mode still finds it running.
+    """
+    def __init__(self, index):
+        super().__init__(name="shard_writer_{}".format(index), daemon=True)
+        self.jobs = queue.Queue()
+        self.start()
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.jobs.put((future, fn, args))
+        return future
+
+    def run(self):
+        while True:
+            future, fn, args = self.jobs.get()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+class sharded_sqlite_db(db_row_store):
+    """
+    Everything with obj_id i (objects, lists, dictionaries) is stored in
+    shard i % shards, a sqlite3_db of its own: map.db is stored as map-0.db,
+    map-1.db and so on. A database has to be opened with the number of
+    shards it was created with.
+
+    Every shard has a writer thread. A flush is split by shard, and each
+    part is written and committed on the writer of its shard, in parallel
+    with the others: SQLite does its work, the fsync of a commit included,
+    without holding the GIL. References between shards are resolved here,
+    the shards only store rows.
+    
+    A flush is not atomic across shards. Each shard commits on its own, so
+    when one fails the others may have committed already. The whole flush
+    stays pending and is written again, which is harmless: every statement
+    of a flush can be repeated. A crash between the commits of two shards
+    leaves the database with part of the flush, e.g., a reference in one
+    shard to an object another shard never stored. Nothing recovers from
+    that. Use sqlite3_db where that matters.
+
+    Ids are leased from the first shard.
+    """
+    def __init__(self, db_file, shards=4, pack_threshold=256, id_block_size=1024):
+        super().__init__(pack_threshold)
+        self.db_file = db_file
+        root, ext = os.path.splitext(db_file)
+        self.shards = [sqlite3_db("{}-{}{}".format(root, i, ext), pack_threshold, id_block_size=id_block_size) for i in range(shards)]
+        self.writers = [shard_writer_thread(i) for i in range(shards)]
+
+    @classmethod
+    def c_set_ref_mgr(cls, mgr):
+        # the shards turn references into ids when they run queries
+        super().c_set_ref_mgr(mgr)
+        sqlite3_db.c_set_ref_mgr(mgr)
+
+    def shard(self, db_id):
+        return self.shards[db_id % len(self.shards)]
+
+    def __on_every_shard(self, fn, args):
+        # fn(shard, *args) for each shard and its args, on the shard writers
+        futures = [writer.submit(fn, shard, *shard_args) for writer, shard, shard_args in zip(self.writers, self.shards, args)]
+        # all of them done, even when one fails
+        wait(futures)
+        return [future.result() for future in futures]
+
+    def get_id_allocator(self):
+        return self.shards[0].get_id_allocator()
+
+    def register_class(self, db_type_name, db_spec, indexes=()):
+        for shard in self.shards:
+            shard.register_class(db_type_name, db_spec, indexes)
+
+    def query(self, db_type_names, conditions):
+        # an object and its rows are in the same shard
+        return [obj_id for shard in self.shards for obj_id in shard.query(db_type_names, conditions)]
+
+    def get_object_class(self, db_id):
+        return self.shard(db_id).get_object_class(db_id)
+
+    def all_objects(self):
+        return [row for shard in self.shards for row in shard.all_objects()]
+
+    def _stored_rows(self, source, db_id):
+        shard = self.shard(db_id)
+        return shard._stored_rows(shard.conn.cursor(), db_id)
+
+    def get(self, ctx):
+        obj_rows = {field: (ref, value) for field, ref, value in self._stored_rows(None, ctx.db_id)}
+        data = {}
+        for field in ctx.db_spec:
+            if field not in obj_rows:
+                data[field] = self.UNSET
+                continue
+            data[field] = self._load(None, *obj_rows[field])
+        ctx.fields_synchronized()
+        return data
+
+    def get_many(self, ctxs):
+        """
+        Bulk load. Every shard is scanned, and everything rebuilt from the
+        rows of all of them at once (see _build).
+        """
+        rows = {}
+        for shard in self.shards:
+            for obj_id, field, ref, value in shard._scan_rows(shard.conn.cursor()):
+                rows.setdefault(obj_id, []).append((field, ref, value))
+        loaded, new_aggregates = self._build(rows, ctxs)
+        return loaded
+
+    def write_prepared(self, batch):
+        batches = [sqlite3_write_batch() for shard in self.shards]
+        for db_id, db_type_name in batch.objects:
+            batches[db_id % len(batches)].insert_object(db_id, db_type_name)
+        for db_id in batch.deleted_objects:
+            batches[db_id % len(batches)].delete_object(db_id)
+        for db_id in batch.cleared:
+            batches[db_id % len(batches)].clear(db_id)
+        for db_id, field in batch.deletes:
+            batches[db_id % len(batches)].delete(db_id, field)
+        for (db_id, field), (ref, value) in batch.upserts.items():
+            batches[db_id % len(batches)].update(db_id, field, ref, value)
+        for db_id, ctx in batch.ctxs.items():
+            batches[db_id % len(batches)].written(ctx)
+        self.__on_every_shard(sqlite3_db.write_prepared, [(shard_batch,) for shard_batch in batches])
+        return []
+
+    def commit(self):
+        self.__on_every_shard(sqlite3_db.commit, [() for shard in self.shards])
+
+    def abort(self, batch):
+        # only undoes the shards that hadn't committed yet
+        self.__on_every_shard(lambda shard: shard.conn.rollback(), [() for shard in self.shards])
+        super().abort(batch)
+
+    def refresh(self, ctx):
+        if ctx.db_type_name in self.AGGREGATE_TYPES:
+            self._read_aggregate(None, ctx.fields_cache)
+        else:
+            ctx.fields_cache._update(self.get(ctx))
@@ -1,7 +1,10 @@
 from persistent_object import persistent_object
+from db_interface import db_inventory
 
 class ship(persistent_object):
     class persistent_data_spec:
+        # ship.query(m_sector=...) finds the ships in a sector
+        _indexes = ("m_sector",)
         m_class = None
         m_fighters = None
         m_holds = None
@@ -14,7 +17,7 @@ class ship(persistent_object):
         self.m_class = ship_class
         self.m_hp = self.m_class.max_hit_points()
         self.m_fighters = 0
-        self.m_holds = [None] * self.m_class.num_min_holds()
+        self.m_holds = db_inventory(self.m_class.num_min_holds())
         self.m_turns = self.m_class.turns_per_day()
         self.m_special = [item.create() for item in self.m_class.special_features()]
         self.m_sector = None
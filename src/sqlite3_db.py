@@ -1,169 +1,558 @@
-import sqlite3
+import sqlite3, contextlib, os, threading, time
 
-from db_interface import db_interface, db_cache_control, db_list, db_dict
+from db_interface import db_interface, db_id_allocator
+from db_rows import db_row_batch, db_row_store
+import db_codec, db_snapshot
 
-class sqlite3_db(db_interface):
-    def __init__(self, db_file):
-        self.conn = sqlite3.connect(db_file)
+class sqlite3_write_batch(db_row_batch):
+    """
+    A db_row_batch plus, in typed table mode, the changed fields of each
+    class table row.
+    """
+    def __init__(self):
+        super().__init__()
+        self.rows = {}
+        # versioned mode: versions as they were before the write
+        self.versions = {}
+        
+    def drop(self, db_ids):
+        super().drop(db_ids)
+        self.rows = {key: fields for key, fields in self.rows.items() if key[1] not in db_ids}
+        
+    def update_row(self, table, db_id, field, ref, value):
+        self.rows.setdefault((table, db_id), {})[field] = (ref, value)
+        
+class sqlite3_class_table:
+    """
+    Table of one persistent class in typed table mode: an obj_id primary
+    key and, per field, a value column (typed after the spec hint when it
+    is a scalar type) and an integer ref column. The pair holds the same
+    (ref, value) a data row would.
+    """
+    COLUMN_TYPES = {int: "INTEGER", float: "REAL", str: "TEXT", bytes: "BLOB"}
+    
+    def __init__(self, db_type_name, db_spec, indexes=()):
+        self.name = '"class_{}"'.format(db_type_name)
+        self.db_type_name = db_type_name
+        self.fields = tuple(sorted(db_spec))
+        self.indexes = indexes
+        self.hints = {field: db_spec[field] for field in self.fields if db_spec[field] in self.COLUMN_TYPES}
+        self.columns = "".join(', "{0}", "{0}__ref"'.format(field) for field in self.fields)
+        
+    @classmethod
+    def c_from_table(cls, cur, db_type_name):
+        # the table of a class this process doesn't have. Fields from the columns
+        columns = [row[1] for row in cur.execute('PRAGMA table_info("class_{}")'.format(db_type_name))]
+        return cls(db_type_name, {column: None for column in columns if column != "obj_id" and not column.endswith("__ref")})
+        
+    def create(self, cur):
+        cur.execute("CREATE TABLE IF NOT EXISTS {}(obj_id INTEGER PRIMARY KEY)".format(self.name))
+        existing = set(row[1] for row in cur.execute("PRAGMA table_info({})".format(self.name)))
+        for field in self.fields:
+            if field in existing: continue
+            # rows stored before the field existed read back as UNSET
+            cur.execute("""ALTER TABLE {} ADD COLUMN "{}" {} DEFAULT '__unset__'""".format(self.name, field, self.COLUMN_TYPES.get(self.hints.get(field), "")))
+            cur.execute('ALTER TABLE {} ADD COLUMN "{}__ref" INTEGER DEFAULT -1'.format(self.name, field))
+        for field in self.indexes:
+            cur.execute('CREATE INDEX IF NOT EXISTS "class_{0}__{1}" ON {2}("{1}", "{1}__ref")'.format(self.db_type_name, field, self.name))
+            
+    def check(self, field, value):
+        hint = self.hints.get(field, None)
+        if hint is None or value is None or value is db_interface.UNSET: return
+        if type(value) is hint or (hint is float and type(value) is int): return
+        raise Exception("Field {}.{} is declared {}, can't store {}".format(self.db_type_name, field, hint.__name__, type(value).__name__))
+        
+    def select(self, cur, where="", args=()):
+        """
+        Yields obj_id and the (field, ref, value) rows of each object.
+        """
+        for row in cur.execute("SELECT obj_id{} FROM {} {}".format(self.columns, self.name, where), args):
+            yield row[0], [(field, row[2*i+2], row[2*i+1]) for i, field in enumerate(self.fields)]
+            
+    def upsert(self, cur, fields, rows):
+        columns = ", ".join('"{0}", "{0}__ref"'.format(field) for field in fields)
+        updates = ", ".join('"{0}"=excluded."{0}", "{0}__ref"=excluded."{0}__ref"'.format(field) for field in fields)
+        cur.executemany("INSERT INTO {}(obj_id, {}) VALUES(?{}) ON CONFLICT(obj_id) DO UPDATE SET {}".format(
+            self.name, columns, ", ?, ?" * len(fields), updates), rows)
+        
+class sqlite3_db(db_row_store):
+    """
+    Stores everything in an objects table and an entity-attribute-value
+    data table, one row per row of the row model (see db_rows).
+    
+    Ids are leased from the id_blocks table, id_block_size at a time.
+    
+    With typed_tables, objects are stored in a table per class instead
+    (see sqlite3_class_table), so an object is read as one row and written
+    with one UPSERT. Aggregates stay in the data table. A database has to
+    be opened in the mode it was created with.
+    
+    With versioned, several processes can share the database. Every object
+    and aggregate has a version in the versions table, read before its
+    data. A flush only writes what is still at the version it was read at,
+    and stamps what it wrote with the next commit sequence number, which
+    changed_ids() follows. Every process has to open the database versioned.
+    
+    With snapshot_dir, checkpoint() writes a snapshot of the database there
+    (see db_snapshot), every snapshot_interval seconds if that is set. A
+    bulk load then reads the newest snapshot and replays only what was
+    written after it, found by the seq stamps of the versions table. Once
+    a database has a versions table, every flush stamps what it writes,
+    snapshots or not.
+    
+    With wal, the database is put in WAL mode and every thread reads on a
+    connection of its own, so reads don't wait for a commit in progress on
+    the writer's connection. Needs a database file, not ":memory:".
+    """
+    QUERY_SQL_OPS = {"lt": "<", "le": "<=", "gt": ">", "ge": ">="}
+    
+    def __init__(self, db_file, pack_threshold=256, typed_tables=False, id_block_size=1024, versioned=False, snapshot_dir=None, snapshot_interval=None, wal=False):
+        super().__init__(pack_threshold)
+        self.db_file = db_file
+        self.typed_tables = typed_tables
+        self.versioned = versioned
+        self.id_block_size = id_block_size
+        self.snapshot_dir = snapshot_dir
+        self.snapshot_interval = snapshot_interval
+        self.__id_conn = None
+        self.wal = wal
+        self.__readers = threading.local()
+        # the timer mode writer thread shares this connection
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
         cur = self.conn.cursor()
+        if wal:
+            cur.execute("PRAGMA journal_mode=WAL")
         cur.execute("CREATE TABLE IF NOT EXISTS objects(obj_id PRIMARY KEY, obj_class)")
         cur.execute("CREATE TABLE IF NOT EXISTS data(obj_id, field, ref, value, PRIMARY KEY(obj_id, field))")
+        cur.execute("CREATE TABLE IF NOT EXISTS id_blocks(name PRIMARY KEY, next_id INTEGER)")
+        # snapshots are only good while every write is stamped, so a
+        # database that has had them keeps stamping
+        self.stamped = versioned or snapshot_dir is not None or cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'versions'").fetchone() is not None
+        if self.stamped:
+            cur.execute("CREATE TABLE IF NOT EXISTS versions(obj_id INTEGER PRIMARY KEY, version INTEGER, seq INTEGER)")
+            cur.execute("CREATE INDEX IF NOT EXISTS versions_seq ON versions(seq)")
         self.conn.commit()
-        self.cache_control = db_cache_control(self)
+        self.__class_hints = {}
+        self.__tables = {}
+        # versioned mode: the version of everything as it was read or last
+        # written here (0 if it has none), and the last commit seen
+        self.__versions = {}
+        self.__seen_seq = 0
+        if versioned:
+            self.__seen_seq = cur.execute("SELECT MAX(seq) FROM versions").fetchone()[0] or 0
+        # snapshot read by all_objects, for the get_many that follows
+        self.__restored = None
+        self.__last_snapshot = 0
+        if snapshot_dir is not None:
+            found = db_snapshot.snapshots(snapshot_dir)
+            if found:
+                self.__last_snapshot = os.path.getmtime(found[-1][1])
+        
+    def get_id_allocator(self):
+        if self.db_file == ":memory:":
+            return db_id_allocator.c_in_memory()
+        return db_id_allocator(self.__lease_ids, self.id_block_size)
+        
+    def __lease_ids(self, count):
+        # leases commit on a connection of their own, whatever the main one
+        # has in flight. BEGIN IMMEDIATE makes concurrent leases take turns
+        if self.__id_conn is None:
+            self.__id_conn = sqlite3.connect(self.db_file, timeout=60, isolation_level=None, check_same_thread=False)
+        conn = self.__id_conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT next_id FROM id_blocks WHERE name = 'objects'").fetchone()
+            first_id = row[0] if row is not None else self.__first_unused_id(conn)
+            conn.execute("REPLACE INTO id_blocks(name, next_id) VALUES('objects', ?)", (first_id + count,))
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        return first_id
+        
+    def __first_unused_id(self, conn):
+        # databases written before ids were leased
+        tables = ["objects", "data"] + ['"{}"'.format(row[0]) for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'class_%'")]
+        last_ids = [conn.execute("SELECT MAX(obj_id) FROM {}".format(table)).fetchone()[0] for table in tables]
+        return max([last_id for last_id in last_ids if last_id is not None] + [-1]) + 1
         
-    def __delete(self, cur, db_id, field=None):
-        if field == None:
-            cur.execute("DELETE FROM objects WHERE obj_id = ?", (db_id, ))
-            cur.execute("DELETE FROM data WHERE obj_id = ?", (db_id, ))
+    def __read_cursor(self):
+        # with wal, every thread reads on a connection of its own, which
+        # sees the last commit and doesn't wait for the one in progress
+        if not self.wal:
+            return self.conn.cursor()
+        conn = getattr(self.__readers, "conn", None)
+        if conn is None:
+            conn = self.__readers.conn = sqlite3.connect(self.db_file)
+        return conn.cursor()
+        
+    def register_class(self, db_type_name, db_spec, indexes=()):
+        cur = self.conn.cursor()
+        if self.typed_tables:
+            table = sqlite3_class_table(db_type_name, db_spec, indexes)
+            table.create(cur)
+            self.__tables[db_type_name] = table
         else:
-            # We don't delete references yet. Garbage collection at some point
-            # cur.execute("SELECT (ref, value) FROM data WHERE obj_id=? AND field=?", (db_id, field))
-            # row = cur.fetchone()
-            # if row is None:
-            #     returnc_create_db_list
-            # ref, value = row
-            # if ref:
-            #     self.__delete(value)
-            cur.execute("DELETE FROM data WHERE obj_id = ? AND  field = ?", (db_id, field))
-        
-    def __update(self, cur, db_id, field, value):
-        # TODO: This is ugly. Get machinery for creating our complex types.
-        if isinstance(value, list) and not isinstance(value, db_list):
-            value = db_list.REGISTRY.c_create_db_list(self.get_cache_control().save, value)
-        elif isinstance(value, dict) and not isinstance(value, db_dict):
-            value = db_dict.REGISTRY.c_create_db_dict(self.get_cache_control().save, value)
+            # partial indexes: only the rows of the indexed field are in each
+            for field in indexes:
+                cur.execute("""CREATE INDEX IF NOT EXISTS "data__{0}" ON data(value, ref) WHERE field = '{0}'""".format(field))
+        self.conn.commit()
+        
+    def __condition(self, value_column, ref_column, op, value):
+        if op == "in":
+            parts = [self.__condition(value_column, ref_column, "eq", v) for v in value]
+            if not parts: return "0", []
+            return "(" + " OR ".join(sql for sql, args in parts) + ")", [arg for sql, args in parts for arg in args]
+        # compare against the (ref, value) pair a row would hold. IS also matches NULLs
+        value, ref_type = self.c_db_ref(value)
+        ref, value = (value, ref_type) if ref_type is not None else (None, value)
+        if op == "eq":
+            return "({} IS ? AND {} IS ?)".format(ref_column, value_column), [ref, value]
+        if op == "ne":
+            return "NOT ({} IS ? AND {} IS ?)".format(ref_column, value_column), [ref, value]
+        if ref is not None:
+            raise Exception("References can only be compared with eq, ne and in")
+        return "({} IS NULL AND {} {} ?)".format(ref_column, value_column, self.QUERY_SQL_OPS[op]), [value]
+        
+    def query(self, db_type_names, conditions):
+        cur = self.__read_cursor()
+        if self.typed_tables:
+            parts = [self.__condition('"{}"'.format(field), '"{}__ref"'.format(field), op, value) for field, op, value in conditions]
+            where = "WHERE " + " AND ".join(sql for sql, args in parts) if parts else ""
+            args = [arg for sql, args in parts for arg in args]
+            obj_ids = []
+            for db_type_name in db_type_names:
+                table = self.__tables.get(db_type_name, None)
+                if table is not None:
+                    obj_ids.extend(row[0] for row in cur.execute("SELECT obj_id FROM {} {}".format(table.name, where), args))
+            return obj_ids
             
-        (value_ref, ref_type) = self.c_db_ref(value)
-        
-        if ref_type is None and type(value) in self.ALLOWED_SCALAR_TYPES:
-            values = (db_id, field, None, value)
-        elif ref_type is not None:
-            values = (db_id, field, value_ref, ref_type)
-            if isinstance(value, list):
-                for k in value._db_ctx.db_dirty_fields:
-                    if k < len(value):
-                        self.__update(cur, value._db_ctx.db_id, k, value[k])
-                    else:
-                        self.__delete(cur, value._db_ctx.db_id, k)
-                value._db_ctx.fields_synchronized()
-            elif isinstance(value, dict):
-                for k in value._db_ctx.db_dirty_fields:
-                    if k in value:
-                        self.__update(cur, value._db_ctx.db_id, k, value[k])
-                    else:
-                        self.__delete(cur, value._db_ctx.db_id, k)
-                value._db_ctx.fields_synchronized()
-        else:
-            raise Exception("Unhandled type {}".format(type(value)))
+        joins = []
+        parts = [("objects.obj_class IN ({})".format(",".join("?" * len(db_type_names))), list(db_type_names))]
+        for i, (field, op, value) in enumerate(conditions):
+            # the field name is inlined so that its partial index applies
+            joins.append("JOIN data d{0} ON d{0}.obj_id = objects.obj_id AND d{0}.field = '{1}'".format(i, field))
+            parts.append(self.__condition("d{}.value".format(i), "d{}.ref".format(i), op, value))
+        sql = "SELECT objects.obj_id FROM objects {} WHERE {}".format(" ".join(joins), " AND ".join(sql for sql, args in parts))
+        return [row[0] for row in cur.execute(sql, [arg for sql, args in parts for arg in args])]
         
-        cur.execute("REPLACE INTO data(obj_id, field, ref, value) VALUES(?, ?, ?, ?)", values)
+    def _new_batch(self):
+        return sqlite3_write_batch()
+        
+    def _update_field(self, batch, ctx, field, value):
+        table = self.__tables.get(ctx.db_type_name, None)
+        if table is None:
+            return self._update(batch, ctx.db_id, field, value)
+        value, ref, stored_value = self._encode(batch, value)
+        batch.update_row(table, ctx.db_id, field, ref, stored_value)
         return value
+        
+    def __rows(self, cur, db_id):
+        cur.execute("SELECT field, ref, value FROM data WHERE obj_id=? ORDER BY field", (db_id,))
+        rows = cur.fetchall()
+        self.__prefetch_classes(cur, rows)
+        return rows
+        
+    def _stored_rows(self, cur, db_id):
+        self.__read_version(cur, db_id)
+        return self.__rows(cur, db_id)
+        
+    def _unpack(self, cur, rows):
+        items = super()._unpack(cur, rows)
+        self.__prefetch_classes(cur, [(None, ref, value) for ref, value in items])
+        return items
+        
+    def __prefetch_classes(self, cur, rows):
+        # objects referenced by these rows are likely to be faulted in next.
+        # Look up all of their classes in one query rather than one per object
+        obj_ids = [ref for field, ref, value in rows if value == "__persistent_object__" and ref not in self.__class_hints]
+        for i in range(0, len(obj_ids), 500):
+            chunk = obj_ids[i:i+500]
+            cur.execute("SELECT obj_id, obj_class FROM objects WHERE obj_id IN ({})".format(",".join("?"*len(chunk))), chunk)
+            self.__class_hints.update(cur.fetchall())
             
-    def __load(self, cur, db_id, field):
-        cur.execute("SELECT ref, value FROM data WHERE obj_id=? and field=?", (db_id, field))
-        row = cur.fetchone()
-        if row is None:
-            raise Exception("Could not load field {}".format(field))
-            
-        ref, value = row
-        if ref is not None:
-
-            # inline dereferencing of aggregate types like list and dictionary
-            if value == "__list__":
-                l = db_list.REGISTRY.c_get_db_list_by_id(ref)
-                if l is not None:
-                    return l
-                
-                l = db_list.REGISTRY.c_create_db_list(self.get_cache_control().save, fixed_id=ref)
-                l._db_ctx.set_db_loading_mode()
-                
-                cur.execute("SELECT MAX(field) FROM data WHERE obj_id=?", (l._db_ctx.db_id,))
-                row = cur.fetchone()
-                if row is None:
-                    # list is empty, I guess
-                    return l
-                    
-                max_index = row[0]
-                for i in range(max_index+1): # plus 1 because max_index is an actually used index
-                    l.append(self.__load(cur, l._db_ctx.db_id, i))
-                l._db_ctx.fields_synchronized()
-                return l
-            # inline dereferencing of aggregate types like list and dictionary
-            if value == "__dict__":
-                d = db_dict.REGISTRY.c_get_db_dict_by_id(ref)
-                if d is not None:
-                    return d
-                
-                d = db_dict.REGISTRY.c_create_db_dict(self.get_cache_control().save, fixed_id=ref)
-                d._db_ctx.set_db_loading_mode()
-                
-                for row in cur.execute("SELECT field FROM data WHERE obj_id=?", (d._db_ctx.db_id,)):
-                    # I think we need a different cursor for calls outside this for loop?
-                    field_cur = self.conn.cursor()
-                    
-                    d_field = row[0]
-                    
-                    # inefficient. Two select calls instead of one. TODO: streamline
-                    d[d_field] = self.__load(field_cur, d._db_ctx.db_id, d_field)
-                
-                d._db_ctx.fields_synchronized()
-                return d
-                
-            # the de-referencer is used for dereferencing external object
-            # it's also used for the UNSET value for... reasons...
-            else:
-                value, derefed = self.c_db_deref(ref, value)
-                if not derefed:
-                    raise Exception("Could not dereference {}, {}".format(ref, value))
-                return value
-        else:
-            return value
-            
-    def get_cache_control(self):
-        return self.cache_control
+    def __read_version(self, cur, db_id):
+        # before the data it covers: a version older than the data only
+        # costs a needless conflict, a newer one would hide a real one
+        if self.versioned:
+            row = cur.execute("SELECT version FROM versions WHERE obj_id = ?", (db_id,)).fetchone()
+            self.__versions[db_id] = row[0] if row is not None else 0
             
     def commit(self):
         self.conn.commit()
+        if self.snapshot_interval is not None and time.time() - self.__last_snapshot >= self.snapshot_interval:
+            self.checkpoint()
         
-    def init_object(self, ctx):
-        cur = self.conn.cursor()
-        cur.execute("INSERT INTO objects(obj_id, obj_class) VALUES(?, ?)", [ctx.db_id, ctx.db_type_name])
-        for field in ctx.db_spec:
-            self.__update(cur, ctx.db_id, field, self.UNSET)
-        
+    def check_field(self, ctx, field, value):
+        table = self.__tables.get(ctx.db_type_name, None)
+        if table is not None:
+            table.check(field, value)
+            
     def get(self, ctx):
-        cur = self.conn.cursor()
-        fields = list(ctx.db_spec.keys())
+        cur = self.__read_cursor()
+        self.__read_version(cur, ctx.db_id)
+        table = self.__tables.get(ctx.db_type_name, None)
+        if table is None:
+            obj_rows = {field: (ref, value) for field, ref, value in self.__rows(cur, ctx.db_id)}
+        else:
+            obj_rows = {}
+            for obj_id, rows in table.select(cur, "WHERE obj_id=?", (ctx.db_id,)):
+                self.__prefetch_classes(cur, rows)
+                obj_rows = {field: (ref, value) for field, ref, value in rows}
         data = {}
-        for field in fields:
-            data[field] = self.__load(cur, ctx.db_id, field)
+        for field in ctx.db_spec:
+            if field not in obj_rows:
+                data[field] = self.UNSET
+                continue
+            data[field] = self._load(cur, *obj_rows[field])
         ctx.fields_synchronized()
         return data
         
-    def set(self, ctx, data):
+    def get_object_class(self, db_id):
+        obj_class = self.__class_hints.pop(db_id, None)
+        if obj_class is not None:
+            return obj_class
+        cur = self.__read_cursor()
+        cur.execute("SELECT obj_class FROM objects WHERE obj_id=?", (db_id,))
+        row = cur.fetchone()
+        return row and row[0]
+        
+    def get_many(self, ctxs):
+        """
+        Bulk load. The data table is read in a single ordered scan (or the
+        snapshot all_objects restored is used) and every object, list and
+        dictionary is rebuilt from those rows in memory (see _build).
+        """
+        cur = self.__read_cursor()
+        restored, self.__restored = self.__restored, None
+        if restored is None:
+            # versions first, as in __read_version
+            stored_versions = dict(cur.execute("SELECT obj_id, version FROM versions")) if self.versioned else {}
+            rows = {}
+            for obj_id, field, ref, value in self._scan_rows(cur):
+                rows.setdefault(obj_id, []).append((field, ref, value))
+        else:
+            objects, stored_versions, rows = restored
+        loaded, new_aggregates = self._build(rows, ctxs)
+        if self.versioned:
+            for db_id in [ctx.db_id for ctx in ctxs] + [agg._db_ctx.db_id for agg in new_aggregates]:
+                self.__versions[db_id] = stored_versions.get(db_id, 0)
+        return loaded
+        
+    def write_prepared(self, batch):
+        # one round trip per statement type, not per row
         cur = self.conn.cursor()
+        conflicts = []
+        if self.versioned:
+            conflicts = self.__check_versions(cur, batch)
+            if batch.deleted_objects:
+                self.__stamp(cur, batch.deleted_objects)
+        elif self.stamped:
+            self.__stamp(cur, list(batch.ctxs) + batch.deleted_objects)
+        if batch.objects:
+            # a batch written again after a partial commit (sharded_sqlite_db)
+            # finds some of them there already
+            cur.executemany("INSERT OR IGNORE INTO objects(obj_id, obj_class) VALUES(?, ?)", batch.objects)
+        if batch.deleted_objects:
+            cur.executemany("DELETE FROM objects WHERE obj_id = ?", ((db_id,) for db_id in batch.deleted_objects))
+            cur.executemany("DELETE FROM data WHERE obj_id = ?", ((db_id,) for db_id in batch.deleted_objects))
+            for table in self.__tables.values():
+                cur.executemany("DELETE FROM {} WHERE obj_id = ?".format(table.name), ((db_id,) for db_id in batch.deleted_objects))
+        if batch.cleared:
+            cur.executemany("DELETE FROM data WHERE obj_id = ?", ((db_id,) for db_id in batch.cleared))
+        if batch.deletes:
+            cur.executemany("DELETE FROM data WHERE obj_id = ? AND field = ?", batch.deletes)
+        if batch.upserts:
+            cur.executemany("REPLACE INTO data(obj_id, field, ref, value) VALUES(?, ?, ?, ?)",
+                ((db_id, field, ref, value) for (db_id, field), (ref, value) in batch.upserts.items()))
+        if batch.rows:
+            # one executemany per table and set of changed fields
+            upserts = {}
+            for (table, db_id), fields in batch.rows.items():
+                changed = tuple(sorted(fields))
+                row = [db_id]
+                for field in changed:
+                    ref, value = fields[field]
+                    row.append(value)
+                    row.append(ref)
+                upserts.setdefault((table, changed), []).append(row)
+            for (table, changed), rows in upserts.items():
+                table.upsert(cur, changed, rows)
+        return conflicts
+        
+    def abort(self, batch):
+        self.conn.rollback()
+        self.__versions.update(batch.versions)
+        super().abort(batch)
         
-        # update aggregates directly
-        if ctx.db_type_name == "__list__":
-            for k in ctx.db_dirty_fields:
-                if k < len(data):
-                    self.__update(cur, ctx.db_id, k, data[k])
-                else:
-                    self.__delete(cur, ctx.db_id, k)
-        elif ctx.db_type_name == "__dict__":
-            for k in ctx.db_dirty_fields:
-                if k in data:
-                    self.__update(cur, ctx.db_id, k, data[k])
-                else:
-                    self.__delete(cur, ctx.db_id, k)
+    def __check_versions(self, cur, batch):
+        # the write lock is taken up front, so nobody commits between
+        # the version check and the writes
+        if not self.conn.in_transaction:
+            cur.execute("BEGIN IMMEDIATE")
+        db_ids = list(batch.ctxs)
+        stored_versions = {}
+        for i in range(0, len(db_ids), 500):
+            chunk = db_ids[i:i+500]
+            cur.execute("SELECT obj_id, version FROM versions WHERE obj_id IN ({})".format(",".join("?"*len(chunk))), chunk)
+            stored_versions.update(cur.fetchall())
+            
+        conflicts = [ctx for db_id, ctx in batch.ctxs.items() if stored_versions.get(db_id, 0) != self.__versions.get(db_id, 0)]
+        if conflicts:
+            batch.drop(set(ctx.db_id for ctx in conflicts))
+            
+        seq = cur.execute("SELECT MAX(seq) FROM versions").fetchone()[0] or 0
+        new_versions = [(db_id, stored_versions.get(db_id, 0) + 1, seq + 1) for db_id in batch.ctxs]
+        cur.executemany("REPLACE INTO versions(obj_id, version, seq) VALUES(?, ?, ?)", new_versions)
+        for db_id, version, seq in new_versions:
+            batch.versions.setdefault(db_id, self.__versions.get(db_id, 0))
+            self.__versions[db_id] = version
+        return conflicts
+        
+    def __stamp(self, cur, db_ids):
+        # what a flush writes gets the next seq. A snapshot at seq s then
+        # misses exactly what has a later one
+        if not db_ids: return
+        if not self.conn.in_transaction:
+            cur.execute("BEGIN IMMEDIATE")
+        seq = (cur.execute("SELECT MAX(seq) FROM versions").fetchone()[0] or 0) + 1
+        cur.executemany("INSERT INTO versions(obj_id, version, seq) VALUES(?, 1, ?) ON CONFLICT(obj_id) DO UPDATE SET version = version + 1, seq = excluded.seq",
+            ((db_id, seq) for db_id in db_ids))
+        
+    def refresh(self, ctx):
+        cur = self.__read_cursor()
+        if ctx.db_type_name in self.AGGREGATE_TYPES:
+            self._read_aggregate(cur, ctx.fields_cache)
         else:
-            for k in data:
-                if k not in ctx.db_spec: raise Exception("Data filed {} is not persistent".format(k))
-                if k not in ctx.db_dirty_fields: continue
-                data[k] = self.__update(cur, ctx.db_id, k, data[k])
-        ctx.fields_synchronized()
+            ctx.fields_cache._update(self.get(ctx))
+            
+    def overwrite(self, ctx):
+        # whatever is stored now is what gets replaced
+        self.__read_version(self.__read_cursor(), ctx.db_id)
+        super().overwrite(ctx)
+            
+    def changed_ids(self):
+        if not self.versioned: return []
+        cur = self.__read_cursor()
+        changed = []
+        for db_id, version, seq in cur.execute("SELECT obj_id, version, seq FROM versions WHERE seq > ?", (self.__seen_seq,)):
+            self.__seen_seq = max(self.__seen_seq, seq)
+            # only what is loaded here, and not our own writes
+            if self.__versions.get(db_id, version) != version:
+                changed.append(db_id)
+        return changed
         
     def all_objects(self):
-        cur = self.conn.cursor()
-        for row in cur.execute("SELECT * FROM objects"):
-            yield(row)
\ No newline at end of file
+        if self.snapshot_dir is not None:
+            with self.__consistent_read() as cur:
+                self.__restored = self.__restore(cur)
+            if self.__restored is not None:
+                return list(self.__restored[0].items())
+        cur = self.__read_cursor()
+        return cur.execute("SELECT * FROM objects")
+        
+    def __class_tables(self, cur):
+        # including those of classes not registered here
+        tables = list(self.__tables.values())
+        for row in cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'class_%'").fetchall():
+            db_type_name = row[0][len("class_"):]
+            if db_type_name not in self.__tables:
+                tables.append(sqlite3_class_table.c_from_table(cur, db_type_name))
+        return tables
+        
+    def _scan_rows(self, cur, where="", args=()):
+        """
+        Yields obj_id, field, ref, value of every stored row, from the data
+        table and the class tables. Packed aggregates come as one row of
+        the unpacked items.
+        """
+        for obj_id, field, ref, value in cur.execute("SELECT obj_id, field, ref, value FROM data {} ORDER BY obj_id, field".format(where), args):
+            if ref == self.PACKED:
+                value = db_codec.unpack_items(value)
+            yield obj_id, field, ref, value
+        for table in self.__class_tables(cur):
+            for obj_id, obj_rows in table.select(cur, where, args):
+                for field, ref, value in obj_rows:
+                    yield obj_id, field, ref, value
+                    
+    def __stored(self, cur, where="", args=()):
+        # (objects, versions, rows) as stored, the way a snapshot holds them
+        objects = dict(cur.execute("SELECT obj_id, obj_class FROM objects {}".format(where), args))
+        versions = dict(cur.execute("SELECT obj_id, version FROM versions {}".format(where), args)) if self.stamped else {}
+        rows = {}
+        for obj_id, field, ref, value in self._scan_rows(cur, where, args):
+            rows.setdefault(obj_id, []).append((field, ref, value))
+        return objects, versions, rows
+        
+    @contextlib.contextmanager
+    def __consistent_read(self):
+        # one read transaction, so everything read is as of the same commit.
+        # No flush runs on this connection meanwhile
+        with self.cache_control.write_lock:
+            started = not self.conn.in_transaction
+            if started:
+                self.conn.execute("BEGIN")
+            try:
+                yield self.conn.cursor()
+            finally:
+                if started:
+                    self.conn.commit()
+                    
+    def checkpoint(self):
+        """
+        Write a snapshot of everything committed to snapshot_dir. Returns
+        its path.
+        """
+        if self.snapshot_dir is None:
+            raise Exception("No snapshot_dir for {}".format(self.db_file))
+        with self.cache_control.write_lock:
+            # what isn't committed yet isn't in the snapshot
+            self.conn.commit()
+            with self.__consistent_read() as cur:
+                seq = cur.execute("SELECT MAX(seq) FROM versions").fetchone()[0] or 0
+                objects, versions, rows = self.__stored(cur)
+        self.__last_snapshot = time.time()
+        return db_snapshot.write(self.snapshot_dir, seq, objects, versions, rows)
+        
+    def __restore(self, cur):
+        """
+        (objects, versions, rows) from the newest snapshot, with everything
+        written after it read back from the database. None if there is no
+        snapshot that can be used.
+        """
+        path = db_snapshot.newest(self.snapshot_dir)
+        if path is None:
+            return None
+        try:
+            seq, objects, versions, rows = db_snapshot.read(path)
+        except Exception as e:
+            print("Ignoring snapshot {}: {}".format(path, e))
+            return None
+        changed = [row[0] for row in cur.execute("SELECT obj_id FROM versions WHERE seq > ?", (seq,))]
+        for i in range(0, len(changed), 500):
+            chunk = changed[i:i+500]
+            for db_id in chunk:
+                objects.pop(db_id, None)
+                rows.pop(db_id, None)
+            # deleted objects just don't come back
+            for stored, replayed in zip((objects, versions, rows), self.__stored(cur, "WHERE obj_id IN ({})".format(",".join("?"*len(chunk))), chunk)):
+                stored.update(replayed)
+        return objects, versions, rows
+        
+    def verify_snapshot(self):
+        """
+        Compare the newest snapshot, with the changes since replayed, to a
+        full read of the database. Returns the differences, one message
+        each. Empty if they agree.
+        """
+        with self.__consistent_read() as cur:
+            restored = self.__restore(cur)
+            if restored is None:
+                return ["No snapshot in {}".format(self.snapshot_dir)]
+            stored = self.__stored(cur)
+        problems = []
+        for name, from_snapshot, from_db in zip(("class", "version", "rows"), restored, stored):
+            for db_id in sorted(set(from_snapshot) | set(from_db)):
+                if from_snapshot.get(db_id) != from_db.get(db_id):
+                    problems.append("{} of {}: {} in the snapshot, {} in the database".format(name, db_id, from_snapshot.get(db_id), from_db.get(db_id)))
+        return problems
\ No newline at end of file
@@ -1,7 +1,16 @@
+import sys
 from persistent_object import persistent_object
-from sqlite3_db import sqlite3_db
 
-persistent_object.c_set_db_interface(sqlite3_db("test.db"))
+# python test.py init|reload [sqlite|log|sharded]
+if len(sys.argv) > 2 and sys.argv[2] == "log":
+    from log_db import log_db
+    persistent_object.c_set_db_interface(log_db("test.log"))
+elif len(sys.argv) > 2 and sys.argv[2] == "sharded":
+    from sharded_sqlite_db import sharded_sqlite_db
+    persistent_object.c_set_db_interface(sharded_sqlite_db("test.db"))
+else:
+    from sqlite3_db import sqlite3_db
+    persistent_object.c_set_db_interface(sqlite3_db("test.db"))
 
 class Test(persistent_object):
     class persistent_data_spec:
@@ -15,7 +24,6 @@ class Test(persistent_object):
         self.x = 3
         self.y = "hello"
         
-import sys
 if sys.argv[1] == "init":
     t1 = Test()
     t1.x=4
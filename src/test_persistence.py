@@ -0,0 +1,200 @@
+"""
+Regression tests for the persistence layer: transactions and rollback,
+recovery from failed flushes and snapshot verification.
+
+    python -m pytest test_persistence.py
+"""
+import gc, sqlite3, threading, time
+
+import pytest
+
+from persistent_object import persistent_object
+from db_interface import db_cache_control
+from sqlite3_db import sqlite3_db
+from sharded_sqlite_db import sharded_sqlite_db
+
+class c_test_item(persistent_object):
+    class persistent_data_spec:
+        a = None
+        items = None
+        peer = None
+
+    def __init__(self, a=0):
+        self.a = a
+        self.items = []
+        self.peer = None
+
+def use_db(db, mode=db_cache_control.CACHE_MODE_MANUAL):
+    persistent_object.c_set_db_interface(db)
+    cache_control = db.get_cache_control()
+    cache_control.change_mode(mode)
+    return cache_control
+
+def item_id(item):
+    return item.__get_persistent_id__()
+
+def stored_a(db_file, db_id):
+    conn = sqlite3.connect(db_file)
+    try:
+        row = conn.execute("SELECT value FROM data WHERE obj_id = ? AND field = 'a'", (db_id,)).fetchone()
+        return row and row[0]
+    finally:
+        conn.close()
+
+@pytest.fixture(autouse=True)
+def forget_objects():
+    # every test starts a new database, with ids from 0 again. Objects
+    # left over from the last one must not answer for those ids
+    yield
+    persistent_object.c_set_object_cache_size(0)
+    persistent_object.c_set_object_cache_size(0)
+    persistent_object.c_set_object_cache_size(None)
+    gc.collect()
+
+@pytest.fixture
+def db_file(tmp_path):
+    return str(tmp_path / "test.db")
+
+def test_rollback_restores_changes(db_file):
+    cache_control = use_db(sqlite3_db(db_file))
+    item = c_test_item(1)
+    item.items.extend([1, 2, 3])
+    cache_control.write_to_database()
+    with persistent_object.transaction():
+        item.a = 2
+        with pytest.raises(ValueError):
+            with persistent_object.transaction():
+                item.a = 3
+                item.items.pop(0)
+                raise ValueError
+        assert item.a == 2 and item.items == [1, 2, 3]
+    assert item.a == 2
+    cache_control.write_to_database()
+    assert stored_a(db_file, item_id(item)) == 2
+
+def test_rollback_forgets_created_objects(db_file):
+    cache_control = use_db(sqlite3_db(db_file))
+    c_test_item(1)
+    cache_control.write_to_database()
+    with pytest.raises(ValueError):
+        with persistent_object.transaction():
+            gone_id = item_id(c_test_item(2))
+            raise ValueError
+    assert persistent_object.c_get_object_by_id(gone_id) is None
+    assert not cache_control.pending
+    assert cache_control.first_pending_time is None
+    cache_control.write_to_database()
+    conn = sqlite3.connect(db_file)
+    assert conn.execute("SELECT obj_id FROM objects").fetchall() == [(0,)]
+    conn.close()
+
+def test_rollback_keeps_other_threads_changes(db_file):
+    cache_control = use_db(sqlite3_db(db_file))
+    mine, theirs = c_test_item(1), c_test_item(1)
+    cache_control.write_to_database()
+    other = threading.Thread(target=setattr, args=(theirs, "a", 2))
+    with pytest.raises(ValueError):
+        with persistent_object.transaction():
+            mine.a = 5
+            other.start()
+            other.join()
+            raise ValueError
+    assert mine.a == 1 and theirs.a == 2
+
+def test_failed_commit_stays_pending(db_file, monkeypatch):
+    db = sqlite3_db(db_file)
+    cache_control = use_db(db)
+    item = c_test_item(1)
+    cache_control.write_to_database()
+    item.a = 2
+    def fail():
+        raise Exception("disk full")
+    monkeypatch.setattr(db, "commit", fail)
+    with pytest.raises(Exception, match="disk full"):
+        cache_control.write_to_database()
+    assert item_id(item) in cache_control.pending and not cache_control.flushing
+    assert stored_a(db_file, item_id(item)) == 1
+    # changes made after the failure are written together with it
+    item.a = 3
+    monkeypatch.undo()
+    cache_control.write_to_database()
+    assert not cache_control.pending
+    assert stored_a(db_file, item_id(item)) == 3
+
+def test_failed_serialization_stays_pending(db_file):
+    cache_control = use_db(sqlite3_db(db_file))
+    item = c_test_item(1)
+    cache_control.write_to_database()
+    item.a = 2
+    item.items.append(object())
+    with pytest.raises(Exception):
+        cache_control.write_to_database()
+    item.items.pop()
+    cache_control.write_to_database()
+    assert not cache_control.pending
+    assert stored_a(db_file, item_id(item)) == 2
+
+def test_timer_writer_survives_a_failed_write(db_file, monkeypatch):
+    db = sqlite3_db(db_file)
+    commit = db.commit
+    failures = []
+    def fail_once():
+        if not failures:
+            failures.append(True)
+            raise Exception("disk full")
+        commit()
+    monkeypatch.setattr(db, "commit", fail_once)
+    cache_control = use_db(db)
+    item = c_test_item(1)
+    cache_control.change_timeout(0.05)
+    cache_control.change_mode(db_cache_control.CACHE_MODE_TIMER)
+    try:
+        deadline = time.time() + 5
+        while cache_control.stats["flushes"] == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        assert failures and cache_control.writer.is_alive()
+        assert stored_a(db_file, item_id(item)) == 1
+    finally:
+        cache_control.change_mode(db_cache_control.CACHE_MODE_MANUAL)
+
+def test_sharded_flush_retries_after_a_partial_commit(tmp_path, monkeypatch):
+    db = sharded_sqlite_db(str(tmp_path / "sharded.db"))
+    cache_control = use_db(db)
+    items = [c_test_item(i) for i in range(8)]
+    for i, item in enumerate(items):
+        item.peer = items[(i + 1) % len(items)]
+    commit = sqlite3_db.commit
+    failures = []
+    def fail_once(shard):
+        if shard is db.shards[1] and not failures:
+            failures.append(shard)
+            raise Exception("disk full")
+        commit(shard)
+    monkeypatch.setattr(sqlite3_db, "commit", fail_once)
+    with pytest.raises(Exception, match="disk full"):
+        cache_control.write_to_database()
+    # the other shards committed. Writing it all again must still work
+    cache_control.write_to_database()
+    assert not cache_control.pending
+    for i, item in enumerate(items):
+        assert stored_a(str(tmp_path / "sharded-{}.db".format(item_id(item) % 4)), item_id(item)) == i
+
+def test_snapshot_agrees_with_the_database(tmp_path):
+    db_file = str(tmp_path / "snap.db")
+    db = sqlite3_db(db_file, snapshot_dir=str(tmp_path / "snapshots"))
+    cache_control = use_db(db)
+    items = [c_test_item(i) for i in range(20)]
+    cache_control.write_to_database()
+    db.checkpoint()
+    # replayed on top of the snapshot
+    items[3].a = 30
+    items[4].items.append(4)
+    c_test_item(100)
+    cache_control.write_to_database()
+    assert db.verify_snapshot() == []
+    # a change that went around the versions table isn't replayed
+    conn = sqlite3.connect(db_file)
+    conn.execute("UPDATE data SET value = 99 WHERE obj_id = ? AND field = 'a'", (item_id(items[5]),))
+    conn.commit()
+    conn.close()
+    assert db.verify_snapshot() != []
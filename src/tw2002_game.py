@@ -16,4 +16,4 @@ class tw2002clone_game(persistent_object):
         pass
         
     def clock_update(self):
-        pass
\ No newline at end of file
+        self.m_map.economy.tick()
\ No newline at end of file